@@ -0,0 +1,124 @@
+# This file contains the usage analytics for admins, computed on the server with aggregation pipelines.
+
+from datetime import datetime, timedelta
+
+from database import get_collection
+
+
+# Percentiles reported for session expense and length
+PERCENTILES = [0.5, 0.9, 0.99]
+
+
+def spend_per_model_per_day(days: int = 30) -> list:
+    '''
+    Total spend and number of requests per model per day, from the usage events.
+
+    Args:
+        days (int): How many days back to look
+    Returns:
+        list: One row per model and day, newest day first
+    '''
+    since = datetime.now() - timedelta(days=days)
+    pipeline = [
+        # Uses the index on time
+        {'$match': {'time': {'$gte': since}}},
+        {'$group': {
+            '_id': {'day': {'$dateToString': {'format': '%Y-%m-%d', 'date': '$time'}}, 'model': '$model'},
+            'cost': {'$sum': '$cost'},
+            'requests': {'$sum': 1},
+            'tokens': {'$sum': {'$add': [{'$ifNull': ['$prompt_tokens', 0]}, {'$ifNull': ['$completion_tokens', 0]}]}},
+        }},
+        {'$sort': {'_id.day': -1, 'cost': -1}},
+        {'$project': {'_id': 0, 'day': '$_id.day', 'model': '$_id.model', 'cost': 1, 'requests': 1, 'tokens': 1}},
+    ]
+    return list(get_collection('usage_events').aggregate(pipeline))
+
+
+def top_users(limit: int = 10, days: int = 30) -> list:
+    '''
+    The users with the highest spend, from the usage events.
+
+    Args:
+        limit (int): The number of users
+        days (int): How many days back to look
+    Returns:
+        list: One row per user, highest spend first
+    '''
+    since = datetime.now() - timedelta(days=days)
+    pipeline = [
+        {'$match': {'time': {'$gte': since}}},
+        {'$group': {'_id': '$user_id', 'cost': {'$sum': '$cost'}, 'requests': {'$sum': 1}}},
+        {'$sort': {'cost': -1}},
+        {'$limit': limit},
+        # Only the top users are joined, using the unique index on user_id
+        {'$lookup': {
+            'from': 'users',
+            'localField': '_id',
+            'foreignField': 'user_id',
+            'pipeline': [{'$project': {'_id': 0, 'username': 1}}],
+            'as': 'user',
+        }},
+        {'$project': {
+            '_id': 0,
+            'user_id': '$_id',
+            'username': {'$first': '$user.username'},
+            'cost': 1,
+            'requests': 1,
+        }},
+    ]
+    return list(get_collection('usage_events').aggregate(pipeline))
+
+
+def session_stats(days: int = 30, percentiles: bool = True) -> dict:
+    '''
+    Totals and percentiles of the saved sessions, overall, per model and per day.
+
+    Percentiles use the $percentile accumulator (MongoDB 7.0+). Older servers reject the pipeline
+    with an OperationFailure, use percentiles=False there.
+
+    Args:
+        days (int): How many days back to look
+        percentiles (bool): Include the expense and requests percentiles in the totals
+    Returns:
+        dict: 'totals', 'per_model' and 'per_day' results
+    '''
+    since = (datetime.now() - timedelta(days=days)).isoformat()
+    summary = {
+        'sessions': {'$sum': 1},
+        'expense': {'$sum': '$session.expense'},
+        'requests': {'$sum': '$session.num_of_requests'},
+    }
+    totals = dict(summary, _id=None)
+    if percentiles:
+        totals['expense_percentiles'] = {'$percentile': {'input': '$session.expense', 'p': PERCENTILES, 'method': 'approximate'}}
+        totals['requests_percentiles'] = {'$percentile': {'input': '$session.num_of_requests', 'p': PERCENTILES, 'method': 'approximate'}}
+
+    pipeline = [
+        # Session details are stored on the first bucket of each conversation. Uses the (bucket, session.start_time) index
+        {'$match': {'bucket': 0, 'session.start_time': {'$gte': since}}},
+        {'$project': {'_id': 0, 'session': 1}},
+        {'$facet': {
+            'totals': [
+                {'$group': totals},
+                {'$project': {'_id': 0}},
+            ],
+            'per_model': [
+                {'$group': dict(summary, _id={'$ifNull': ['$session.model', 'unknown']})},
+                {'$sort': {'expense': -1}},
+                {'$project': {'_id': 0, 'model': '$_id', 'sessions': 1, 'expense': 1, 'requests': 1}},
+            ],
+            'per_day': [
+                # start_time is an ISO string, the first 10 characters are the date
+                {'$group': dict(summary, _id={'$substrBytes': ['$session.start_time', 0, 10]})},
+                {'$sort': {'_id': -1}},
+                {'$project': {'_id': 0, 'day': '$_id', 'sessions': 1, 'expense': 1, 'requests': 1}},
+            ],
+        }},
+    ]
+
+    result = next(get_collection('conversations').aggregate(pipeline), {})
+    return {
+        'totals': (result.get('totals') or [{}])[0],
+        'per_model': result.get('per_model', []),
+        'per_day': result.get('per_day', []),
+    }
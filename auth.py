@@ -0,0 +1,166 @@
+# This file contains password hashing and session tokens for the chat application.
+
+import asyncio
+import base64
+import hashlib
+import hmac
+import math
+import os
+import threading
+import time
+
+import bcrypt
+
+from concurrent.futures import ThreadPoolExecutor
+
+# Using config.py to load environment variables, production
+import config
+
+
+BCRYPT_WORKERS = getattr(config, 'BCRYPT_WORKERS', 4)             # Maximum number of concurrent hashes
+BCRYPT_TARGET_MS = getattr(config, 'BCRYPT_TARGET_MS', 250)       # Target time for a single hash
+BCRYPT_MIN_ROUNDS = 10
+BCRYPT_MAX_ROUNDS = 16
+SESSION_TTL = getattr(config, 'SESSION_TTL', 60 * 60)             # Seconds a session token stays valid
+
+# Tokens signed with a per-process secret stop working on restart. Set SESSION_SECRET to share them
+SESSION_SECRET = getattr(config, 'SESSION_SECRET', None) or os.urandom(32)
+if isinstance(SESSION_SECRET, str):
+    SESSION_SECRET = SESSION_SECRET.encode('utf-8')
+
+# bcrypt holds the calling thread for the whole hash. Running it in a bounded pool keeps logins
+# from stalling everything else, and caps how much CPU concurrent logins can take
+_executor = ThreadPoolExecutor(max_workers=BCRYPT_WORKERS, thread_name_prefix='bcrypt')
+
+_rounds = None
+_rounds_lock = threading.Lock()
+
+
+def calibrate(target_ms: float = BCRYPT_TARGET_MS) -> int:
+    '''
+    Benchmark bcrypt and pick the highest cost factor that hashes within the target time.
+
+    Each extra round doubles the time, so a single hash at the minimum cost is enough to estimate it.
+
+    Args:
+        target_ms (float): The target time for a single hash, in milliseconds
+    Returns:
+        int: The cost factor
+    '''
+    start_time = time.perf_counter()
+    bcrypt.hashpw(b'benchmark', bcrypt.gensalt(rounds=BCRYPT_MIN_ROUNDS))
+    elapsed_ms = (time.perf_counter() - start_time) * 1000
+
+    extra_rounds = math.floor(math.log2(target_ms / elapsed_ms)) if elapsed_ms > 0 else 0
+    return max(BCRYPT_MIN_ROUNDS, min(BCRYPT_MAX_ROUNDS, BCRYPT_MIN_ROUNDS + extra_rounds))
+
+
+def get_rounds() -> int:
+    '''
+    Get the bcrypt cost factor, benchmarking it on first use.
+    '''
+    global _rounds
+
+    if _rounds is None:
+        with _rounds_lock:
+            if _rounds is None:
+                _rounds = calibrate()
+    return _rounds
+
+
+def hashed_rounds(hashed_password: bytes) -> int:
+    '''
+    Get the cost factor a password was hashed with, from the $2b$<rounds>$ prefix.
+    '''
+    return int(hashed_password[4:6])
+
+
+def _hash(password: str) -> bytes:
+    return bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt(rounds=get_rounds()))
+
+
+def _check(password: str, hashed_password: bytes) -> bool:
+    return bcrypt.checkpw(password.encode('utf-8'), hashed_password)
+
+
+def hash_password(password: str) -> bytes:
+    '''
+    Hash a password in the bcrypt worker pool.
+
+    Args:
+        password (str): The password to hash
+    Returns:
+        bytes: The hashed password
+    '''
+    return _executor.submit(_hash, password).result()
+
+
+def check_password(password: str, hashed_password: bytes) -> bool:
+    '''
+    Check a password against its hash in the bcrypt worker pool.
+
+    Args:
+        password (str): The password to check
+        hashed_password (bytes): The stored hash
+    Returns:
+        bool: True if the password matches, False otherwise
+    '''
+    return _executor.submit(_check, password, hashed_password).result()
+
+
+async def ahash_password(password: str) -> bytes:
+    '''
+    Async version of hash_password(). Does not block the event loop.
+    '''
+    return await asyncio.get_running_loop().run_in_executor(_executor, _hash, password)
+
+
+async def acheck_password(password: str, hashed_password: bytes) -> bool:
+    '''
+    Async version of check_password(). Does not block the event loop.
+    '''
+    return await asyncio.get_running_loop().run_in_executor(_executor, _check, password, hashed_password)
+
+
+def _sign(payload: bytes) -> str:
+    signature = hmac.new(SESSION_SECRET, payload, hashlib.sha256).digest()
+    return base64.urlsafe_b64encode(signature).decode('ascii').rstrip('=')
+
+
+def issue_token(user_id: str, ttl: int = SESSION_TTL) -> str:
+    '''
+    Issue a signed session token, so the user can authenticate again without bcrypt.
+
+    Args:
+        user_id (str): The authenticated user's id
+        ttl (int): Seconds until the token expires
+    Returns:
+        str: The token
+    '''
+    payload = f"{user_id}:{int(time.time()) + ttl}".encode('utf-8')
+    encoded = base64.urlsafe_b64encode(payload).decode('ascii').rstrip('=')
+    return f"{encoded}.{_sign(payload)}"
+
+
+def verify_token(token: str):
+    '''
+    Verify a session token.
+
+    Args:
+        token (str): The token
+    Returns:
+        str: The user id, or None if the token is invalid or expired
+    '''
+    try:
+        encoded, signature = token.split('.')
+        payload = base64.urlsafe_b64decode(encoded + '=' * (-len(encoded) % 4))
+        user_id, expires = payload.decode('utf-8').rsplit(':', 1)
+    except (ValueError, UnicodeDecodeError):
+        return None
+
+    if not hmac.compare_digest(signature, _sign(payload)):
+        return None
+    if int(expires) < time.time():
+        return None
+
+    return user_id
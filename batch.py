@@ -0,0 +1,223 @@
+# This file contains the bulk prompt runner used for offline evaluation jobs.
+
+import asyncio
+import json
+import os
+
+from chat_engine import achat, areserve, arelease, asettle, estimate_max_cost, response_cost, usage_details
+from chat_settings import ChatSettings
+from conversation import Conversation
+from exceptions import ChatError
+
+
+# Prompt settings that a record may override
+RECORD_SETTINGS = ['model', 'max_tokens', 'temperature', 'top_p', 'frequency_penalty', 'presence_penalty']
+
+
+def read_requests(input_path: str):
+    '''
+    Stream the lines of a JSONL file, one at a time. Lines are parsed by run_record(), so an invalid
+    line only fails its own record.
+
+    Yields:
+        tuple: The line number and the line
+    '''
+    with open(input_path) as f:
+        for line_number, line in enumerate(f, start=1):
+            line = line.strip()
+            if line:
+                yield line_number, line
+
+
+def parse_record(line: str) -> dict:
+    '''
+    Parse and check a record.
+
+    Each record has either a "prompt" string, or a "messages" list of role/content dicts ending with
+    the user message. Records may also override any of the prompt settings (model, max_tokens, ...).
+
+    Raises:
+        ValueError: If the line is not a valid record
+    '''
+    try:
+        record = json.loads(line)
+    except json.JSONDecodeError as e:
+        raise ValueError(f"Error: Invalid JSON ({e}).")
+
+    if not isinstance(record, dict):
+        raise ValueError("Error: Record must be a JSON object.")
+
+    if 'messages' in record:
+        messages = record['messages']
+        if not isinstance(messages, list) or not all(
+            isinstance(m, dict) and isinstance(m.get('role'), str) and isinstance(m.get('content'), str)
+            for m in messages
+        ):
+            raise ValueError("Error: Messages must be a list of objects with a role and content string.")
+    elif 'prompt' in record:
+        if not isinstance(record['prompt'], str):
+            raise ValueError("Error: Prompt must be a string.")
+    else:
+        raise ValueError("Error: Record has no prompt or messages.")
+
+    return record
+
+
+def completed_lines(output_path: str) -> set:
+    '''
+    Get the line numbers that already have a result in the output file, so a crashed run can resume.
+    '''
+    done = set()
+
+    if not os.path.exists(output_path):
+        return done
+
+    with open(output_path) as f:
+        for line in f:
+            try:
+                result = json.loads(line)
+            except json.JSONDecodeError:
+                # The last line may be incomplete if the run crashed while writing it
+                continue
+            if result.get('status') == 'ok':
+                done.add(result['line'])
+
+    return done
+
+
+def split_record(record: dict):
+    '''
+    Split a record into the conversation history and the prompt to send.
+    '''
+    if 'messages' in record:
+        messages = list(record['messages'])
+        if not messages or messages[-1]['role'] != 'user':
+            raise ValueError("Error: The last message must be a user message.")
+        return Conversation(messages[:-1]), messages[-1]['content']
+
+    if 'prompt' in record:
+        return Conversation(), record['prompt']
+
+    raise ValueError("Error: Record has no prompt or messages.")
+
+
+async def run_record(user, line_number: int, line: str, settings: ChatSettings) -> dict:
+    '''
+    Run a single record and return its result. Never raises, every record gets a result.
+    '''
+    result = {'line': line_number, 'id': None, 'model': settings.model}
+    try:
+        return await _run_record(user, line, settings, result)
+    except Exception as e:
+        result.update({'status': 'error', 'error': f"Error: {e!r}"})
+        return result
+
+
+async def _run_record(user, line: str, settings: ChatSettings, result: dict) -> dict:
+    try:
+        record = parse_record(line)
+        result['id'] = record.get('id')
+        result['model'] = record.get('model', settings.model)
+
+        # Validated once per record, like a session's settings
+        record_settings = settings.replace(**{key: record[key] for key in RECORD_SETTINGS if key in record})
+        conversation, prompt = split_record(record)
+    except (ValueError, TypeError) as e:
+        result.update({'status': 'error', 'error': str(e)})
+        return result
+
+    # Reserve the maximum cost up front, so concurrent records can't overdraw the balance
+    reserved = estimate_max_cost(record_settings, conversation, prompt)
+    if not await areserve(user, reserved):
+        result.update({'status': 'insufficient_funds'})
+        return result
+
+    try:
+        response = await achat(prompt, conversation, record_settings)
+    except Exception as e:
+        await arelease(user, reserved)
+        result.update({'status': 'error', 'error': e.message if isinstance(e, ChatError) else f"Error: {e!r}"})
+        return result
+
+    if response.get('cached'):
+        # Served from the response cache, nothing to pay for
+        cost = 0.0
+        await arelease(user, reserved)
+    else:
+        cost = response_cost(response)
+        await asettle(user, reserved, cost, usage_details(response))
+
+    result.update({
+        'status': 'ok',
+        'cached': bool(response.get('cached')),
+        'answer': response['choices'][0]['message']['content'],
+        'usage': dict(response['usage']),
+        'cost': cost,
+        'timing': response['timing'],
+    })
+    return result
+
+
+async def run_batch(user, input_path: str, output_path: str, settings: ChatSettings, concurrency: int = 8) -> dict:
+    '''
+    Run every record of a JSONL file concurrently, writing results to an output JSONL as they finish.
+
+    Records that already succeeded in the output file are skipped, so the same command resumes a
+    crashed run. Failed records are retried on the next run.
+
+    Args:
+        user (User): The user to charge
+        input_path (str): The JSONL file of requests
+        output_path (str): The JSONL file to append results to
+        settings (ChatSettings): The default prompt settings
+        concurrency (int): The maximum number of requests in flight
+    Returns:
+        dict: Counts of the records by status
+    '''
+    done = completed_lines(output_path)
+    summary = {'skipped': len(done), 'ok': 0, 'error': 0, 'insufficient_funds': 0, 'expense': 0.0}
+
+    # Streaming responses only adds overhead when nobody is watching
+    settings = settings.replace(stream=False)
+
+    # Start on a fresh line if the last run crashed while writing a result
+    if os.path.exists(output_path) and os.path.getsize(output_path) > 0:
+        with open(output_path, 'rb') as f:
+            f.seek(-1, os.SEEK_END)
+            needs_newline = f.read(1) != b'\n'
+        if needs_newline:
+            with open(output_path, 'a') as f:
+                f.write('\n')
+
+    pending = set()
+
+    with open(output_path, 'a') as output:
+        def write_result(task):
+            result = task.result()
+            output.write(json.dumps(result) + '\n')
+            output.flush()
+            summary[result['status']] += 1
+            summary['expense'] += result.get('cost', 0.0)
+
+        try:
+            for line_number, line in read_requests(input_path):
+                if line_number in done:
+                    continue
+
+                # Only read the next record once there is room for it
+                if len(pending) >= concurrency:
+                    finished, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                    for task in finished:
+                        write_result(task)
+
+                pending.add(asyncio.create_task(run_record(user, line_number, line, settings)))
+        finally:
+            # Records already dispatched may have been charged, so their results are written even if
+            # reading the input failed
+            while pending:
+                finished, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in finished:
+                    write_result(task)
+
+    summary['expense'] = round(summary['expense'], 8)
+    return summary
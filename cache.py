@@ -0,0 +1,255 @@
+# This file contains the response cache used to skip repeated deterministic requests.
+
+import asyncio
+import copy
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+
+from collections import OrderedDict
+
+from conversation import Message
+
+# Using config.py to load environment variables, production
+import config
+
+
+CACHE_PATH = getattr(config, 'CACHE_PATH', 'response_cache.sqlite3')
+CACHE_MEMORY_ENTRIES = getattr(config, 'CACHE_MEMORY_ENTRIES', 256)
+CACHE_DISK_BYTES = getattr(config, 'CACHE_DISK_BYTES', 100 * 1024 * 1024)
+CACHE_TTL = getattr(config, 'CACHE_TTL', 7 * 24 * 60 * 60)
+
+# Request fields that decide the response. Anything else (e.g. stream) does not change the answer
+KEY_FIELDS = ['model', 'temperature', 'top_p', 'max_tokens', 'frequency_penalty', 'presence_penalty']
+
+
+def is_full_path(messages: list) -> bool:
+    '''
+    Check if the messages are a whole conversation branch, from its first message, and not trimmed.
+    '''
+    if not messages or not all(isinstance(m, Message) for m in messages):
+        return False
+    return messages[0].parent is None and all(m.parent is p for p, m in zip(messages, messages[1:]))
+
+
+def request_key(request: dict) -> str:
+    '''
+    Build a canonical hash of a request.
+
+    Args:
+        request (dict): The request, including the messages
+    Returns:
+        str: The hex digest identifying the request
+    '''
+    canonical = {field: request.get(field) for field in KEY_FIELDS}
+    messages = request['messages']
+    if is_full_path(messages):
+        # The last message's digest already identifies the whole history, and is the same in every
+        # branch that shares it, so the messages don't need to be hashed again
+        canonical['prefix'] = messages[-1].digest.hex()
+    else:
+        canonical['messages'] = [[m['role'], m['content']] for m in messages]
+    encoded = json.dumps(canonical, sort_keys=True, separators=(',', ':'), ensure_ascii=False)
+    return hashlib.sha256(encoded.encode('utf-8')).hexdigest()
+
+
+def deterministic_only(request: dict) -> bool:
+    '''
+    Default cache policy: only cache requests that should always give the same answer.
+    '''
+    return request.get('temperature') == 0
+
+
+class ResponseCache:
+    '''
+    Two-tier response cache: a bounded in-memory LRU in front of a SQLite file.
+
+    Entries expire after ttl seconds. When the file grows beyond max_bytes, the least recently used
+    entries are evicted. The async methods run the SQLite tier in a worker thread, so the event loop
+    only ever waits for the memory tier.
+    '''
+    def __init__(self, path=CACHE_PATH, memory_entries=CACHE_MEMORY_ENTRIES, max_bytes=CACHE_DISK_BYTES,
+                 ttl=CACHE_TTL, policy=deterministic_only):
+        self.path = path
+        self.memory_entries = memory_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.policy = policy
+        self.hits = 0
+        self.misses = 0
+        self.memory_hits = 0
+        self._memory = OrderedDict()    # key -> (created, response)
+        self._lock = threading.Lock()   # Guards the memory tier and the counters
+        self._db_lock = threading.Lock()
+        self._db = None
+        self._bytes = 0                 # Total size of the stored responses, kept instead of summed on every put
+        self._accessed = {}             # key -> last access time, written with the next put
+
+    def _connect(self):
+        # Opened on first use so the file is only created when caching is actually used
+        if self._db is None:
+            self._db = sqlite3.connect(self.path, check_same_thread=False)
+            self._db.execute('PRAGMA journal_mode=WAL')
+            self._db.execute(
+                'CREATE TABLE IF NOT EXISTS responses ('
+                'key TEXT PRIMARY KEY, response TEXT NOT NULL, size INTEGER NOT NULL, '
+                'created REAL NOT NULL, accessed REAL NOT NULL)'
+            )
+            self._db.execute('CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed)')
+            self._db.execute('CREATE INDEX IF NOT EXISTS responses_created ON responses (created)')
+            self._bytes = self._db.execute('SELECT COALESCE(SUM(size), 0) FROM responses').fetchone()[0]
+        return self._db
+
+    def _remember(self, key, created, response):
+        self._memory[key] = (created, response)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.memory_entries:
+            self._memory.popitem(last=False)
+
+    def _get_memory(self, key, now):
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None and now - entry[0] <= self.ttl:
+                self._memory.move_to_end(key)
+                self.hits += 1
+                self.memory_hits += 1
+                return self._hit(entry[1])
+        return None
+
+    def _get_disk(self, key, now):
+        with self._db_lock:
+            row = self._connect().execute('SELECT response, created FROM responses WHERE key = ?', (key,)).fetchone()
+            if row is not None and now - row[1] <= self.ttl:
+                # Written with the next put, so a hit doesn't commit
+                self._accessed[key] = now
+
+        with self._lock:
+            if row is None or now - row[1] > self.ttl:
+                self.misses += 1
+                return None
+            response = json.loads(row[0])
+            self._remember(key, row[1], response)
+            self.hits += 1
+            return self._hit(response)
+
+    def get(self, request: dict):
+        '''
+        Look up the response for a request.
+
+        Returns:
+            dict: A copy of the cached response, marked with 'cached': True, or None on a miss
+        '''
+        if not self.policy(request):
+            return None
+
+        key = request_key(request)
+        now = time.time()
+        return self._get_memory(key, now) or self._get_disk(key, now)
+
+    async def aget(self, request: dict):
+        '''
+        Async version of get(). The SQLite lookup runs in a worker thread.
+        '''
+        if not self.policy(request):
+            return None
+
+        key = request_key(request)
+        now = time.time()
+        return self._get_memory(key, now) or await asyncio.to_thread(self._get_disk, key, now)
+
+    def _hit(self, response):
+        response = copy.deepcopy(response)
+        response['cached'] = True
+        response['timing'] = {'time_to_first_token': 0.0, 'total_time': 0.0, 'tokens_per_second': None}
+        return response
+
+    def _prepare(self, request: dict, response):
+        '''
+        Store the response in the memory tier. Returns the key and the encoded response for the SQLite tier.
+        '''
+        key = request_key(request)
+        stored = {
+            'object': response['object'],
+            'model': response['model'],
+            'choices': [{
+                'index': 0,
+                'message': {
+                    'role': response['choices'][0]['message']['role'],
+                    'content': response['choices'][0]['message']['content'],
+                },
+                'finish_reason': response['choices'][0].get('finish_reason'),
+            }],
+            'usage': dict(response['usage']),
+        }
+        with self._lock:
+            self._remember(key, time.time(), stored)
+        return key, json.dumps(stored)
+
+    def _put_disk(self, key, encoded):
+        now = time.time()
+        with self._db_lock:
+            db = self._connect()
+            old = db.execute('SELECT size FROM responses WHERE key = ?', (key,)).fetchone()
+            db.execute(
+                'INSERT OR REPLACE INTO responses (key, response, size, created, accessed) VALUES (?, ?, ?, ?, ?)',
+                (key, encoded, len(encoded), now, now)
+            )
+            self._bytes += len(encoded) - (old[0] if old else 0)
+
+            accessed, self._accessed = self._accessed, {}
+            db.executemany('UPDATE responses SET accessed = ? WHERE key = ?', [(t, k) for k, t in accessed.items()])
+
+            self._evict(db, now)
+            db.commit()
+
+    def put(self, request: dict, response):
+        '''
+        Store the response for a request, if the policy allows it.
+        '''
+        if self.policy(request):
+            self._put_disk(*self._prepare(request, response))
+
+    async def aput(self, request: dict, response):
+        '''
+        Async version of put(). The SQLite write runs in a worker thread.
+        '''
+        if self.policy(request):
+            await asyncio.to_thread(self._put_disk, *self._prepare(request, response))
+
+    def _evict(self, db, now):
+        expired = db.execute('DELETE FROM responses WHERE created < ? RETURNING size', (now - self.ttl,)).fetchall()
+        self._bytes -= sum(size for size, in expired)
+        if self._bytes <= self.max_bytes:
+            return
+
+        # Drop the least recently used entries until the cache fits again
+        evicted = []
+        for key, size in db.execute('SELECT key, size FROM responses ORDER BY accessed'):
+            if self._bytes <= self.max_bytes:
+                break
+            evicted.append((key,))
+            self._bytes -= size
+        db.executemany('DELETE FROM responses WHERE key = ?', evicted)
+
+        with self._lock:
+            for key, in evicted:
+                self._memory.pop(key, None)
+
+    def stats(self) -> dict:
+        '''
+        Return the hit/miss counts.
+        '''
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'memory_hits': self.memory_hits,
+            'disk_hits': self.hits - self.memory_hits,
+            'misses': self.misses,
+            'hit_rate': round(self.hits / lookups, 3) if lookups else None,
+        }
+
+
+# Shared cache for the application
+response_cache = ResponseCache()
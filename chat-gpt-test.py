@@ -1,4 +1,7 @@
 import openai
+import argparse
+import asyncio
+import csv
 import json
 import stdiomask
 import uuid
@@ -6,10 +9,23 @@ import json
 import os
 import time
 
-from exceptions import ChatError, ModelNotFound # Custom exceptions for rhe chat application
+from exceptions import ChatError, CircuitOpen # Custom exceptions for rhe chat application
 from datetime import datetime
-from users import User
-from pymongo import MongoClient
+from model_registry import registry
+from chat_settings import ChatSettings
+from conversation import Conversation, api_messages
+from chat_engine import StreamAccumulator, add_timing, estimate_max_cost, usage_details
+from batch import run_batch
+from cache import response_cache
+from context import ContextWindow
+from rate_limit import get_limiter, estimate_request_tokens
+from retry import call_with_retry, is_transient
+from users import User, ensure_indexes
+import analytics
+import conversations
+from storage import get_backend, MongoBackend
+from persistence import persistence
+from pymongo.errors import OperationFailure, PyMongoError
 
 # Using dotenv to load environment variables, development only
 # from dotenv import load_dotenv
@@ -17,17 +33,10 @@ from pymongo import MongoClient
 
 
 # Using config.py to load environment variables, production
-from config import ATLAS_URI, API_KEY
+from config import API_KEY
 
 
-# Connect to the database
-# atlas_url = os.getenv('ATLAS_URI')    #! Development only, use config.py for production
-# --- OR ---
-atlas_url = ATLAS_URI
-client = MongoClient(atlas_url)
-db = client['openai-app']
-users_collection = db['users']
-
+# The storage backend (MongoDB or SQLite, see STORAGE_BACKEND) is created lazily by storage.py on first use, and shared with users.py
 
 
 # Set the OpenAI API key
@@ -35,18 +44,6 @@ users_collection = db['users']
 openai.api_key = API_KEY
 
 
-DEFAULT_SETTINGS = {
-    'model': 'gpt-3.5-turbo',
-    'max_tokens': 1000,
-    'temperature': 1.2,
-    'top_p': 1,
-    'frequency_penalty': 0.5,
-    'presence_penalty': 0.5,
-}
-
-settings = DEFAULT_SETTINGS.copy()
-
-
 def login_prompt():
     print("Would you like to login, or continue as a guest?")
     print("1. Login")
@@ -122,16 +119,11 @@ def get_model_list(display: bool = False):
     # models = openai.Model.list()
     # models = models['data']
 
-    # Trimmed down list of models:
-    with open('models.json') as f:
-        models_json = json.load(f)
-
-    models = models_json["models"]
-
+    # Trimmed down list of models, loaded once from models.json by the model registry:
     if display:
-        model_list = [model['display'] for model in models]
+        model_list = registry.display_names()
     else:
-        model_list = [model['id'] for model in models]
+        model_list = registry.ids()
 
     return model_list
 
@@ -145,23 +137,110 @@ def print_model_list(model_list):
 def list_admin_options():
     print("\nAdmin Options:")
     print("help -> View this help menu")
-    print("users -> View all users")
+    print("users -> View all users. Options: role=<role> min_balance=<amount> max_balance=<amount> page=<n> limit=<n>")
     print("roles -> Set user roles")
+    print("setrole <role> <filters|all> -> Set the role of many users. Filters: role=<role> min_balance=<amount> max_balance=<amount>")
+    print("credit <amount> <filters|all> -> Add funds to many users")
+    print("bulk <file> -> Set roles/add funds from a CSV (username,role,credit) or JSONL file")
+    print("stats -> View usage statistics. Options: days=<n> limit=<n>")
+    print("migrate -> Move conversations stored in user documents (the old format) to the conversations collection")
     print("prompts -> Customize prompt parameters")
     print("chat -> Proceed to chat with the AI. Ends the admin session.\n")
 
-def get_user_list():
-    users = users_collection.find()
-    user_list = [user for user in users]
-    return user_list
+# Options accepted by the admin "users" command, and how to parse them
+USER_FILTER_OPTIONS = {
+    'role': str,
+    'min_balance': float,
+    'max_balance': float,
+}
+
+USER_LIST_OPTIONS = dict(USER_FILTER_OPTIONS, page=int, limit=int)
+
+def parse_options(args: list, accepted: dict) -> dict:
+    '''
+    Parse the key=value options of an admin command.
+
+    Args:
+        args (list): The command arguments
+        accepted (dict): The accepted options, and the type of their values
+    Raises:
+        ValueError: If an option is unknown or has an invalid value
+    '''
+    options = {}
+    for arg in args:
+        key, _, value = arg.partition('=')
+        if key not in accepted or not value:
+            raise ValueError(f"Error: Invalid option ({arg}).")
+        options[key] = accepted[key](value)
+    return options
+
+def get_user_list(**options):
+    # Streams users from the database instead of loading them all, see User.iter_users()
+    return User.iter_users(**options)
 
 def print_user_list(user_list):
     print("\nUsers:")
+    count = 0
     for user in user_list:
-        print(user.__str__())
+        print(f"User: {user['username']} {user['email']} {user['user_id']} role={user['role']} balance={float(user['balance']):.5f}")
+        count += 1
+    print(f"{count} users\n")
+
+
+# Options accepted by the admin "stats" command
+STATS_OPTIONS = {
+    'days': int,
+    'limit': int,
+}
+
+def print_usage_stats(days: int = 30, limit: int = 10):
+    '''
+    Print usage statistics. Everything is aggregated on the database server.
+    '''
+    if not isinstance(get_backend(), MongoBackend):
+        print("Error: Usage statistics need the MongoDB storage backend.")
+        return
+
+    try:
+        spend = analytics.spend_per_model_per_day(days)
+        users = analytics.top_users(limit, days)
+        try:
+            stats = analytics.session_stats(days)
+        except OperationFailure:
+            # $percentile needs MongoDB 7.0+, show the totals without it
+            stats = analytics.session_stats(days, percentiles=False)
+    except PyMongoError as e:
+        print(f"Error: Could not load usage statistics ({e}).")
+        return
+
+    print(f"\nUsage over the last {days} days")
+
+    print("\nSpend per model per day:")
+    for row in spend:
+        print(f" {row['day']} {row['model']}: ${row['cost']:.5f} ({row['requests']} requests, {row['tokens']} tokens)")
+
+    print(f"\nTop {limit} users:")
+    for row in users:
+        print(f" {row.get('username') or row['user_id']}: ${row['cost']:.5f} ({row['requests']} requests)")
+
+    totals = stats['totals']
+    print("\nSaved sessions:")
+    if totals:
+        print(f" Sessions: {totals['sessions']}, requests: {totals['requests']}, expense: ${totals['expense']:.5f}")
+        if 'expense_percentiles' in totals:
+            percentiles = ', '.join(f"p{int(p * 100)}" for p in analytics.PERCENTILES)
+            print(f" Expense per session ({percentiles}): {', '.join(f'${value:.5f}' for value in totals['expense_percentiles'])}")
+            print(f" Requests per session ({percentiles}): {', '.join(f'{value:g}' for value in totals['requests_percentiles'])}")
+    for row in stats['per_model']:
+        print(f" {row['model']}: {row['sessions']} sessions, {row['requests']} requests, ${row['expense']:.5f}")
+    for row in stats['per_day']:
+        print(f" {row['day']}: {row['sessions']} sessions, {row['requests']} requests, ${row['expense']:.5f}")
     print()
 
 
+# Roles an admin can assign
+ASSIGNABLE_ROLES = ['user', 'admin']
+
 def set_user_role():
     print("Enter the username of the user you would like to modify:")
     username = input("Username: ")
@@ -169,20 +248,82 @@ def set_user_role():
     user = User.get_user_by_username(username)
 
     if user:
-        print(f"User found: {user}")
+        print(f"User found: {user['username']} {user['email']} role={user['role']}")
         print("Enter the new role for this user:")
         role = input("Role: ")
 
-        while role not in ['user', 'admin']:
+        while role not in ASSIGNABLE_ROLES:
             print("Error: Invalid role. Please try again.")
             role = input("Role: ")
 
-        user.role = role
-        user.save2db()
+        # Update the existing user, instead of inserting a copy
+        User.bulk_update([(username, role, None)])
         print("Role updated successfully!")
     else:
         print("Error: User not found.")
 
+def read_user_changes(path: str):
+    '''
+    Read bulk user changes from a CSV (username,role,credit header) or JSONL file.
+
+    Yields:
+        tuple: (username, role, credit). role and credit are None when not given
+    Raises:
+        ValueError: If a row is invalid
+    '''
+    with open(path, newline='') as f:
+        if path.endswith('.jsonl'):
+            rows = (json.loads(line) for line in f if line.strip())
+        else:
+            rows = csv.DictReader(f)
+
+        for row in rows:
+            username = row.get('username')
+            role = row.get('role') or None
+            credit = row.get('credit') or None
+
+            if not username:
+                raise ValueError(f"Error: Missing username ({row}).")
+            if role and role not in ASSIGNABLE_ROLES:
+                raise ValueError(f"Error: Invalid role for {username} ({role}).")
+
+            yield username, role, float(credit) if credit else None
+
+def bulk_user_changes(command: str, args: list):
+    '''
+    Handle the admin bulk commands:
+        setrole <role> <filters|all> -> Set the role of every matching user
+        credit <amount> <filters|all> -> Add to the balance of every matching user
+        bulk <file> -> Apply the roles/credits listed in a CSV or JSONL file
+    '''
+    if not args:
+        print(f"Error: Missing argument for {command}.")
+        return
+
+    try:
+        if command == 'bulk':
+            matched, modified = User.bulk_update(read_user_changes(args[0]))
+        else:
+            # Require an explicit "all" to change every user
+            filters = [arg for arg in args[1:] if arg != 'all']
+            if not filters and 'all' not in args[1:]:
+                print("Error: Add filters (role=, min_balance=, max_balance=) or 'all' to change every user.")
+                return
+            filters = parse_options(filters, USER_FILTER_OPTIONS)
+
+            if command == 'setrole':
+                if args[0] not in ASSIGNABLE_ROLES:
+                    print("Error: Invalid role. Please try again.")
+                    return
+                matched, modified = User.update_matching(filters, role=args[0])
+            else:
+                matched, modified = User.update_matching(filters, credit=float(args[0]))
+    except (ValueError, OSError) as e:
+        print(e)
+        return
+
+    print(f"Matched {matched} users, modified {modified}.")
+
 def list_prompt_options():
     print("\nPrompt Options:")
     print("temperature -> Set the temperature")
@@ -190,6 +331,7 @@ def list_prompt_options():
     print("top_p -> Set the top p value")
     print("frequency_penalty -> Set the frequency penalty")
     print("presence_penalty -> Set the presence penalty")
+    print("stream -> Show the response as it is generated (on/off)")
     print()
 
 
@@ -258,7 +400,24 @@ def set_presence_penalty():
     print("Presence penalty updated successfully!")
     return customPresencePenalty
 
-def set_prompt_parameters():
+def set_stream():
+    print("Show the response as it is generated? (on/off)")
+    stream = input("Stream: ").lower()
+
+    while stream not in ['on', 'off']:
+        print("Error: Enter on or off. Please try again.")
+        stream = input("Stream: ").lower()
+
+    print("Streaming updated successfully!")
+    return stream == 'on'
+
+def set_prompt_parameters(settings: ChatSettings) -> ChatSettings:
+    '''
+    Ask for new prompt parameters.
+
+    Returns:
+        ChatSettings: The new settings. The settings passed in are not changed
+    '''
 
     updating = True
 
@@ -270,35 +429,46 @@ def set_prompt_parameters():
         elif parameter == '-done':
             break
         else:
-            while parameter not in ['temperature', 'max_tokens', 'top_p', 'frequency_penalty', 'presence_penalty']:
+            while parameter not in ['temperature', 'max_tokens', 'top_p', 'frequency_penalty', 'presence_penalty', 'stream']:
                 print("Error: Invalid parameter. Please try again.")
                 parameter = input("Parameter: ")
 
             if parameter == 'temperature':
-                temp = set_temperature()
-                settings['temperature'] = temp
+                changes = {'temperature': set_temperature()}
             elif parameter == 'max_tokens':
-                max_t = set_max_tokens()
-                settings['max_tokens'] = max_t
+                changes = {'max_tokens': set_max_tokens()}
             elif parameter == 'top_p':
-                top_p = set_top_p()
-                settings['top_p'] = top_p
+                changes = {'top_p': set_top_p()}
             elif parameter == 'frequency_penalty':
-                fp = set_frequency_penalty()
-                settings['frequency_penalty'] = fp
+                changes = {'frequency_penalty': set_frequency_penalty()}
             elif parameter == 'presence_penalty':
-                pp = set_presence_penalty()
-                settings['presence_penalty'] = pp
+                changes = {'presence_penalty': set_presence_penalty()}
+            elif parameter == 'stream':
+                changes = {'stream': set_stream()}
+
+            try:
+                settings = settings.replace(**changes)
+            except ValueError as e:
+                print(e)
     
     print("Proceeding with the following parameters:")
-    print(f"Max Tokens: {settings['max_tokens']}")
-    print(f"Temperature: {settings['temperature']}")
-    print(f"Top P: {settings['top_p']}")
-    print(f"Frequency Penalty: {settings['frequency_penalty']}")
-    print(f"Presence Penalty: {settings['presence_penalty']}")
+    print(f"Max Tokens: {settings.max_tokens}")
+    print(f"Temperature: {settings.temperature}")
+    print(f"Top P: {settings.top_p}")
+    print(f"Frequency Penalty: {settings.frequency_penalty}")
+    print(f"Presence Penalty: {settings.presence_penalty}")
+    print(f"Stream: {'on' if settings.stream else 'off'}")
+
+    return settings
+
 
+def handle_admin(user: User, settings: ChatSettings) -> ChatSettings:
+    '''
+    Run an admin session before the chat.
 
-def handle_admin(user: User):
+    Returns:
+        ChatSettings: The settings to chat with, changed by the "prompts" command
+    '''
     print("Admin privileges enabled. Would you like to begin an admin session? (y/n)")
     admin_session = input("Admin: ")
     print()
@@ -311,7 +481,7 @@ def handle_admin(user: User):
     if admin_session == 'n':
         print("Proceeding to chatbot.\n")
         # End the function
-        return
+        return settings
         
     elif admin_session == 'y':
         print("Admin session initiated.")
@@ -322,13 +492,30 @@ def handle_admin(user: User):
     admin = True
     while admin:
         admin_input = input(f'{user.username} > ')
-        if admin_input == 'users':
-            user_list = get_user_list()
+        if admin_input.split(' ')[0] == 'users':
+            try:
+                options = parse_options(admin_input.split()[1:], USER_LIST_OPTIONS)
+            except ValueError as e:
+                print(e)
+                continue
+            user_list = get_user_list(**options)
             print_user_list(user_list)
+        elif admin_input.split(' ')[0] == 'stats':
+            try:
+                options = parse_options(admin_input.split()[1:], STATS_OPTIONS)
+            except ValueError as e:
+                print(e)
+                continue
+            print_usage_stats(**options)
+        elif admin_input == 'migrate':
+            migrate_conversations()
         elif admin_input == 'roles':
             set_user_role()
+        elif admin_input.split(' ')[0] in ['setrole', 'credit', 'bulk']:
+            command, *args = admin_input.split()
+            bulk_user_changes(command, args)
         elif admin_input == 'prompts':
-            set_prompt_parameters()
+            settings = set_prompt_parameters(settings)
         elif admin_input == 'help':
             list_admin_options()
         elif admin_input == 'chat':
@@ -336,24 +523,25 @@ def handle_admin(user: User):
         else:
             print("Error: Invalid command. Please try again.")
 
-#TODO: Add async functionality
-# async def call_openai_api(request):
-#     print("Sent request to API. Waiting for response...")
+    return settings
 
-#     # Start timer
-#     start_time = time.time()
-    
-#     # Make async request to API
-#     response = await openai.Completion.create(**request)
+def migrate_conversations():
+    '''
+    Move the conversations embedded in user documents to the conversations collection.
+    '''
+    if not isinstance(get_backend(), MongoBackend):
+        print("Nothing to migrate. Conversations were only stored in user documents on MongoDB.")
+        return
 
-#     # End timer
-#     end_time = time.time()
-#     total_time = end_time - start_time
-#     print(f"Received response in {total_time} seconds.\n")
+    try:
+        migrated = conversations.migrate_embedded_conversations()
+    except PyMongoError as e:
+        print(f"Error: Could not migrate the conversations ({e}).")
+        return
 
-#     return response
+    print(f"Migrated the conversations of {migrated} users.")
 
- 
+# Async functionality lives in chat_engine.py (call_openai_api, achat, aconverse_turn)
 
 
 def get_cost(response=None, model=None, num_of_tokens=None) -> float:
@@ -367,31 +555,10 @@ def get_cost(response=None, model=None, num_of_tokens=None) -> float:
     else:
         raise ValueError("Error: Invalid parameters. Please try again.")
 
-    # Get the model cost per token
-    with open('models.json') as f:
-        models_json = json.load(f)
-
-
+    # Get the model cost per token from the model registry.
+    # Unknown model ids (e.g. "gpt-3.5-turbo-0301") are resolved by model family.
     try:
-        if model not in [model['id'] for model in models_json["models"]]:
-            raise ModelNotFound(f"Error: Model ({model}) not found.")
-        
-        for m in models_json['models']:
-            if m['id'] == model:
-                # Calculate the cost of the response
-                cpt = m['cpt']
-                cost = round(total_tokens * cpt, 8)
-                return cost
-            
-    except ModelNotFound as e:
-        # Could not find the model
-        # Search for the model family...
-        for m in models_json['models']:
-            if m['family'] in model:
-                # Calculate the cost of the response
-                cpt = m['cpt']
-                cost = round(total_tokens * cpt, 8)
-                return cost
+        return registry.cost(model, total_tokens)
 
     except Exception as e:
         print(e)
@@ -399,9 +566,14 @@ def get_cost(response=None, model=None, num_of_tokens=None) -> float:
         exit()
 
 
-def check_balance(user: User) -> bool:
-    # Call get_cost() with keyword arguments
-    max_cost = get_cost(model=settings['model'], num_of_tokens=settings['max_tokens']) # Maximum possible cost of next response
+def check_balance(user: User, settings: ChatSettings, conversation: Conversation = None, prompt: str = None, context: ContextWindow = None) -> bool:
+    '''
+    Check that the user can afford the next request, before it is sent.
+
+    Returns:
+        bool: True if the user can afford the request, False otherwise
+    '''
+    max_cost = estimate_max_cost(settings, conversation, prompt, context) # Maximum possible cost of next response
     #TODO: Could adjust max_tokens for next request based on user balance
 
     if user.balance < max_cost:
@@ -411,29 +583,39 @@ def check_balance(user: User) -> bool:
     return True
 
 
-def select_model():
+def select_model(settings: ChatSettings) -> ChatSettings:
+    '''
+    Ask for the model to chat with.
+
+    Returns:
+        ChatSettings: The settings with the selected model
+    '''
     model_list = get_model_list(display=True) # Get the model list with the display name
     print_model_list(model_list)
     print()
 
     selected_model = input("Enter a model name: ").lower()
 
-    model_list = get_model_list() # Get the model list with the id
-
     if not selected_model:
         # Set default model
         selected_model = 'gpt-3.5-turbo'
         print('Using default model: gpt-3.5-turbo\n')
 
-    while selected_model not in model_list:
+    while selected_model not in registry:
         print('Error: Invalid model name. Please try again.')
         selected_model = input("Enter a model name: ").lower()
 
-    # Store the selected model in the settings dictionary
-    settings.update({'model': selected_model})
+    # Settings are immutable, the session continues with the returned copy
+    return settings.replace(model=selected_model)
 
 
-def converse(user: User, conversation: list, session: dict):
+def converse(user: User, conversation: Conversation, session: dict, settings: ChatSettings, context: ContextWindow = None):
+    '''
+    Run the conversation loop until the user ends it or runs out of funds.
+
+    Returns:
+        tuple: The session details, and the settings in use when the conversation ended
+    '''
     # --------------Start conversation--------------
     print("Beginning conversation...")
     print("-" * 50)
@@ -446,16 +628,20 @@ def converse(user: User, conversation: list, session: dict):
     # Run the loop until the user ends the conversation
     while True:
         # Check if the user has enough funds to continue the conversation
-        if not check_balance(user):
+        if not check_balance(user, settings, conversation, context=context):
             # End the conversation
             break
 
         # Get user input
         user_input = input(f'{user.username} > ').replace('\\n', '\n')
-        result = interpret_request(user, conversation, user_input)
+        result = interpret_request(user, conversation, user_input, settings)
 
         # Handle the result
-        if result == True:
+        if isinstance(result, ChatSettings):
+            # User changed the model or streaming. Later turns use the new settings
+            settings = result
+            continue
+        elif result == True:
             # User entered a command
             continue
         elif result == False:
@@ -465,39 +651,73 @@ def converse(user: User, conversation: list, session: dict):
             # User entered a prompt
             prompt = result
 
-            try:
-                response = chat(prompt, conversation)
-            except ChatError:
-                # Ask the user if they would like to try again
-                while True:
+            # Reserve the maximum cost now that the prompt is known. The balance check and deduction are
+            # one atomic update, so concurrent sessions can't overdraw and unaffordable requests are never sent
+            reserved = estimate_max_cost(settings, conversation, prompt, context)
+            if not user.reserve(reserved):
+                print("Error: Insufficient funds. Please add more funds to your account.")
+                break
+
+            # Print the model name before the response, so streamed text follows it
+            streaming = settings.stream
+            if streaming:
+                print(f"{settings.model} > ", end='', flush=True)
+
+            response = None
+            while response is None:
+                try:
+                    response = chat(prompt, conversation, settings, on_delta=print_delta if streaming else None, context=context)
+                except ChatError as e:
+                    print(f"\n{e.message}")
+
+                    # Ask the user if they would like to try again
                     try_again = input("Would you like to try again? (y/n): ")
-                    if try_again == 'y':
-                        # Continue the conversation loop
-                        continue
-                    elif try_again == 'n':
+                    while try_again not in ['y', 'n']:
+                        print("Error: Invalid input. Please try again.")
+                        try_again = input("Would you like to try again? (y/n): ")
+
+                    if try_again == 'n':
                         # Ends the conversation
                         break
-                    else:
-                        print("Error: Invalid input. Please try again.")
-            except Exception as e:
-                print(e)
+
+                    # Re-send the prompt
+                    if streaming:
+                        print(f"{settings.model} > ", end='', flush=True)
+                except Exception as e:
+                    print(e)
+                    break
+
+            if response is None:
+                # Nothing was sent, give back the reservation
+                user.release(reserved)
                 break
 
             # Received response from API, now process it
             #TODO: Check response status code
             answer = response['choices'][0]['message']['content']
-            print(f"{settings['model']} > {answer}")
+            if streaming:
+                # The answer was already printed as it arrived
+                print()
+            else:
+                print(f"{settings.model} > {answer}")
 
             # Add the response to the conversation
-            conversation.append({"role": "assistant", "content": answer})  
+            conversation.add("assistant", answer)
 
-            # Deduct the cost of the response from the user's balance
-            cost = get_cost(response=response)
-            User.expense(user, cost)
+            if response.get('cached'):
+                # Served from the response cache, nothing to pay for
+                cost = 0.0
+                session['cache_hits'] += 1
+                user.release(reserved)
+            else:
+                # Settle the reservation with the actual cost of the response
+                cost = get_cost(response=response)
+                user.settle(reserved, cost, usage_details(response, session))
 
             # Update the session details
             session['num_of_requests'] += 1
             session['expense'] += cost
+            session['turns'].append(response['timing'])
 
         elif result is None:
             # User entered "-end"
@@ -509,35 +729,214 @@ def converse(user: User, conversation: list, session: dict):
     
     session['end_time'] = datetime.now().isoformat()
 
-    return session
+    return session, settings
+
+
+def print_delta(text: str):
+    '''
+    Print a piece of a streamed response as soon as it arrives.
+    '''
+    print(text, end='', flush=True)
+
+
+def stream_response(request: dict, on_delta=None) -> dict:
+    '''
+    Send a streaming request to the API and rebuild the full response from the deltas.
+
+    Args:
+        request (dict): The request, including the messages
+        on_delta (callable): Called with each piece of content as it arrives
+    Returns:
+        dict: A response in the same format as a non-streamed ChatCompletion
+    '''
+    accumulator = StreamAccumulator(request['model'], request['messages'], on_delta)
 
+    for chunk in openai.ChatCompletion.create(**request):
+        accumulator.add(chunk)
 
-def chat(prompt: str, conversation: list):
-    # Format the prompt
-    message = {"role": "user", "content": prompt}
+    return accumulator.response()
 
-    # Redefining messages as conversation
-    # This is how you get continuous conversation. Conversation is a list of messages
+
+def chat(prompt: str, conversation: Conversation, settings: ChatSettings, on_delta=None, context: ContextWindow = None):
+    # Mark the end of the conversation, so a failed request can be rolled back in O(1)
+    checkpoint = conversation.checkpoint()
+
+    # This is how you get continuous conversation. Conversation holds the messages
     #! Important: Stored as "conversation" locally, sent to API as "messages"
-    conversation.append(message)
+    conversation.add("user", prompt)
 
     # Settings + Prompt/Messages = Request
-    settings.update({'messages': conversation})
-    request = settings
-
-    # Send request to API
+    # Long conversations are trimmed to the model's context window, keeping the system messages
+    if context:
+        messages = context.fit(conversation.to_api(), settings.model, settings.max_tokens)
+    else:
+        messages = conversation.to_api()
+    # The settings build a new request around the messages, they are never changed
+    request = settings.request(messages)
+
+    # Deterministic requests that were answered before are served from the response cache
+    cached = response_cache.get(request)
+    if cached:
+        if on_delta:
+            on_delta(cached['choices'][0]['message']['content'])
+        return cached
+
+    limiter = get_limiter(request['model'])
+    estimated_tokens = estimate_request_tokens(request)
+
+    # Streamed text can't be taken back once it is printed, so only retry if nothing was shown yet
+    delivered = []
+
+    def deliver(text):
+        delivered.append(text)
+        if on_delta:
+            on_delta(text)
+
+    # Messages are sent as plain dicts, built once for every attempt
+    payload = dict(request, messages=api_messages(request['messages']))
+
+    def send():
+        # Wait until the model's requests/tokens per minute limits have room for the request
+        limiter.acquire(estimated_tokens)
+
+        try:
+            if request.get('stream'):
+                return stream_response(payload, deliver)
+
+            start_time = time.perf_counter()
+            response = openai.ChatCompletion.create(**payload)
+            return add_timing(response, time.perf_counter() - start_time)
+        except Exception:
+            # A failed attempt used no tokens, unless part of the answer was streamed
+            if not delivered:
+                limiter.release(estimated_tokens)
+            raise
+
+    # Send request to API. Transient errors (timeouts, 429, 5xx) are retried with backoff
     try:
-        response = openai.ChatCompletion.create(**request)
-    except Exception:
+        response = call_with_retry(send, can_retry=lambda: not delivered)
+    except CircuitOpen:
+        conversation.rollback(checkpoint)
+        raise
+    except Exception as e:
         # Most commonly returns: openai.error.APIError
         # Gives error when asking: "do you have a character or word limit?"
-        conversation.remove(message)
-        raise ChatError("Error: Could not connect to the API. Please try again.")
+        conversation.rollback(checkpoint)
+        if is_transient(e):
+            raise ChatError("Error: Could not connect to the API. Please try again.")
+        raise ChatError(f"Error: The API rejected the request ({e}).")
+
+    # Give back the tokens that were reserved but not used
+    limiter.settle(estimated_tokens, response['usage']['total_tokens'])
+
+    response_cache.put(request, response)
 
     return response
 
 
-def interpret_request(user: User, conversation: list, request: str):
+def preview(message: dict, width: int = 60) -> str:
+    '''
+    Shorten a message to a single line.
+    '''
+    content = ' '.join(message['content'].split())
+    return content if len(content) <= width else f"{content[:width - 3]}..."
+
+
+def shared_messages(conversation: Conversation, path: list) -> int:
+    '''
+    Count the messages a branch, given as its path, shares with the current branch.
+    '''
+    count = 0
+    while count < min(len(path), len(conversation)) and path[count] is conversation[count]:
+        count += 1
+    return count
+
+
+def leading_system_messages(conversation: Conversation) -> int:
+    count = 0
+    while count < len(conversation) and conversation[count]['role'] == 'system':
+        count += 1
+    return count
+
+
+def parse_number(args: list, default: int, low: int, high: int) -> int:
+    '''
+    Parse the optional number argument of a branch command.
+
+    Raises:
+        ValueError: If the argument is not a number between low and high
+    '''
+    if not args:
+        return default
+    if not args[0].isdigit() or not low <= int(args[0]) <= high:
+        raise ValueError(f"Error: Enter a number between {low} and {high}.")
+    return int(args[0])
+
+
+def change_branch(conversation: Conversation, command: str, args: list):
+    '''
+    Handle the branch commands: -history, -rewind, -fork, -branches and -switch.
+
+    Raises:
+        ValueError: If the argument is invalid
+    '''
+    # System messages at the start are kept by every branch
+    first = leading_system_messages(conversation)
+
+    if command == '-history':
+        for number, message in enumerate(conversation, start=1):
+            print(f"{number}. {message['role']}: {preview(message)}")
+        print(f"Prefix hash: {conversation.digest()[:12]}")
+
+    elif command == '-rewind':
+        exchanges = sum(1 for message in conversation.to_storage(first) if message['role'] == 'user')
+        if not exchanges:
+            print("Nothing to rewind.")
+            return
+        turns = parse_number(args, 1, 1, exchanges)
+
+        # Go back to just before the n-th last user message
+        checkpoint = len(conversation)
+        while turns:
+            checkpoint -= 1
+            if conversation[checkpoint]['role'] == 'user':
+                turns -= 1
+        conversation.rewind(checkpoint)
+        print(f"Rewound to message {checkpoint}. Use -branches to go back.")
+
+    elif command == '-fork':
+        # Forking at the end would only continue the current branch
+        if len(conversation) <= first:
+            print("Nothing to fork yet.")
+            return
+        if not args:
+            raise ValueError("Error: Enter the number of the message to branch off after, see -history.")
+        checkpoint = parse_number(args, None, first, len(conversation) - 1)
+        conversation.fork(checkpoint)
+        print(f"New branch after message {checkpoint}. The previous branch is kept, see -branches.")
+
+    elif command == '-branches':
+        branches = conversation.branches()
+        if not branches:
+            print("There are no other branches.")
+        for number, tip in enumerate(branches, start=1):
+            path = tip.path()
+            print(f"{number}. {len(path)} messages ({shared_messages(conversation, path)} shared), "
+                  f"hash {tip.digest.hex()[:12]}, last: {tip['role']}: {preview(tip)}")
+
+    elif command == '-switch':
+        branches = conversation.branches()
+        if not branches:
+            print("There are no other branches.")
+            return
+        if not args:
+            raise ValueError("Error: Enter the number of the branch, see -branches.")
+        tip = branches[parse_number(args, 1, 1, len(branches)) - 1]
+        conversation.switch(tip)
+        print(f"Switched to the branch ending with {tip['role']}: {preview(tip)}")
+
+
+def interpret_request(user: User, conversation: Conversation, request: str, settings: ChatSettings):
     '''
     Interprets the user's request and handles commands.
 
@@ -545,34 +944,56 @@ def interpret_request(user: User, conversation: list, request: str):
         prompt (str): The prompt to send to the chatbot.
         True: The user entered a command. Continue the loop.
         False: The user ended the conversation. Break the loop.
+        ChatSettings: The user changed the model or streaming. Continue the loop with the new settings.
     '''
     # Check if the user entered a command
     commands = {
         '-help': 'Display a list of commands',
         '-balance': 'Display the user\'s balance',
         '-model': 'Change the model',
+        '-stream': 'Turn showing the response as it is generated on or off: -stream <on|off>',
+        '-history': 'Show the numbered messages of the current branch',
+        '-rewind': 'Undo the last exchange, or the last n with -rewind <n>. The undone messages are kept as a branch',
+        '-fork': 'Start a new branch after message n: -fork <n>. The current branch is kept',
+        '-branches': 'List the other branches of the conversation',
+        '-switch': 'Switch to another branch: -switch <n>',
         '-end': 'End the conversation',
         '-info': 'Show the session/conversation info'
     }
     
     if request.startswith('-'):
         # User entered a command
-        if request == '-help':
+        command, *args = request.split()
+        if command == '-help':
             # Display a list of commands
-            for command, description in commands.items():
-                print(f"{command}: {description}")
-        elif request == '-balance':
+            for name, description in commands.items():
+                print(f"{name}: {description}")
+        elif command == '-balance':
             # Display the user's balance
             print(f"Balance: {user.balance}")
-        elif request == '-model':
+        elif command == '-model':
             # Change the model
-            select_model()
-        elif request == '-end':
+            return select_model(settings)
+        elif command == '-stream':
+            if args and args[0].lower() not in ['on', 'off']:
+                print("Error: Enter -stream on or -stream off.")
+                return True
+            # Without an argument, streaming is toggled
+            stream = args[0].lower() == 'on' if args else not settings.stream
+            print(f"Streaming is {'on' if stream else 'off'}.")
+            return settings.replace(stream=stream)
+        elif command in ['-history', '-rewind', '-fork', '-branches', '-switch']:
+            # Branches share the messages of their common history, nothing is copied
+            try:
+                change_branch(conversation, command, args)
+            except ValueError as e:
+                print(e)
+        elif command == '-end':
             # End the conversation
             print("Ending conversation...")
             print("-" * 50)
             return None
-        elif request == '-info':
+        elif command == '-info':
             # Show session info
             #TODO: show_session_info()
             pass
@@ -608,24 +1029,57 @@ def analyze_response(response):
 
     return results
 
-def save_conversation(user: User, conversation: list, session: dict):
+def save_conversation(user: User, conversation: Conversation, session: dict) -> int:
     '''
-    Saves the conversation to the database.
+    Saves the conversation to the database. Saving again only sends the messages added since the last save.
+
+    Returns:
+        int: The number of messages saved
     '''
-    #TODO: Prevent saving the same conversation twice
+    # Conversations are stored in their own collection, in buckets keyed by user and session id
+    return conversations.save_conversation(user.user_id, session, conversation)
 
-    # Convert conversation list to dict
-    conversation_dict = {
-        'messages': [{'user': msg['role'], 'content': msg['content']} for msg in conversation],
-        'session': session
-        }
 
-    # Save conversation to database
-    user.conversations.append(conversation_dict)
-    user.save()
+def load_conversation(user: User):
+    '''
+    Ask for one of the user's saved conversations and load it.
+
+    Returns:
+        Conversation: The loaded conversation, or None if nothing was loaded
+    '''
+    try:
+        saved = user.get_conversations()
+    except PyMongoError as e:
+        print(f"Error: Could not load the saved conversations ({e}).")
+        return None
+
+    if not saved:
+        print("There are no saved conversations.")
+        return None
+
+    for number, summary in enumerate(saved, start=1):
+        session = summary.get('session', {})
+        print(f"{number}. {session.get('start_time', summary.get('created'))} {session.get('model', '')}: "
+              f"{summary.get('total', 0)} messages")
+
+    try:
+        choice = parse_number(input("Enter a number: ").split(), 0, 1, len(saved))
+    except ValueError as e:
+        print(e)
+        return None
+    if not choice:
+        return None
+
+    try:
+        messages = user.get_conversation_messages(saved[choice - 1]['session_id'])
+    except PyMongoError as e:
+        print(f"Error: Could not load the conversation ({e}).")
+        return None
+
+    return Conversation(messages)
 
 
-def export_conversation(user: User, conversation: list, filename: str):
+def export_conversation(user: User, conversation: Conversation, filename: str):
     '''
     Exports the conversation to a text file.
     '''
@@ -659,6 +1113,9 @@ def export_conversation(user: User, conversation: list, filename: str):
 
 
 def main():
+    # Start connecting to the database while the user reads the login menu
+    get_backend().warm_up(on_connect=ensure_indexes)
+
     print("-" * 50)
     print("\nWelcome to the OpenAI API Chatbot Test\n")
 
@@ -670,8 +1127,10 @@ def main():
         print("Unkown user error. Continuing as a guest.\n")
         user = User.guest()
 
+    settings = ChatSettings() # Per-session prompt settings, replaced (never changed) when the user changes them
+
     if user.role == 'admin':
-        handle_admin(user)
+        settings = handle_admin(user, settings)
 
     # Get users balance from the database
     balance = user.balance
@@ -684,17 +1143,17 @@ def main():
     #     print("Sign up for a free account to continue using the application to add funds.\n")
 
     # Select a model
-    select_model()
+    settings = select_model(settings)
 
-    conversation = [] #TODO: Maybe make this a class
+    conversation = Conversation()
+    context = ContextWindow() # Keeps the messages sent to the API within the model's context window
 
     #TODO: Need to add a way for admin to add system message before the chat starts. Don't want to ask admin for more input. Refactor later
     if user.role == 'admin':
         system = input ("Would you like to add a system message? (y/n): ")
         if system == 'y':
             system_message = input("Enter your message: ")
-            message = {"role": "system", "content": system_message}
-            conversation.append(message)
+            conversation.add("system", system_message)
 
     # Begin the conversation
     conversation_loop = True
@@ -704,14 +1163,17 @@ def main():
         session_details = {
             'id': str(uuid.uuid4()),
             'user': user.username,
+            'model': settings.model,
             'start_time': datetime.now().isoformat(),
             'end_time': None,
             'num_of_requests': 0,
             'expense': 0.00,
+            'turns': [],    # Time to first token and tokens/sec for each response
+            'cache_hits': 0,
         }
 
         # Begin the conversation
-        info = converse(user, conversation, session_details) # Loops until user ends conversation. Info holds the session details
+        info, settings = converse(user, conversation, session_details, settings, context) # Loops until user ends conversation. Info holds the session details
 
         # End the conversation
         # Post conversation actions loop
@@ -726,13 +1188,13 @@ def main():
                 'balance': 'Check your balance',
                 'info': 'View the conversation info',
                 'save': 'Save the conversation',
+                'load': 'Load a saved conversation and continue it',
                 'export': 'Export the conversation to a text file',
             }
 
             #TODO: Differentiate between session and conversation info. Users should be able to continue the conversation after viewing the session info
-            #TODO: Add load conversation option
 
-            while action not in ['chat', 'exit', 'options', 'change', 'balance', 'info', 'save', 'export']:
+            while action not in commands:
                 print('Error: Invalid input. Please try again.')
                 action = input("To start a new conversation, type 'chat', or select another option. Type 'options' to see a list of options: ").lower()
 
@@ -750,8 +1212,8 @@ def main():
                 break
             elif action == 'change':
                 # Change the model
-                select_model()
-                print(f'{settings["model"]} will be used for the next conversation.')
+                settings = select_model(settings)
+                print(f'{settings.model} will be used for the next conversation.')
                 continue
             elif action == 'balance':
                 # Display the user's balance
@@ -764,8 +1226,18 @@ def main():
                 continue
             elif action == 'save':
                 # Save the conversation
-                save_conversation(user=user, conversation=conversation, session=info)
-                print('Conversation saved to user profile.')
+                if save_conversation(user=user, conversation=conversation, session=info):
+                    print('Conversation saved to user profile.')
+                else:
+                    print('No new messages to save.')
+                continue
+            elif action == 'load':
+                # Replace the conversation with a saved one. Use chat to continue it
+                loaded = load_conversation(user)
+                if loaded is not None:
+                    conversation = loaded
+                    context = ContextWindow()
+                    print(f'Loaded {len(conversation)} messages. Use chat to continue the conversation.')
                 continue
             elif action == 'export':
                 # Export the conversation to a file
@@ -785,13 +1257,50 @@ def main():
     # Save updated user information to the database
     user.save()
 
-    # Application exit
-    client.close()
+    # Application exit. Write anything still queued before closing the connection
+    persistence.close()
+    get_backend().close()
     print('Thank you for using the OpenAi API Chatbot Test')
 
 
+def batch_main(input_path: str, output_path: str, concurrency: int):
+    '''
+    Run a JSONL file of prompts in batch mode, charged to the logged in user.
+    '''
+    get_backend().warm_up(on_connect=ensure_indexes)
+
+    print("-" * 50)
+    print("\nOpenAI API Chatbot Test - Batch Mode\n")
+
+    user = login_prompt()
+
+    if not output_path:
+        output_path = f"{os.path.splitext(input_path)[0]}.results.jsonl"
+
+    print(f"Running {input_path} with up to {concurrency} requests in flight...")
+    summary = asyncio.run(run_batch(user, input_path, output_path, ChatSettings(), concurrency))
+
+    for key, value in summary.items():
+        print(f"{key}: {value}")
+    for key, value in response_cache.stats().items():
+        print(f"cache_{key}: {value}")
+    print(f"Results written to {output_path}")
+
+    persistence.close()
+    get_backend().close()
+
+
 if __name__ == '__main__':
-    main()
+    parser = argparse.ArgumentParser(description='OpenAI API Chatbot Test')
+    parser.add_argument('--batch', metavar='INPUT', help='Run the prompts in a JSONL file instead of the interactive chat')
+    parser.add_argument('--output', metavar='OUTPUT', help='JSONL file to write batch results to (default: INPUT.results.jsonl)')
+    parser.add_argument('--concurrency', type=int, default=8, help='Maximum number of batch requests in flight (default: 8)')
+    args = parser.parse_args()
+
+    if args.batch:
+        batch_main(args.batch, args.output, args.concurrency)
+    else:
+        main()
 
 
 
@@ -0,0 +1,302 @@
+# This file contains the asynchronous chat engine used to run many conversations on one event loop.
+
+import asyncio
+import time
+
+import openai
+
+from chat_settings import ChatSettings
+from conversation import Conversation, api_messages
+from exceptions import ChatError, CircuitOpen
+from cache import response_cache
+from model_registry import registry
+from rate_limit import get_limiter, estimate_request_tokens
+from retry import acall_with_retry, is_transient
+from tokens import TOKENS_PER_REPLY, count_message_tokens
+
+
+class StreamAccumulator:
+    '''
+    Rebuilds a full ChatCompletion response from streamed chunks.
+
+    The API does not report usage for streamed responses, so completion tokens are counted from the
+    streamed chunks (one token per chunk) and prompt tokens are estimated locally. The usage is
+    marked as estimated.
+    '''
+    def __init__(self, model: str, messages: list, on_delta=None):
+        self.model = model
+        self.messages = messages
+        self.on_delta = on_delta
+        self.role = 'assistant'
+        self.content = []
+        self.completion_tokens = 0
+        self.finish_reason = None
+        self.start_time = time.perf_counter()
+        self.first_token_time = None
+
+    def add(self, chunk):
+        '''
+        Add a streamed chunk to the response.
+
+        Args:
+            chunk (dict): A chat.completion.chunk object
+        '''
+        self.model = chunk.get('model', self.model)
+        choice = chunk['choices'][0]
+        delta = choice.get('delta', {})
+
+        if 'role' in delta:
+            self.role = delta['role']
+        if delta.get('content'):
+            if self.first_token_time is None:
+                self.first_token_time = time.perf_counter()
+            self.content.append(delta['content'])
+            self.completion_tokens += 1
+            if self.on_delta:
+                self.on_delta(delta['content'])
+        if choice.get('finish_reason'):
+            self.finish_reason = choice['finish_reason']
+
+    def response(self) -> dict:
+        '''
+        Return the rebuilt response, in the same format as a non-streamed ChatCompletion.
+        '''
+        end_time = time.perf_counter()
+        prompt_tokens = count_message_tokens(self.messages)
+        first_token_time = self.first_token_time or end_time
+        generation_time = end_time - first_token_time
+
+        return {
+            'object': 'chat.completion',
+            'model': self.model,
+            'choices': [{
+                'index': 0,
+                'message': {'role': self.role, 'content': ''.join(self.content)},
+                'finish_reason': self.finish_reason,
+            }],
+            'usage': {
+                'prompt_tokens': prompt_tokens,
+                'completion_tokens': self.completion_tokens,
+                'total_tokens': prompt_tokens + self.completion_tokens,
+                'estimated': True,
+            },
+            'timing': {
+                'time_to_first_token': round(first_token_time - self.start_time, 3),
+                'total_time': round(end_time - self.start_time, 3),
+                'tokens_per_second': round(self.completion_tokens / generation_time, 2) if generation_time > 0 else None,
+            },
+        }
+
+
+def add_timing(response, total_time: float):
+    '''
+    Add timing details to a non-streamed response. The first token arrives with the whole response.
+
+    Args:
+        response (dict): The API response
+        total_time (float): Seconds between sending the request and receiving the response
+    '''
+    completion_tokens = response['usage']['completion_tokens']
+    response['timing'] = {
+        'time_to_first_token': round(total_time, 3),
+        'total_time': round(total_time, 3),
+        'tokens_per_second': round(completion_tokens / total_time, 2) if total_time > 0 else None,
+    }
+    return response
+
+
+def response_cost(response) -> float:
+    '''
+    Calculate the cost of a response from its usage.
+    '''
+    return registry.cost(response['model'], response['usage']['total_tokens'])
+
+
+async def call_openai_api(request: dict, on_delta=None):
+    '''
+    Send a request to the API without blocking the event loop.
+
+    Args:
+        request (dict): The request, including the messages
+        on_delta (callable): Called with each piece of content as it arrives, when streaming
+    Returns:
+        dict: The response
+    '''
+    # Deterministic requests that were answered before are served from the response cache
+    cached = await response_cache.aget(request)
+    if cached:
+        if on_delta:
+            on_delta(cached['choices'][0]['message']['content'])
+        return cached
+
+    limiter = get_limiter(request['model'])
+    estimated_tokens = estimate_request_tokens(request)
+
+    # Streamed text can't be taken back once it is delivered, so only retry if nothing was sent yet
+    delivered = []
+
+    def deliver(text):
+        delivered.append(text)
+        if on_delta:
+            on_delta(text)
+
+    # Messages are sent as plain dicts, built once for every attempt
+    payload = dict(request, messages=api_messages(request['messages']))
+
+    async def send():
+        # Wait until the model's requests/tokens per minute limits have room for the request
+        await limiter.acquire_async(estimated_tokens)
+
+        try:
+            if request.get('stream'):
+                accumulator = StreamAccumulator(request['model'], request['messages'], deliver)
+                async for chunk in await openai.ChatCompletion.acreate(**payload):
+                    accumulator.add(chunk)
+                return accumulator.response()
+
+            start_time = time.perf_counter()
+            response = await openai.ChatCompletion.acreate(**payload)
+            return add_timing(response, time.perf_counter() - start_time)
+        except Exception:
+            # A failed attempt used no tokens, unless part of the answer was streamed
+            if not delivered:
+                limiter.release(estimated_tokens)
+            raise
+
+    # Transient errors (timeouts, 429, 5xx) are retried with backoff
+    response = await acall_with_retry(send, can_retry=lambda: not delivered)
+
+    # Give back the tokens that were reserved but not used
+    limiter.settle(estimated_tokens, response['usage']['total_tokens'])
+
+    await response_cache.aput(request, response)
+
+    return response
+
+
+async def achat(prompt: str, conversation: Conversation, settings: ChatSettings, on_delta=None, context=None):
+    '''
+    Async version of chat(). Adds the prompt to the conversation and sends it to the API.
+
+    Args:
+        prompt (str): The user prompt
+        conversation (Conversation): The conversation. The prompt is rolled back on failure
+        settings (ChatSettings): The per-session prompt settings
+        on_delta (callable): Called with each piece of content as it arrives, when streaming
+        context (ContextWindow): Trims the messages sent to the model's context window
+    Returns:
+        dict: The response
+    '''
+    checkpoint = conversation.checkpoint()
+    conversation.add("user", prompt)
+
+    if context:
+        messages = context.fit(conversation.to_api(), settings.model, settings.max_tokens)
+    else:
+        messages = conversation.to_api()
+    request = settings.request(messages)
+
+    try:
+        response = await call_openai_api(request, on_delta)
+    except CircuitOpen:
+        conversation.rollback(checkpoint)
+        raise
+    except Exception as e:
+        conversation.rollback(checkpoint)
+        if is_transient(e):
+            raise ChatError("Error: Could not connect to the API. Please try again.")
+        raise ChatError(f"Error: The API rejected the request ({e}).")
+
+    return response
+
+
+def estimate_max_cost(settings: ChatSettings, conversation: Conversation = None, prompt: str = None, context=None) -> float:
+    '''
+    Estimate the maximum cost of the next request: the prompt tokens of the messages that will be sent, plus max_tokens.
+    '''
+    messages = conversation.to_api() if conversation else []
+    new = [{"role": "user", "content": prompt}] if prompt is not None else []
+
+    if not messages and not new:
+        prompt_tokens = 0
+    elif context:
+        prompt_tokens = count_message_tokens(context.fit(messages + new, settings.model, settings.max_tokens))
+    else:
+        # The conversation keeps a running token count, only the new prompt is counted
+        prompt_tokens = count_message_tokens(new) + (conversation.tokens() - TOKENS_PER_REPLY if conversation else 0)
+
+    return registry.cost(settings.model, prompt_tokens + settings.max_tokens)
+
+
+def usage_details(response, session: dict = None) -> dict:
+    '''
+    Get the details of a response to record with its usage event.
+    '''
+    details = {
+        'model': response['model'],
+        'prompt_tokens': response['usage']['prompt_tokens'],
+        'completion_tokens': response['usage']['completion_tokens'],
+    }
+    if response['usage'].get('estimated'):
+        # Streamed, the token counts are local estimates rather than the API's
+        details['estimated'] = True
+    if session:
+        details['session_id'] = session['id']
+    return details
+
+
+async def areserve(user, amount: float) -> bool:
+    '''
+    Reserve the maximum cost of a request. The database update runs in a worker thread.
+    '''
+    return await asyncio.to_thread(user.reserve, amount)
+
+
+async def arelease(user, amount: float):
+    '''
+    Give back an unused reservation. The database update runs in a worker thread.
+    '''
+    await asyncio.to_thread(user.release, amount)
+
+
+async def asettle(user, reserved: float, cost: float, details: dict = None):
+    '''
+    Settle a reservation with the actual cost. The database updates run in a worker thread.
+    '''
+    await asyncio.to_thread(user.settle, reserved, cost, details)
+
+
+async def aconverse_turn(user, conversation: Conversation, session: dict, prompt: str, settings: ChatSettings, on_delta=None, context=None):
+    '''
+    Run a single conversation turn: reserve the maximum cost, send the prompt and settle the actual cost.
+
+    Returns:
+        str: The answer, or None if the user cannot afford the request
+    '''
+    reserved = estimate_max_cost(settings, conversation, prompt, context)
+    if not await areserve(user, reserved):
+        return None
+
+    try:
+        response = await achat(prompt, conversation, settings, on_delta, context)
+    except Exception:
+        await arelease(user, reserved)
+        raise
+
+    answer = response['choices'][0]['message']['content']
+    conversation.add("assistant", answer)
+
+    if response.get('cached'):
+        # Served from the response cache, nothing to pay for
+        cost = 0.0
+        session['cache_hits'] += 1
+        await arelease(user, reserved)
+    else:
+        cost = response_cost(response)
+        await asettle(user, reserved, cost, usage_details(response, session))
+
+    session['num_of_requests'] += 1
+    session['expense'] += cost
+    session['turns'].append(response['timing'])
+
+    return answer
@@ -0,0 +1,78 @@
+# This file contains the per-session prompt settings, validated once and used to build every request.
+
+from dataclasses import dataclass, fields, replace
+
+from model_registry import registry
+
+
+# Accepted range of each numeric setting, as documented by the API
+SETTING_LIMITS = {
+    'max_tokens': (int, 1, 8000),
+    'temperature': (float, 0, 2),
+    'top_p': (float, 0, 1),
+    'frequency_penalty': (float, -2, 2),
+    'presence_penalty': (float, -2, 2),
+}
+
+
+@dataclass(frozen=True)
+class ChatSettings:
+    '''
+    The prompt settings of one session.
+
+    Instances are immutable and validated on creation, so they can be shared between threads and
+    tasks. Changing a setting returns a new instance, see replace().
+    '''
+    model: str = 'gpt-3.5-turbo'
+    max_tokens: int = 1000
+    temperature: float = 1.2
+    top_p: float = 1
+    frequency_penalty: float = 0.5
+    presence_penalty: float = 0.5
+    stream: bool = True     # Render the response as it is generated
+
+    def __post_init__(self):
+        if self.model not in registry:
+            raise ValueError(f"Error: Invalid model name ({self.model}).")
+
+        for name, (kind, low, high) in SETTING_LIMITS.items():
+            value = getattr(self, name)
+            try:
+                value = kind(value)
+            except (TypeError, ValueError):
+                raise ValueError(f"Error: Invalid value for {name} ({value}).")
+            if not low <= value <= high:
+                raise ValueError(f"Error: {name} must be between {low} and {high}.")
+            # Frozen, so normalized values are set past the dataclass guard
+            object.__setattr__(self, name, value)
+
+        # bool() would turn e.g. the string "false" from a JSON body into True
+        if not isinstance(self.stream, bool):
+            raise ValueError(f"Error: Invalid value for stream ({self.stream}).")
+
+    def replace(self, **changes):
+        '''
+        Return new settings with some values changed. The new values are validated.
+
+        Raises:
+            ValueError: If a setting is unknown or invalid
+        '''
+        names = {field.name for field in fields(self)}
+        for key in changes:
+            if key not in names:
+                raise ValueError(f"Error: Unknown setting ({key}).")
+        return replace(self, **changes)
+
+    def as_dict(self) -> dict:
+        return {field.name: getattr(self, field.name) for field in fields(self)}
+
+    def request(self, messages: list) -> dict:
+        '''
+        Build the API request for the messages.
+
+        The messages are referenced, not copied, and the settings are not changed, so the same
+        settings can build requests for any number of sessions.
+        '''
+        request = self.as_dict()
+        request['messages'] = messages
+        return request
@@ -0,0 +1,110 @@
+# This file contains the context window manager that keeps long conversations within a token budget.
+
+from model_registry import registry
+from tokens import TOKENS_PER_REPLY, message_tokens
+
+# Using config.py to load environment variables, production
+import config
+
+
+# Optional per-model prompt budgets, e.g. {'gpt-3.5-turbo': 2000}. Defaults to the model's context window
+CONTEXT_BUDGETS = getattr(config, 'CONTEXT_BUDGETS', {})
+
+
+class ContextWindow:
+    '''
+    Chooses which messages of a conversation to send, so the prompt fits the model's context window.
+
+    System messages are always sent. The oldest other messages are dropped until the prompt plus
+    max_tokens fits. Token counts are kept per message and the window only moves forward, so each
+    turn only tokenizes the new messages.
+    '''
+    def __init__(self, budget: int = None):
+        self.budget = budget        # Fixed prompt budget, overrides the per-model budget
+        self._entries = []          # (message, tokens) for each message seen so far
+        self._start = 0             # Index of the oldest message still in the window
+        self._window_tokens = 0     # Tokens of the messages from _start on
+        self._pinned = []           # System messages that fell out of the window, sent anyway
+        self._pinned_tokens = 0
+        self._last_budget = None
+
+    def get_budget(self, model: str, max_tokens: int) -> int:
+        '''
+        Get the number of prompt tokens available for a model.
+
+        Args:
+            model (str): The model id
+            max_tokens (int): The tokens reserved for the response
+        Returns:
+            int: The prompt budget
+        '''
+        entry = registry.get(model)
+        budget = entry.get('context_window', 4096) - max_tokens
+        configured = self.budget or CONTEXT_BUDGETS.get(entry['id'])
+        if configured:
+            budget = min(budget, configured)
+        return budget
+
+    def _sync(self, conversation: list):
+        # Forget messages that were removed from the end (e.g. a failed request)
+        while self._entries and (
+            len(self._entries) > len(conversation)
+            or self._entries[-1][0] is not conversation[len(self._entries) - 1]
+        ):
+            message, tokens = self._entries.pop()
+            if len(self._entries) >= self._start:
+                self._window_tokens -= tokens
+            else:
+                # The window can't be moved back past a removed message, start over
+                self._reset()
+
+        for message in conversation[len(self._entries):]:
+            tokens = message_tokens(message)
+            self._entries.append((message, tokens))
+            self._window_tokens += tokens
+
+    def _reset(self):
+        self._start = 0
+        self._pinned = []
+        self._pinned_tokens = 0
+        self._window_tokens = sum(tokens for message, tokens in self._entries)
+
+    def fit(self, conversation: list, model: str, max_tokens: int) -> list:
+        '''
+        Get the messages to send for the next request.
+
+        Args:
+            conversation (list): The full conversation, ending with the new prompt
+            model (str): The model id
+            max_tokens (int): The tokens reserved for the response
+        Returns:
+            list: The pinned system messages followed by the most recent messages that fit
+        '''
+        budget = self.get_budget(model, max_tokens)
+
+        # A bigger budget (e.g. a different model) may fit older messages again
+        if self._last_budget is not None and budget > self._last_budget:
+            self._reset()
+        self._last_budget = budget
+
+        self._sync(conversation)
+
+        # Always keep the newest message, even if it does not fit on its own
+        last = len(self._entries) - 1
+        while self._start < last and self._pinned_tokens + self._window_tokens + TOKENS_PER_REPLY > budget:
+            message, tokens = self._entries[self._start]
+            if message['role'] == 'system':
+                self._pinned.append(message)
+                self._pinned_tokens += tokens
+            self._window_tokens -= tokens
+            self._start += 1
+
+        if self._start == 0:
+            return conversation
+        return self._pinned + conversation[self._start:]
+
+    def prompt_tokens(self) -> int:
+        '''
+        Return the estimated prompt tokens of the last fitted window.
+        '''
+        return self._pinned_tokens + self._window_tokens + TOKENS_PER_REPLY
@@ -0,0 +1,202 @@
+# This file contains the in-memory conversation: a tree of messages with cached token counts and prefix hashes.
+
+import hashlib
+import sys
+
+from tokens import TOKENS_PER_REPLY, estimate_message_tokens
+
+
+# Hash of the empty conversation, the start of every hash chain
+ROOT_DIGEST = hashlib.sha256(b'').digest()
+
+
+def api_messages(messages: list) -> list:
+    '''
+    Build the {'role': ..., 'content': ...} dicts the API and the conversations collection expect.
+
+    Args:
+        messages (list): Messages or dicts, e.g. Conversation.to_api()
+    Returns:
+        list: New dicts, one per message
+    '''
+    return [{'role': message['role'], 'content': message['content']} for message in messages]
+
+
+def chain_digest(previous: bytes, role: str, content: str) -> bytes:
+    '''
+    Hash a message together with the hash of everything before it.
+
+    The digest of a message therefore identifies the whole conversation up to and including it.
+
+    Args:
+        previous (bytes): The digest of the previous message, or ROOT_DIGEST
+        role (str): The message role
+        content (str): The message content
+    Returns:
+        bytes: The new digest
+    '''
+    # The previous digest has a fixed length and roles never contain a NUL, so the encoding is unambiguous
+    return hashlib.sha256(previous + role.encode('utf-8') + b'\0' + content.encode('utf-8')).digest()
+
+
+class Message:
+    '''
+    A chat message, and a node in the conversation tree.
+
+    A record of the role and content, the parent message, the token count of the conversation up
+    to and including it, and the digest of that conversation. It is not a dict, so a message costs
+    one slotted object, its digest and its token count; it can still be read like the
+    {'role': ..., 'content': ...} dict it replaces, e.g. message['role']. Requests and saves build
+    the dicts with api_messages(). Messages must not be changed once created, so any number of
+    branches can share them.
+    '''
+    __slots__ = ('role', 'content', 'parent', 'prefix_tokens', 'digest')
+
+    def __init__(self, role: str, content: str, parent=None):
+        self.role = sys.intern(role)
+        self.content = content
+        self.parent = parent
+        self.prefix_tokens = estimate_message_tokens(role, content) + (parent.prefix_tokens if parent else 0)
+        self.digest = chain_digest(parent.digest if parent else ROOT_DIGEST, role, content)
+
+    def __getitem__(self, key: str) -> str:
+        if key == 'role':
+            return self.role
+        if key == 'content':
+            return self.content
+        raise KeyError(key)
+
+    def to_dict(self) -> dict:
+        return {'role': self.role, 'content': self.content}
+
+    def path(self) -> list:
+        '''
+        Get the messages from the start of the conversation up to this one.
+        '''
+        messages = []
+        node = self
+        while node is not None:
+            messages.append(node)
+            node = node.parent
+        messages.reverse()
+        return messages
+
+
+class Conversation:
+    '''
+    A conversation with branches.
+
+    Messages form a persistent tree: every message points to its parent, so branches share the
+    messages of their common history instead of copying them, and a message's digest identifies
+    its whole prefix. The active branch is also kept as a list, for O(1) access when a request is
+    sent. Token totals are kept per prefix, so counting and rolling back are O(1) in the history.
+    '''
+    __slots__ = ('_messages', '_branches')
+
+    def __init__(self, messages=None):
+        self._messages = []         # The active branch, from the first message to the tip
+        self._branches = []         # Tips of the other branches
+        for message in messages or []:
+            self.append(message)
+
+    def add(self, role: str, content: str) -> Message:
+        '''
+        Add a message to the end of the active branch.
+
+        Returns:
+            Message: The new message
+        '''
+        message = Message(role, content, self._messages[-1] if self._messages else None)
+        self._messages.append(message)
+        return message
+
+    def append(self, message: dict) -> Message:
+        '''
+        Add a message given as a dict with a role and content.
+        '''
+        return self.add(message['role'], message['content'])
+
+    def checkpoint(self) -> int:
+        '''
+        Mark the current end of the conversation, to roll back to.
+        '''
+        return len(self._messages)
+
+    def rollback(self, checkpoint: int):
+        '''
+        Remove every message added since the checkpoint, e.g. after a failed request. Nothing is kept.
+        '''
+        del self._messages[checkpoint:]
+
+    def _keep(self):
+        # Keep the tip of the active branch before leaving it. Compared by identity, equal messages
+        # in different branches are different nodes
+        if self._messages and not any(tip is self._messages[-1] for tip in self._branches):
+            self._branches.append(self._messages[-1])
+
+    def rewind(self, checkpoint: int):
+        '''
+        Go back to an earlier point of the conversation. The messages after it are kept as a branch.
+        '''
+        if checkpoint < len(self._messages):
+            self._keep()
+            self.rollback(checkpoint)
+
+    def fork(self, checkpoint: int):
+        '''
+        Start a new branch after the first checkpoint messages. The current branch is kept.
+
+        The same as rewind(). Forking at the end does nothing: the active branch simply continues,
+        and would otherwise be listed as one of its own branches.
+        '''
+        self.rewind(checkpoint)
+
+    def branches(self) -> list:
+        '''
+        Get the tips of the other branches, oldest first.
+        '''
+        return list(self._branches)
+
+    def switch(self, tip: Message):
+        '''
+        Make another branch active, given its tip. The current branch is kept.
+        '''
+        self._keep()
+        self._branches = [branch for branch in self._branches if branch is not tip]
+        self._messages = tip.path()
+
+    def tokens(self) -> int:
+        '''
+        Estimate the prompt tokens of the active branch, the same as count_message_tokens().
+        '''
+        return (self._messages[-1].prefix_tokens if self._messages else 0) + TOKENS_PER_REPLY
+
+    def digest(self, checkpoint: int = None) -> str:
+        '''
+        Get the hash of the active branch, or of its first checkpoint messages. Branches with the same
+        history have the same hash.
+        '''
+        end = len(self._messages) if checkpoint is None else checkpoint
+        return (self._messages[end - 1].digest if end else ROOT_DIGEST).hex()
+
+    def to_api(self) -> list:
+        '''
+        Get the messages to send. Returns the internal list, which must not be changed. The request
+        is converted with api_messages() when it is sent, so the cache can still use the digests.
+        '''
+        return self._messages
+
+    def to_storage(self, start: int = 0, end: int = None) -> list:
+        '''
+        Get a range of the messages in the storage format, as new dicts.
+        '''
+        return api_messages(self._messages[start:end])
+
+    def __len__(self):
+        return len(self._messages)
+
+    def __iter__(self):
+        return iter(self._messages)
+
+    def __getitem__(self, index):
+        return self._messages[index]
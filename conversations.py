@@ -0,0 +1,203 @@
+# This file contains the conversations collection, which stores saved conversations outside of the user documents.
+
+import hashlib
+import json
+import threading
+
+from collections import OrderedDict
+from datetime import datetime
+
+from conversation import Conversation
+from database import get_users_collection
+from persistence import persistence
+from storage import get_backend
+
+# Using config.py to load environment variables, production
+import config
+
+
+# Maximum number of messages stored in one bucket document
+BUCKET_SIZE = 100
+
+# Fields returned when listing conversations, without the messages. "count" is the size of each bucket,
+# "total" the number of messages in the conversation, stored on the first bucket
+SUMMARY_FIELDS = ('session_id', 'session', 'total', 'created')
+
+# Number of sessions whose last save is remembered. A forgotten session is written in full on its next save
+SAVED_SESSIONS = getattr(config, 'CONVERSATIONS_SAVED_SESSIONS', 1000)
+
+
+def to_stored_message(message: dict) -> dict:
+    '''
+    Convert an API message to the stored format.
+    '''
+    return {'role': message['role'], 'content': message['content']}
+
+
+class SavedState:
+    '''
+    What was last saved for a session: the number of messages, the hash of the messages up to the end
+    of each bucket, and the hash of the session details.
+    '''
+    __slots__ = ('count', 'digests', 'session')
+
+    def __init__(self, count: int, digests: list, session: str):
+        self.count = count
+        self.digests = digests
+        self.session = session
+
+
+_saved = OrderedDict()      # (user_id, session_id) -> SavedState, least recently saved first
+_saved_lock = threading.Lock()
+
+
+def session_digest(session: dict) -> str:
+    return hashlib.sha256(json.dumps(session, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+
+def bucket_digests(messages: Conversation) -> list:
+    '''
+    Get the hash of the messages up to the end of each bucket.
+    '''
+    return [messages.digest(min(start + BUCKET_SIZE, len(messages))) for start in range(0, max(len(messages), 1), BUCKET_SIZE)]
+
+
+def unchanged_messages(saved: SavedState, messages: Conversation) -> int:
+    '''
+    Count the saved messages that are still the start of the conversation, rounded down to whole
+    buckets unless every saved message is.
+    '''
+    for bucket, digest in enumerate(saved.digests):
+        end = min((bucket + 1) * BUCKET_SIZE, saved.count)
+        if end > len(messages) or messages.digest(end) != digest:
+            return bucket * BUCKET_SIZE
+    return saved.count
+
+
+def save_conversation(user_id: str, session: dict, messages: list) -> int:
+    '''
+    Save a conversation, split into buckets of BUCKET_SIZE messages.
+
+    Saves are incremental: messages added since the last save of the session are appended to its
+    buckets, so saving again only sends the new messages, and saving an unchanged conversation sends
+    nothing. If earlier messages changed (e.g. after a rewind), the buckets from the first change on
+    are rewritten. The session details and the total number of messages are stored on the first bucket. The writes are queued and
+    applied in the background.
+
+    Only the active branch of a Conversation is saved. Its other branches live in memory only.
+
+    Args:
+        user_id (str): The user id
+        session (dict): The session details, including its id
+        messages (Conversation): The conversation, or a list of messages
+    Returns:
+        int: The number of messages written
+    '''
+    if not isinstance(messages, Conversation):
+        messages = Conversation(to_stored_message(message) for message in messages)
+
+    key = (user_id, session['id'])
+    details = session_digest(session)
+    now = datetime.now()
+
+    with _saved_lock:
+        saved = _saved.get(key)
+        if saved is None:
+            # Never saved by this process: write every bucket, which overwrites anything saved before
+            saved = SavedState(0, [], None)
+        start = unchanged_messages(saved, messages)
+
+        updates = {}
+        last = max(len(messages) - 1, 0) // BUCKET_SIZE
+        if start < len(messages) or not saved.digests:
+            for bucket in range(start // BUCKET_SIZE, last + 1):
+                end = (bucket + 1) * BUCKET_SIZE
+                if bucket * BUCKET_SIZE < start:
+                    # The start of the bucket is already saved, append the rest
+                    stored = messages.to_storage(start, end)
+                    updates[bucket] = {'$push': {'messages': {'$each': stored}}, '$inc': {'count': len(stored)}}
+                else:
+                    stored = messages.to_storage(bucket * BUCKET_SIZE, end)
+                    updates[bucket] = {'$set': {'messages': stored, 'count': len(stored)}}
+
+        # Empty the buckets left over from a longer version of the conversation
+        for bucket in range(last + 1, len(saved.digests)):
+            updates[bucket] = {'$set': {'messages': [], 'count': 0}}
+
+        if details != saved.session:
+            updates.setdefault(0, {}).setdefault('$set', {})['session'] = session
+        if len(messages) != saved.count or not saved.digests:
+            updates.setdefault(0, {}).setdefault('$set', {})['total'] = len(messages)
+
+        # Queued under the lock, so saves of the same session are written in order
+        for bucket, update in sorted(updates.items()):
+            update['$setOnInsert'] = {'created': now}
+            persistence.update(
+                'conversations',
+                {'user_id': user_id, 'session_id': session['id'], 'bucket': bucket},
+                update,
+                upsert=True
+            )
+
+        _saved[key] = SavedState(len(messages), bucket_digests(messages), details)
+        _saved.move_to_end(key)
+        if len(_saved) > SAVED_SESSIONS:
+            _saved.popitem(last=False)
+
+    return len(messages) - start
+
+
+def list_conversations(user_id: str, page: int = 0, page_size: int = 20) -> list:
+    '''
+    List a user's saved conversations, newest first, without their messages.
+
+    Args:
+        user_id (str): The user id
+        page (int): The page number, starting at 0
+        page_size (int): The number of conversations per page
+    Returns:
+        list: The conversation summaries
+    '''
+    return get_backend().find_conversations(user_id, SUMMARY_FIELDS, page, page_size)
+
+
+def load_messages(user_id: str, session_id: str, page: int = None, buckets_per_page: int = 1) -> list:
+    '''
+    Load the messages of a saved conversation.
+
+    Args:
+        user_id (str): The user id
+        session_id (str): The session id
+        page (int): Only load this page of buckets. Loads every message if None
+        buckets_per_page (int): The number of buckets per page
+    Returns:
+        list: The messages, in order
+    '''
+    if page is None:
+        return get_backend().find_messages(user_id, session_id)
+    return get_backend().find_messages(user_id, session_id, page * buckets_per_page, buckets_per_page)
+
+
+def migrate_embedded_conversations():
+    '''
+    Move conversations embedded in user documents (the old format) into the conversations collection.
+    Only needed on MongoDB, the old format was never stored in SQLite.
+
+    Returns:
+        int: The number of users migrated
+    '''
+    users = get_users_collection()
+    migrated = 0
+
+    for user in users.find({'conversations': {'$exists': True}}, projection={'user_id': 1, 'conversations': 1}):
+        for conversation in user['conversations']:
+            # The old format stored the role under "user"
+            messages = [{'role': m['user'], 'content': m['content']} for m in conversation['messages']]
+            save_conversation(user['user_id'], conversation['session'], messages)
+
+        # Make sure the conversations are stored before removing them from the user
+        persistence.flush()
+        users.update_one({'user_id': user['user_id']}, {'$unset': {'conversations': ''}})
+        migrated += 1
+
+    return migrated
@@ -0,0 +1,87 @@
+# This file contains the shared MongoDB connection used by the chat application.
+
+import threading
+
+from pymongo import MongoClient
+
+# Using dotenv to load environment variables, development only
+# from dotenv import load_dotenv
+# load_dotenv()
+
+# Using config.py to load environment variables, production
+import config
+
+
+DATABASE_NAME = 'openai-app'
+
+# Connection pool settings. Can be overridden in config.py
+MAX_POOL_SIZE = getattr(config, 'MONGO_MAX_POOL_SIZE', 20)
+MIN_POOL_SIZE = getattr(config, 'MONGO_MIN_POOL_SIZE', 0)
+SERVER_SELECTION_TIMEOUT_MS = getattr(config, 'MONGO_SERVER_SELECTION_TIMEOUT_MS', 5000)
+CONNECT_TIMEOUT_MS = getattr(config, 'MONGO_CONNECT_TIMEOUT_MS', 5000)
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_client() -> MongoClient:
+    '''
+    Get the process-wide MongoDB client, creating it on first use.
+
+    MongoClient connects in the background, so creating it is cheap. The DNS/SRV lookup and
+    handshake happen on the first operation, or earlier if the storage backend was warmed up.
+
+    Returns:
+        MongoClient: The shared client
+    '''
+    global _client
+
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                # atlas_url = os.getenv('ATLAS_URI') #! Development only, use config.py for production
+                _client = MongoClient(
+                    config.ATLAS_URI,
+                    maxPoolSize=MAX_POOL_SIZE,
+                    minPoolSize=MIN_POOL_SIZE,
+                    serverSelectionTimeoutMS=SERVER_SELECTION_TIMEOUT_MS,
+                    connectTimeoutMS=CONNECT_TIMEOUT_MS,
+                )
+
+    return _client
+
+
+def get_database():
+    '''
+    Get the application database.
+    '''
+    return get_client()[DATABASE_NAME]
+
+
+def get_collection(name: str):
+    '''
+    Get a collection from the application database.
+
+    Args:
+        name (str): The collection name
+    '''
+    return get_database()[name]
+
+
+def get_users_collection():
+    '''
+    Get the users collection.
+    '''
+    return get_collection('users')
+
+
+def close_client():
+    '''
+    Close the shared client, if it was created.
+    '''
+    global _client
+
+    with _client_lock:
+        if _client is not None:
+            _client.close()
+            _client = None
@@ -15,4 +15,12 @@ class ModelNotFound(Exception):
     '''
     def __init__(self, message):
         super().__init__(message)
-        self.message = message
\ No newline at end of file
+        self.message = message
+
+class CircuitOpen(ChatError):
+    '''
+    Raised when requests are not sent because the API has failed too many times in a row.
+    '''
+    def __init__(self, message, retry_in):
+        super().__init__(message)
+        self.retry_in = retry_in
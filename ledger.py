@@ -0,0 +1,97 @@
+# This file contains the balance ledger: atomic reservations and settlements of user balances.
+
+from datetime import datetime
+
+from persistence import persistence
+from storage import get_backend
+
+
+def reserve(user_id: str, amount: float):
+    '''
+    Reserve an amount from the user's balance before a request is sent.
+
+    The balance check and the deduction happen in one atomic update, so concurrent sessions for the
+    same user can never take the balance below zero. This is the only ledger write the chat waits for.
+
+    Args:
+        user_id (str): The user id
+        amount (float): The maximum cost of the request
+    Returns:
+        float: The balance after the reservation, or None if the balance is insufficient
+    '''
+    balance = get_backend().reserve_balance(user_id, amount)
+
+    if balance is None and persistence.has_pending():
+        # Refunds from earlier settlements may still be queued, apply them and try again
+        persistence.flush()
+        balance = get_backend().reserve_balance(user_id, amount)
+
+    return balance
+
+
+def refund(user_id: str, amount: float):
+    '''
+    Return an amount to the balance. Negative when a cost exceeded its reservation.
+
+    Refunds are written now rather than queued: the next reservation reads the balance from the
+    database, and a queued refund would be missing from it, or lost if the process stopped before
+    the next flush.
+    '''
+    persistence.write_now('users', {'user_id': user_id}, {'$inc': {'balance': amount}})
+
+
+def release(user_id: str, amount: float):
+    '''
+    Give back a reservation that was not used, e.g. because the request failed.
+
+    Args:
+        user_id (str): The user id
+        amount (float): The reserved amount
+    '''
+    refund(user_id, amount)
+
+
+def usage_event(user_id: str, cost: float, reserved: float, details: dict = None) -> dict:
+    '''
+    Build a usage event for the ledger.
+
+    Args:
+        user_id (str): The user id
+        cost (float): The actual cost of the request
+        reserved (float): The amount that was reserved for the request
+        details (dict): Extra details, e.g. model, session id and token usage
+    '''
+    event = {
+        'user_id': user_id,
+        'cost': cost,
+        'reserved': reserved,
+        'time': datetime.now(),
+    }
+    if details:
+        event.update(details)
+    return event
+
+
+def settle(user_id: str, reserved: float, cost: float, details: dict = None):
+    '''
+    Settle a reservation once the actual cost is known from the response usage.
+
+    The unused part of the reservation is returned to the balance with a $inc, see refund(), and the
+    usage is recorded as an append-only event, queued and written in the background.
+
+    Streamed costs are estimated, and can exceed the reservation. The whole cost is still charged, so
+    the balance can end up below zero by the overage, and the event records it as "overage". The next
+    reservation fails until the balance covers it again.
+
+    Args:
+        user_id (str): The user id
+        reserved (float): The amount that was reserved for the request
+        cost (float): The actual cost of the request
+        details (dict): Extra details for the usage event
+    '''
+    refund(user_id, round(reserved - cost, 8))
+
+    event = usage_event(user_id, cost, reserved, details)
+    if cost > reserved:
+        event['overage'] = round(cost - reserved, 8)
+    persistence.insert('usage_events', event)
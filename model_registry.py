@@ -0,0 +1,153 @@
+# This file contains the in-memory model registry used by the chat application.
+
+import json
+import os
+import threading
+import time
+
+from exceptions import ModelNotFound
+
+
+MODELS_FILE = 'models.json'
+
+
+class ModelRegistry:
+    '''
+    Loaded-once view of the models.json file.
+
+    Models are indexed by id for O(1) lookup, and by family so that model ids returned by the API
+    (e.g. "gpt-3.5-turbo-0301") can be resolved to a known model without scanning the whole list.
+    The file is reloaded when its modification time changes.
+    '''
+    def __init__(self, path=MODELS_FILE, check_interval=1.0):
+        self.path = path
+        self.check_interval = check_interval    # Minimum number of seconds between mtime checks
+        self._lock = threading.Lock()
+        self._mtime = None
+        self._last_check = 0.0
+        self._models = []
+        self._by_id = {}
+        self._by_family = {}
+        self._family_lengths = []
+        self._resolved = {}
+
+    def _load(self):
+        '''
+        Parse the models file and rebuild the indexes.
+        '''
+        mtime = os.stat(self.path).st_mtime
+
+        with open(self.path) as f:
+            models_json = json.load(f)
+
+        models = models_json['models']
+        by_id = {m['id']: m for m in models}
+
+        # First model listed for a family wins, same as the previous linear scan
+        by_family = {}
+        for m in models:
+            by_family.setdefault(m['family'], m)
+
+        # Longest families are tried first so the most specific match wins
+        family_lengths = sorted({len(family) for family in by_family}, reverse=True)
+
+        self._models = models
+        self._by_id = by_id
+        self._by_family = by_family
+        self._family_lengths = family_lengths
+        self._resolved = {}
+        self._mtime = mtime
+
+    def _refresh(self):
+        '''
+        Load the models file on first use, and reload it if it changed on disk.
+        '''
+        now = time.monotonic()
+        if self._mtime is not None and now - self._last_check < self.check_interval:
+            return
+
+        with self._lock:
+            if self._mtime is not None and now - self._last_check < self.check_interval:
+                return
+            self._last_check = now
+            if self._mtime is None:
+                # Nothing to fall back on, a missing or invalid file is an error
+                self._load()
+                return
+
+            # Keep serving the last good copy if the file is temporarily missing, or read while it
+            # is being written. The mtime is only updated by a successful load, so it is retried
+            try:
+                if os.stat(self.path).st_mtime != self._mtime:
+                    self._load()
+            except (OSError, ValueError, KeyError, TypeError):
+                pass
+
+    def models(self):
+        '''
+        Return the list of model entries.
+        '''
+        self._refresh()
+        return self._models
+
+    def ids(self):
+        '''
+        Return the list of model ids.
+        '''
+        return [m['id'] for m in self.models()]
+
+    def display_names(self):
+        '''
+        Return the list of model display names.
+        '''
+        return [m['display'] for m in self.models()]
+
+    def __contains__(self, model_id):
+        self._refresh()
+        return model_id in self._by_id
+
+    def get(self, model_id):
+        '''
+        Get a model entry by id, falling back to the model family.
+
+        Args:
+            model_id (str): The model id, as selected by the user or returned by the API
+        Returns:
+            dict: The model entry
+        Raises:
+            ModelNotFound: If neither the id nor its family is known
+        '''
+        self._refresh()
+
+        model = self._by_id.get(model_id)
+        if model is not None:
+            return model
+
+        # Resolved family lookups are cached until the next reload
+        model = self._resolved.get(model_id)
+        if model is not None:
+            return model
+
+        for length in self._family_lengths:
+            model = self._by_family.get(model_id[:length])
+            if model is not None:
+                self._resolved[model_id] = model
+                return model
+
+        raise ModelNotFound(f"Error: Model ({model_id}) not found.")
+
+    def cost(self, model_id, num_of_tokens):
+        '''
+        Calculate the cost of a number of tokens for a model.
+
+        Args:
+            model_id (str): The model id
+            num_of_tokens (int): The number of tokens
+        Returns:
+            float: The cost, rounded to 8 decimal places
+        '''
+        return round(num_of_tokens * self.get(model_id)['cpt'], 8)
+
+
+# Shared registry for the application
+registry = ModelRegistry()
@@ -0,0 +1,269 @@
+# This file contains the write-behind queue that keeps database writes off the chat path.
+
+import atexit
+import os
+import threading
+
+from bson import json_util
+
+from storage import get_backend
+
+# Using config.py to load environment variables, production
+import config
+
+
+FLUSH_INTERVAL = getattr(config, 'PERSISTENCE_FLUSH_INTERVAL', 1.0)     # Seconds between flushes
+MAX_PENDING = getattr(config, 'PERSISTENCE_MAX_PENDING', 100)           # Flush early once this many writes are queued
+JOURNAL_PATH = getattr(config, 'PERSISTENCE_JOURNAL', 'persistence_journal.jsonl')
+REJECTED_PATH = getattr(config, 'PERSISTENCE_REJECTED', 'persistence_rejected.jsonl')    # Writes the database refused
+
+# Update operators that can be merged into a pending update of the same document
+MERGEABLE_OPERATORS = ('$set', '$setOnInsert', '$inc', '$push')
+
+
+def _merge(pending: dict, update: dict) -> bool:
+    '''
+    Merge an update into a pending update of the same document.
+
+    Returns:
+        bool: False if the updates touch the same field in different ways and can't be merged
+    '''
+    if any(operator not in MERGEABLE_OPERATORS for operator in list(pending) + list(update)):
+        return False
+
+    for operator, fields in update.items():
+        for field, value in fields.items():
+            other = [op for op in pending if op != operator and field in pending[op]]
+            if other:
+                return False
+
+    for operator, fields in update.items():
+        target = pending.setdefault(operator, {})
+        for field, value in fields.items():
+            if operator == '$inc':
+                target[field] = target.get(field, 0) + value
+            elif operator == '$push':
+                values = value['$each'] if isinstance(value, dict) and '$each' in value else [value]
+                target.setdefault(field, {'$each': []})['$each'].extend(values)
+            elif operator == '$setOnInsert':
+                # Only the first insert counts
+                target.setdefault(field, value)
+            else:
+                target[field] = value
+
+    return True
+
+
+class PersistenceQueue:
+    '''
+    Background worker that coalesces writes and flushes them to the storage backend in batches.
+
+    Updates to the same document are merged ($inc values are summed, the last $set wins, $push values
+    are appended) until the next flush, which happens every flush_interval seconds or as soon as
+    max_pending writes are queued. If the database can't be reached, the writes are appended to a
+    local journal file and replayed on the next successful flush. Writes the database rejects, e.g.
+    duplicate keys, would fail again on every replay, so they are moved to a separate file instead.
+    '''
+    def __init__(self, flush_interval=FLUSH_INTERVAL, max_pending=MAX_PENDING, journal_path=JOURNAL_PATH,
+                 rejected_path=REJECTED_PATH):
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.journal_path = journal_path
+        self.rejected_path = rejected_path
+        self._pending = []          # [collection, kind, filter, document, upsert] in arrival order
+        self._updates = {}          # (collection, filter) -> pending update entry
+        self._count = 0
+        self._condition = threading.Condition()
+        self._flush_lock = threading.Lock()
+        self._thread = None
+        self._closed = False
+
+    def _start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='persistence', daemon=True)
+            self._thread.start()
+            atexit.register(self.close)
+
+    def _add(self, collection, kind, filter, document, upsert=False):
+        with self._condition:
+            self._start()
+
+            key = (collection, json_util.dumps(filter, sort_keys=True)) if kind == 'update' else None
+            entry = self._updates.get(key) if key else None
+            if entry is not None and _merge(entry[3], document):
+                entry[4] = entry[4] or upsert
+            else:
+                entry = [collection, kind, filter, document, upsert]
+                self._pending.append(entry)
+                if key:
+                    self._updates[key] = entry
+
+            self._count += 1
+            if self._count >= self.max_pending:
+                self._condition.notify()
+
+    def update(self, collection: str, filter: dict, update: dict, upsert: bool = False):
+        '''
+        Queue an update of a single document.
+
+        Args:
+            collection (str): The collection name
+            filter (dict): Identifies the document, e.g. {'user_id': ...}
+            update (dict): The update, using $set, $setOnInsert, $inc or $push
+            upsert (bool): Insert the document if it does not exist
+        '''
+        # Copy, since pending updates are merged in place
+        update = {operator: dict(fields) for operator, fields in update.items()}
+        self._add(collection, 'update', filter, update, upsert)
+
+    def write_now(self, collection: str, filter: dict, update: dict, upsert: bool = False):
+        '''
+        Write an update of a single document now, without queueing it. Blocks until done.
+
+        For writes that must not wait for the next flush. If the database can't be reached, the update
+        is journaled and replayed like any queued write.
+        '''
+        entry = [collection, 'update', filter, update, upsert]
+        # Holds the flush lock, so a replay can't remove the journal while the entry is being added
+        with self._flush_lock:
+            failed = self._write([entry])
+            if failed:
+                print(f"Warning: Could not reach the database. 1 write saved to {self.journal_path}")
+                self._spill(failed)
+
+    def insert(self, collection: str, document: dict):
+        '''
+        Queue an insert.
+        '''
+        self._add(collection, 'insert', None, document)
+
+    def has_pending(self) -> bool:
+        '''
+        Check if there are writes that were not flushed yet.
+        '''
+        return self._count > 0 or os.path.exists(self.journal_path)
+
+    def _take(self):
+        with self._condition:
+            pending = self._pending
+            self._pending = []
+            self._updates = {}
+            self._count = 0
+        return pending
+
+    def _write(self, entries):
+        '''
+        Write entries through the storage backend, e.g. one bulk_write per collection on MongoDB.
+        Rejected writes are set aside.
+
+        Returns:
+            list: The entries that could not be written because the database could not be reached
+        '''
+        failed, rejected = get_backend().write(entries)
+        if rejected:
+            print(f"Warning: The database rejected {len(rejected)} writes ({rejected[0][1]}). Saved to {self.rejected_path}")
+            with open(self.rejected_path, 'a') as f:
+                for entry, error in rejected:
+                    f.write(json_util.dumps(dict(self._record(entry), error=error)) + '\n')
+        return failed
+
+    @staticmethod
+    def _record(entry) -> dict:
+        collection, kind, filter, document, upsert = entry
+        return {'collection': collection, 'kind': kind, 'filter': filter, 'document': document, 'upsert': upsert}
+
+    def _spill(self, entries):
+        with open(self.journal_path, 'a') as f:
+            for entry in entries:
+                f.write(json_util.dumps(self._record(entry)) + '\n')
+
+    def _replay(self) -> bool:
+        '''
+        Write the journaled entries from an earlier outage. Returns True if the journal is now empty.
+        '''
+        if not os.path.exists(self.journal_path):
+            return True
+
+        with open(self.journal_path) as f:
+            entries = []
+            for line in f:
+                if not line.strip():
+                    continue
+                try:
+                    record = json_util.loads(line)
+                    entries.append([record['collection'], record['kind'], record['filter'], record['document'], record.get('upsert', False)])
+                except (ValueError, KeyError, TypeError) as e:
+                    # A damaged line would block the journal forever, set it aside
+                    print(f"Warning: Unreadable journal entry. Saved to {self.rejected_path}")
+                    with open(self.rejected_path, 'a') as rejected:
+                        rejected.write(json_util.dumps({'journal_line': line, 'error': str(e)}) + '\n')
+
+        failed = self._write(entries)
+        os.remove(self.journal_path)
+        if failed:
+            self._spill(failed)
+            return False
+        return True
+
+    def flush(self):
+        '''
+        Write everything that is queued now. Blocks until done.
+        '''
+        with self._flush_lock:
+            pending = self._take()
+
+            # Keep the original order: older journaled writes go first. The journal is only removed
+            # once it was written, so an error leaves it in place
+            try:
+                replayed = self._replay()
+            except Exception as e:
+                print(f"Warning: Could not replay {self.journal_path} ({e!r})")
+                replayed = False
+            if not replayed:
+                if pending:
+                    self._spill(pending)
+                return
+
+            if pending:
+                try:
+                    failed = self._write(pending)
+                except Exception as e:
+                    # Unexpected errors must not lose the batch, it is kept for the next flush
+                    print(f"Warning: Could not write to the database ({e!r})")
+                    failed = pending
+                if failed:
+                    print(f"Warning: {len(failed)} writes saved to {self.journal_path}")
+                    self._spill(failed)
+
+    def _run(self):
+        while True:
+            with self._condition:
+                if self._count < self.max_pending and not self._closed:
+                    self._condition.wait(self.flush_interval)
+                closed = self._closed
+            try:
+                self.flush()
+            except Exception as e:
+                # Keep the worker alive, or nothing would be written until exit
+                print(f"Warning: Background flush failed ({e!r})")
+            if closed:
+                return
+
+    def close(self):
+        '''
+        Flush the queue and stop the worker. Used on application exit.
+        '''
+        with self._condition:
+            if self._closed:
+                return
+            self._closed = True
+            self._condition.notify()
+
+        if self._thread is not None:
+            self._thread.join()
+        else:
+            self.flush()
+
+
+# Shared queue for the application
+persistence = PersistenceQueue()
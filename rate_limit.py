@@ -0,0 +1,142 @@
+# This file contains the client-side rate limiter used to stay under the API's rate limits.
+
+import asyncio
+import threading
+import time
+
+from model_registry import registry
+from tokens import count_message_tokens
+
+
+# Used for models without "rpm"/"tpm" entries in models.json
+DEFAULT_RPM = 3000
+DEFAULT_TPM = 250000
+
+
+class TokenBucket:
+    '''
+    Thread-safe token bucket that refills continuously up to its capacity.
+
+    Callers reserve capacity up front and are told how long to wait for it. Reservations are
+    allowed to take the bucket negative, so waiting callers are served in the order they arrived
+    and nobody is starved by a stream of smaller requests.
+    '''
+    def __init__(self, capacity: float, per_seconds: float = 60.0):
+        self.capacity = capacity
+        self.rate = capacity / per_seconds     # Tokens added per second
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self, amount: float) -> float:
+        '''
+        Take capacity from the bucket.
+
+        Args:
+            amount (float): The capacity to take. Clamped to the bucket size so large requests can still run
+        Returns:
+            float: The number of seconds to wait before using the capacity
+        '''
+        amount = min(amount, self.capacity)
+        with self._lock:
+            self._refill(time.monotonic())
+            self.tokens -= amount
+            if self.tokens >= 0:
+                return 0.0
+            return -self.tokens / self.rate
+
+    def release(self, amount: float):
+        '''
+        Give back capacity that was reserved but not used.
+        '''
+        with self._lock:
+            self._refill(time.monotonic())
+            self.tokens = min(self.capacity, self.tokens + amount)
+
+
+class ModelRateLimiter:
+    '''
+    Requests per minute and tokens per minute limits for a single model.
+    '''
+    def __init__(self, rpm: int, tpm: int):
+        self.requests = TokenBucket(rpm)
+        self.tokens = TokenBucket(tpm)
+
+    def _reserve(self, num_of_tokens: int) -> float:
+        # Wait for whichever limit is further away
+        return max(self.requests.reserve(1), self.tokens.reserve(num_of_tokens))
+
+    def acquire(self, num_of_tokens: int):
+        '''
+        Block the calling thread until there is capacity for a request.
+
+        Args:
+            num_of_tokens (int): The estimated number of tokens for the request
+        '''
+        wait = self._reserve(num_of_tokens)
+        if wait > 0:
+            time.sleep(wait)
+
+    async def acquire_async(self, num_of_tokens: int):
+        '''
+        Wait without blocking the event loop until there is capacity for a request.
+
+        Args:
+            num_of_tokens (int): The estimated number of tokens for the request
+        '''
+        wait = self._reserve(num_of_tokens)
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+    def release(self, num_of_tokens: int):
+        '''
+        Give back the tokens of a request that failed before using them, e.g. rejected with a 429.
+        The request itself still counts against the requests per minute limit.
+        '''
+        self.tokens.release(num_of_tokens)
+
+    def settle(self, estimated_tokens: int, actual_tokens: int):
+        '''
+        Return the difference between the estimated and actual token usage to the bucket.
+        '''
+        if actual_tokens < estimated_tokens:
+            self.tokens.release(estimated_tokens - actual_tokens)
+
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+
+def get_limiter(model: str) -> ModelRateLimiter:
+    '''
+    Get the shared rate limiter for a model. Model ids returned by the API share the limiter of
+    the model they resolve to in models.json.
+
+    Args:
+        model (str): The model id
+    Returns:
+        ModelRateLimiter: The limiter, shared by every thread and task in the process
+    '''
+    entry = registry.get(model)
+    model_id = entry['id']
+
+    limiter = _limiters.get(model_id)
+    if limiter is None:
+        with _limiters_lock:
+            limiter = _limiters.get(model_id)
+            if limiter is None:
+                limiter = ModelRateLimiter(entry.get('rpm', DEFAULT_RPM), entry.get('tpm', DEFAULT_TPM))
+                _limiters[model_id] = limiter
+
+    return limiter
+
+
+def estimate_request_tokens(request: dict) -> int:
+    '''
+    Estimate the tokens a request counts against the limit: the prompt plus max_tokens.
+    '''
+    return count_message_tokens(request['messages']) + request.get('max_tokens', 0)
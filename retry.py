@@ -0,0 +1,190 @@
+# This file contains the retry policy and circuit breaker used when calling the API.
+
+import asyncio
+import random
+import threading
+import time
+
+import openai
+
+from exceptions import CircuitOpen
+
+
+# Errors that are worth retrying: the same request may succeed a moment later
+TRANSIENT_ERRORS = (
+    openai.error.Timeout,
+    openai.error.APIConnectionError,
+    openai.error.RateLimitError,
+    openai.error.ServiceUnavailableError,
+    openai.error.TryAgain,
+)
+
+
+def is_transient(error: Exception) -> bool:
+    '''
+    Check if an API error is transient (timeouts, 429, 5xx) rather than permanent (bad request, auth).
+    '''
+    if isinstance(error, TRANSIENT_ERRORS):
+        return True
+    if isinstance(error, (TimeoutError, ConnectionError, asyncio.TimeoutError)):
+        return True
+
+    status = getattr(error, 'http_status', None)
+    return status is not None and (status == 429 or status >= 500)
+
+
+def get_retry_after(error: Exception):
+    '''
+    Get the number of seconds the API asked us to wait, from the Retry-After header.
+
+    Returns:
+        float: The number of seconds, or None if the header is missing or not a number
+    '''
+    headers = getattr(error, 'headers', None) or {}
+    value = headers.get('retry-after') or headers.get('Retry-After')
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+class RetryPolicy:
+    '''
+    Exponential backoff with full jitter, capped at max_delay.
+    '''
+    def __init__(self, max_attempts: int = 4, base_delay: float = 0.5, max_delay: float = 20.0):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    def delay(self, attempt: int, error: Exception) -> float:
+        '''
+        Get the number of seconds to wait before the next attempt.
+
+        Args:
+            attempt (int): The number of the attempt that failed, starting at 1
+            error (Exception): The error that caused the attempt to fail
+        '''
+        delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** (attempt - 1)))
+
+        # Never retry sooner than the API asked us to
+        retry_after = get_retry_after(error)
+        if retry_after is not None:
+            delay = max(delay, min(retry_after, self.max_delay))
+
+        return delay
+
+
+class CircuitBreaker:
+    '''
+    Stops sending requests after repeated failures, so callers fail fast instead of piling up.
+
+    After failure_threshold consecutive failures the circuit opens for reset_timeout seconds. Then a
+    single trial request is let through: if it succeeds the circuit closes, otherwise it opens again.
+    '''
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.trial_in_progress = False
+        self._lock = threading.Lock()
+
+    def before_request(self):
+        '''
+        Check that a request may be sent.
+
+        Raises:
+            CircuitOpen: If the circuit is open
+        '''
+        with self._lock:
+            if self.opened_at is None:
+                return
+
+            retry_in = self.opened_at + self.reset_timeout - time.monotonic()
+            if retry_in > 0 or self.trial_in_progress:
+                raise CircuitOpen(
+                    f"Error: The API is currently unavailable. Please try again in {max(retry_in, 1):.0f} seconds.",
+                    retry_in=max(retry_in, 0)
+                )
+
+            # Half-open: let one trial request through
+            self.trial_in_progress = True
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self.trial_in_progress = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.trial_in_progress or self.failures >= self.failure_threshold:
+                self.opened_at = time.monotonic()
+            self.trial_in_progress = False
+
+
+# Shared by every session in the process, since provider outages affect all of them
+default_policy = RetryPolicy()
+api_breaker = CircuitBreaker()
+
+
+def call_with_retry(send, policy: RetryPolicy = default_policy, breaker: CircuitBreaker = api_breaker, can_retry=None):
+    '''
+    Call send() until it succeeds, retrying transient errors.
+
+    Args:
+        send (callable): Sends the request and returns the response
+        policy (RetryPolicy): How many times and how long to wait between attempts
+        breaker (CircuitBreaker): Shared circuit breaker
+        can_retry (callable): Optional check that it is still safe to retry, e.g. nothing was streamed yet
+    Returns:
+        The response
+    Raises:
+        CircuitOpen: If the circuit is open
+        Exception: The last error, if it was permanent or the attempts ran out
+    '''
+    attempt = 0
+    while True:
+        attempt += 1
+        breaker.before_request()
+        try:
+            response = send()
+        except Exception as e:
+            transient = is_transient(e)
+            if transient:
+                breaker.record_failure()
+            else:
+                # The API answered, so it is up. The request itself is at fault
+                breaker.record_success()
+            if not transient or attempt >= policy.max_attempts or (can_retry and not can_retry()):
+                raise
+            time.sleep(policy.delay(attempt, e))
+        else:
+            breaker.record_success()
+            return response
+
+
+async def acall_with_retry(send, policy: RetryPolicy = default_policy, breaker: CircuitBreaker = api_breaker, can_retry=None):
+    '''
+    Async version of call_with_retry(). send() returns an awaitable.
+    '''
+    attempt = 0
+    while True:
+        attempt += 1
+        breaker.before_request()
+        try:
+            response = await send()
+        except Exception as e:
+            transient = is_transient(e)
+            if transient:
+                breaker.record_failure()
+            else:
+                breaker.record_success()
+            if not transient or attempt >= policy.max_attempts or (can_retry and not can_retry()):
+                raise
+            await asyncio.sleep(policy.delay(attempt, e))
+        else:
+            breaker.record_success()
+            return response
@@ -0,0 +1,399 @@
+# This file contains the HTTP chat service: one process serving many users and sessions on a single event loop.
+
+import argparse
+import asyncio
+import json
+import time
+import uuid
+
+import openai
+
+from aiohttp import ClientSession, ClientTimeout, TCPConnector, web
+from datetime import datetime
+
+import auth
+import conversations
+
+from chat_engine import aconverse_turn
+from chat_settings import ChatSettings
+from context import ContextWindow
+from conversation import Conversation
+from exceptions import ChatError, CircuitOpen, ModelNotFound
+from model_registry import registry
+from persistence import persistence
+from storage import get_backend
+from users import User, ensure_indexes
+
+# Using config.py to load environment variables, production
+import config
+
+
+openai.api_key = config.API_KEY
+
+SERVER_HOST = getattr(config, 'SERVER_HOST', '127.0.0.1')
+SERVER_PORT = getattr(config, 'SERVER_PORT', 8080)
+SESSION_IDLE_TIMEOUT = getattr(config, 'SERVER_SESSION_IDLE_TIMEOUT', 30 * 60)     # Seconds before an idle chat session is dropped
+MAX_SESSIONS_PER_USER = getattr(config, 'SERVER_MAX_SESSIONS_PER_USER', 10)
+HTTP_POOL_SIZE = getattr(config, 'SERVER_HTTP_POOL_SIZE', 100)                     # Connections to the OpenAI API, shared by all sessions
+
+# Routes that don't need a session token
+PUBLIC_ROUTES = {('POST', '/login'), ('GET', '/models')}
+
+
+def json_error(status: int, message: str):
+    '''
+    Build an HTTP error with a JSON body, to raise from a handler.
+    '''
+    error_class = {
+        400: web.HTTPBadRequest, 401: web.HTTPUnauthorized, 402: web.HTTPPaymentRequired,
+        404: web.HTTPNotFound, 409: web.HTTPConflict, 429: web.HTTPTooManyRequests,
+        502: web.HTTPBadGateway, 503: web.HTTPServiceUnavailable,
+    }[status]
+    return error_class(text=json.dumps({'error': message}), content_type='application/json')
+
+
+def validate_settings(settings: ChatSettings, changes: dict) -> ChatSettings:
+    '''
+    Apply a client's setting changes. The settings are immutable, so this returns new settings.
+
+    Raises:
+        web.HTTPBadRequest: If a setting is unknown or invalid
+    '''
+    try:
+        return settings.replace(**changes)
+    except ValueError as e:
+        raise json_error(400, str(e))
+
+
+class ChatSession:
+    '''
+    A conversation held in memory by the server, owned by one user.
+
+    Every session has its own immutable settings, conversation and context window, so sessions never
+    share request state. Only one turn runs at a time in a session.
+    '''
+    __slots__ = ('id', 'user', 'settings', 'conversation', 'context', 'details', 'lock', 'last_used')
+
+    def __init__(self, user: User, settings: ChatSettings, session_id: str = None, messages: list = None):
+        # A session that continues a saved conversation keeps its id, so saves update the same conversation
+        self.id = session_id or str(uuid.uuid4())
+        self.user = user
+        self.settings = settings
+        self.conversation = Conversation(messages)
+        self.context = ContextWindow()
+        self.lock = asyncio.Lock()
+        self.last_used = time.monotonic()
+        self.details = {
+            'id': self.id,
+            'user': user.username,
+            'model': settings.model,
+            'start_time': datetime.now().isoformat(),
+            'end_time': None,
+            'num_of_requests': 0,
+            'expense': 0.00,
+            'turns': [],
+            'cache_hits': 0,
+        }
+
+    def summary(self) -> dict:
+        return {
+            'session_id': self.id,
+            'settings': self.settings.as_dict(),
+            'messages': len(self.conversation),
+            'num_of_requests': self.details['num_of_requests'],
+            'expense': self.details['expense'],
+        }
+
+
+def get_session(request) -> ChatSession:
+    '''
+    Get the chat session named in the URL, if it belongs to the authenticated user.
+    '''
+    session = request.app['sessions'].get(request.match_info['session_id'])
+    if session is None or session.user.user_id != request['user_id']:
+        raise json_error(404, "Session not found.")
+    session.last_used = time.monotonic()
+    return session
+
+
+async def read_json(request) -> dict:
+    if not request.can_read_body:
+        return {}
+    try:
+        body = await request.json()
+    except json.JSONDecodeError:
+        raise json_error(400, "Invalid JSON body.")
+    if not isinstance(body, dict):
+        raise json_error(400, "Invalid JSON body.")
+    return body
+
+
+@web.middleware
+async def auth_middleware(request, handler):
+    '''
+    Check the session token, and send API calls through the shared HTTP pool.
+    '''
+    # openai reads the session from a context variable, set for every request task
+    openai.aiosession.set(request.app['openai_session'])
+
+    if (request.method, request.path) not in PUBLIC_ROUTES:
+        header = request.headers.get('Authorization', '')
+        token = header[len('Bearer '):] if header.startswith('Bearer ') else None
+        user_id = auth.verify_token(token) if token else None
+        if user_id is None:
+            raise json_error(401, "Missing or expired token.")
+        request['user_id'] = user_id
+        request['token'] = token
+
+    return await handler(request)
+
+
+async def login(request):
+    body = await read_json(request)
+    username, password = body.get('username'), body.get('password')
+    if not username or not password:
+        raise json_error(400, "Missing username or password.")
+
+    # The database lookup runs in a worker thread, the bcrypt check in the bounded bcrypt pool
+    user = await User.aauthenticate(username, password)
+    if user is None:
+        raise json_error(401, "Invalid username or password.")
+
+    return web.json_response({
+        'token': user.issue_token(),
+        'expires_in': auth.SESSION_TTL,
+        'user': {'username': user.username, 'role': user.role, 'balance': user.balance},
+    })
+
+
+async def list_models(request):
+    return web.json_response([{'id': model['id'], 'display': model['display']} for model in registry.models()])
+
+
+async def create_session(request):
+    body = await read_json(request)
+    sessions = request.app['sessions']
+
+    owned = sum(1 for session in sessions.values() if session.user.user_id == request['user_id'])
+    if owned >= MAX_SESSIONS_PER_USER:
+        raise json_error(429, f"Too many open sessions (maximum {MAX_SESSIONS_PER_USER}).")
+
+    # "conversation" names a saved conversation to continue, everything else is a setting
+    saved_id = body.pop('conversation', None)
+    if saved_id is not None and not isinstance(saved_id, str):
+        raise json_error(400, "Invalid conversation.")
+    settings = validate_settings(ChatSettings(), body)
+
+    user = await asyncio.to_thread(User.from_token, request['token'])
+    if user is None:
+        raise json_error(401, "User not found.")
+
+    messages = None
+    if saved_id is not None:
+        if saved_id in sessions:
+            raise json_error(409, "The conversation is already open in a session.")
+        messages = await asyncio.to_thread(user.get_conversation_messages, saved_id)
+        if not messages:
+            raise json_error(404, "Conversation not found.")
+
+    session = ChatSession(user, settings, saved_id, messages)
+    sessions[session.id] = session
+    return web.json_response(session.summary(), status=201)
+
+
+async def update_session(request):
+    session = get_session(request)
+    session.settings = validate_settings(session.settings, await read_json(request))
+    session.details['model'] = session.settings.model
+    return web.json_response(session.summary())
+
+
+async def end_session(request):
+    session = get_session(request)
+    session.details['end_time'] = datetime.now().isoformat()
+    del request.app['sessions'][session.id]
+    return web.json_response(session.details)
+
+
+def sse(event: str, data) -> bytes:
+    '''
+    Encode a server-sent event.
+    '''
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n".encode('utf-8')
+
+
+async def run_turn(session: ChatSession, prompt: str, settings: ChatSettings, on_delta=None) -> dict:
+    '''
+    Run one conversation turn and describe the result.
+
+    Raises:
+        web.HTTPException: If the balance is too low or the API call failed
+    '''
+    expense = session.details['expense']
+    try:
+        answer = await aconverse_turn(
+            session.user, session.conversation, session.details, prompt, settings, on_delta, session.context
+        )
+    except CircuitOpen as e:
+        raise json_error(503, e.message)
+    except ChatError as e:
+        raise json_error(502, e.message)
+    except ModelNotFound:
+        raise json_error(400, f"Invalid model name ({settings.model}).")
+
+    if answer is None:
+        raise json_error(402, "Insufficient balance.")
+
+    return {
+        'answer': answer,
+        'cost': round(session.details['expense'] - expense, 8),
+        'balance': session.user.balance,
+        'timing': session.details['turns'][-1],
+    }
+
+
+async def chat(request):
+    session = get_session(request)
+    body = await read_json(request)
+
+    prompt = body.pop('prompt', None)
+    if not prompt or not isinstance(prompt, str):
+        raise json_error(400, "Missing prompt.")
+
+    # Overrides apply to this request only
+    settings = validate_settings(session.settings, body)
+
+    if session.lock.locked():
+        raise json_error(409, "A request is already running in this session.")
+
+    async with session.lock:
+        if not settings.stream:
+            return web.json_response(await run_turn(session, prompt, settings))
+
+        response = web.StreamResponse(headers={'Content-Type': 'text/event-stream', 'Cache-Control': 'no-cache'})
+        await response.prepare(request)
+
+        # The engine reports content synchronously, the queue hands it to the writer without blocking the stream
+        deltas = asyncio.Queue()
+
+        async def forward():
+            while (content := await deltas.get()) is not None:
+                await response.write(sse('delta', {'content': content}))
+
+        writer = asyncio.create_task(forward())
+        try:
+            result = await run_turn(session, prompt, settings, deltas.put_nowait)
+            event = 'done'
+        except web.HTTPException as e:
+            result = json.loads(e.text)
+            result['status'] = e.status
+            event = 'error'
+        finally:
+            deltas.put_nowait(None)
+            await writer
+
+        await response.write(sse(event, result))
+        await response.write_eof()
+        return response
+
+
+async def save_session(request):
+    session = get_session(request)
+    # Only queues the writes, so it runs on the event loop and sees the conversation between turns
+    saved = conversations.save_conversation(session.user.user_id, dict(session.details), session.conversation)
+    return web.json_response({'session_id': session.id, 'messages': len(session.conversation), 'saved': saved})
+
+
+async def export_session(request):
+    session = get_session(request)
+    text = ''.join(f"{message['role']}: {message['content']}\n" for message in session.conversation)
+    filename = f"{session.user.first_name}_{datetime.now().strftime('%m-%d-%Y_%H-%M-%S')}.txt"
+    return web.Response(text=text, headers={'Content-Disposition': f'attachment; filename="{filename}"'})
+
+
+async def list_saved_conversations(request):
+    try:
+        page = int(request.query.get('page', 0))
+        page_size = min(int(request.query.get('page_size', 20)), 100)
+    except ValueError:
+        raise json_error(400, "Invalid page.")
+
+    saved = await asyncio.to_thread(conversations.list_conversations, request['user_id'], page, page_size)
+    for summary in saved:
+        if isinstance(summary.get('created'), datetime):
+            summary['created'] = summary['created'].isoformat()
+    return web.json_response(saved)
+
+
+async def get_saved_conversation(request):
+    try:
+        page = int(request.query['page']) if 'page' in request.query else None
+    except ValueError:
+        raise json_error(400, "Invalid page.")
+
+    # Each page is one bucket of the stored conversation
+    messages = await asyncio.to_thread(
+        conversations.load_messages, request['user_id'], request.match_info['session_id'], page
+    )
+    if not messages and not page:
+        raise json_error(404, "Conversation not found.")
+    return web.json_response({'session_id': request.match_info['session_id'], 'page': page, 'messages': messages})
+
+
+async def expire_sessions(app):
+    '''
+    Drop chat sessions that have been idle for longer than SESSION_IDLE_TIMEOUT.
+    '''
+    while True:
+        await asyncio.sleep(60)
+        cutoff = time.monotonic() - SESSION_IDLE_TIMEOUT
+        idle = [session.id for session in app['sessions'].values() if session.last_used < cutoff and not session.lock.locked()]
+        for session_id in idle:
+            del app['sessions'][session_id]
+
+
+async def on_startup(app):
+    get_backend().warm_up(on_connect=ensure_indexes)
+    # One HTTP pool for every API call made by the server
+    app['openai_session'] = ClientSession(
+        connector=TCPConnector(limit=HTTP_POOL_SIZE),
+        timeout=ClientTimeout(total=600)
+    )
+    app['expire_sessions'] = asyncio.create_task(expire_sessions(app))
+
+
+async def on_cleanup(app):
+    app['expire_sessions'].cancel()
+    await app['openai_session'].close()
+    # Write anything still queued before closing the database connection
+    await asyncio.to_thread(persistence.close)
+    get_backend().close()
+
+
+def create_app() -> web.Application:
+    app = web.Application(middlewares=[auth_middleware])
+    app['sessions'] = {}
+    app.on_startup.append(on_startup)
+    app.on_cleanup.append(on_cleanup)
+    app.add_routes([
+        web.post('/login', login),
+        web.get('/models', list_models),
+        web.get('/conversations', list_saved_conversations),
+        web.get('/conversations/{session_id}', get_saved_conversation),
+        web.post('/sessions', create_session),
+        web.patch('/sessions/{session_id}', update_session),
+        web.delete('/sessions/{session_id}', end_session),
+        web.post('/sessions/{session_id}/chat', chat),
+        web.post('/sessions/{session_id}/save', save_session),
+        web.get('/sessions/{session_id}/export', export_session),
+    ])
+    return app
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='OpenAI API chat service')
+    parser.add_argument('--host', default=SERVER_HOST)
+    parser.add_argument('--port', type=int, default=SERVER_PORT)
+    args = parser.parse_args()
+
+    web.run_app(create_app(), host=args.host, port=args.port)
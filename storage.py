@@ -0,0 +1,693 @@
+# This file contains the storage backends: MongoDB (Atlas), or an embedded SQLite file for single-node installs.
+
+import sqlite3
+import threading
+
+from abc import ABC, abstractmethod
+from datetime import datetime
+
+from bson import json_util
+from bson.errors import InvalidDocument
+from pymongo import ASCENDING, DESCENDING, InsertOne, ReturnDocument, UpdateMany, UpdateOne
+from pymongo.errors import BulkWriteError, ConnectionFailure, DuplicateKeyError, ExecutionTimeout, PyMongoError, WTimeoutError
+
+from database import close_client, get_client, get_collection, get_users_collection
+
+# Using config.py to load environment variables, production
+import config
+
+
+STORAGE_BACKEND = getattr(config, 'STORAGE_BACKEND', 'mongodb')         # 'mongodb' or 'sqlite'
+SQLITE_PATH = getattr(config, 'SQLITE_PATH', 'openai-app.sqlite3')
+
+_backend = None
+_backend_lock = threading.Lock()
+
+
+def apply_update(document: dict, update: dict, inserting: bool = False) -> dict:
+    '''
+    Apply an update, written with MongoDB update operators, to a document in memory.
+
+    Supports the operators used by the application: $set, $setOnInsert, $inc, $push (with $each) and $unset.
+
+    Args:
+        document (dict): The current document
+        update (dict): The update
+        inserting (bool): The document is being inserted by an upsert, so $setOnInsert applies
+    Returns:
+        dict: The updated copy of the document
+    '''
+    document = dict(document)
+    for operator, fields in update.items():
+        for field, value in fields.items():
+            if operator == '$set':
+                document[field] = value
+            elif operator == '$setOnInsert':
+                if inserting:
+                    document[field] = value
+            elif operator == '$inc':
+                document[field] = document.get(field, 0) + value
+            elif operator == '$push':
+                values = value['$each'] if isinstance(value, dict) and '$each' in value else [value]
+                document[field] = list(document.get(field, [])) + list(values)
+            elif operator == '$unset':
+                document.pop(field, None)
+            else:
+                raise ValueError(f"Unsupported update operator: {operator}")
+    return document
+
+
+class StorageBackend(ABC):
+    '''
+    Storage for users, conversations and usage events.
+
+    Writes are described with MongoDB update operators (see apply_update()), so the write-behind
+    queue and the ledger work the same way on every backend. Lookups use equality filters.
+    '''
+    name = None
+
+    @abstractmethod
+    def ping(self):
+        '''
+        Open the connection, raising if the storage can't be reached.
+        '''
+        raise NotImplementedError
+
+    def warm_up(self, background: bool = True, on_connect=None):
+        '''
+        Connect ahead of the first query.
+
+        Args:
+            background (bool): Run the warm-up in a daemon thread so it does not delay startup
+            on_connect (callable): Startup work to run once connected, e.g. creating indexes
+        Returns:
+            threading.Thread: The warm-up thread, or None if run in the foreground
+        '''
+        def connect():
+            try:
+                self.ping()
+                if on_connect:
+                    on_connect()
+            except Exception as e:
+                # The first real query will surface the error to the user
+                print(f"Warning: Could not connect to the database ({e})")
+
+        if not background:
+            connect()
+            return None
+
+        thread = threading.Thread(target=connect, name=f'{self.name}-warm-up', daemon=True)
+        thread.start()
+        return thread
+
+    @abstractmethod
+    def ensure_indexes(self):
+        '''
+        Create the indexes (and tables) used by the application. Safe to call more than once.
+        '''
+        raise NotImplementedError
+
+    @abstractmethod
+    def close(self):
+        '''
+        Close the connection. Used on application exit.
+        '''
+        raise NotImplementedError
+
+    # Users
+
+    @abstractmethod
+    def find_user(self, filter: dict, fields) -> dict:
+        '''
+        Find a single user.
+
+        Args:
+            filter (dict): Equality filter, e.g. {'username': ...}
+            fields (tuple): The fields to return
+        Returns:
+            dict: The user, or None if not found
+        '''
+        raise NotImplementedError
+
+    @abstractmethod
+    def insert_user(self, user_data: dict) -> bool:
+        '''
+        Insert a new user.
+
+        Returns:
+            bool: False if the username or user id is already taken
+        '''
+        raise NotImplementedError
+
+    @abstractmethod
+    def delete_user(self, user_id: str):
+        '''
+        Delete a user. Deleting a user that does not exist is not an error.
+        '''
+        raise NotImplementedError
+
+    @abstractmethod
+    def iter_users(self, filters: dict, fields, page: int = 0, limit: int = None, batch_size: int = 100):
+        '''
+        Stream users sorted by username, one batch at a time.
+
+        Args:
+            filters (dict): Admin filters: role, min_balance and max_balance
+            fields (tuple): The fields to return
+            page (int): The page to start at, in pages of limit users
+            limit (int): The maximum number of users. Streams every matching user if None
+            batch_size (int): The number of users fetched at a time
+        '''
+        raise NotImplementedError
+
+    @abstractmethod
+    def update_users(self, changes) -> tuple:
+        '''
+        Apply one update per user, in a single round-trip.
+
+        Args:
+            changes (list): (filter, update) pairs
+        Returns:
+            tuple: The number of users matched and modified
+        '''
+        raise NotImplementedError
+
+    @abstractmethod
+    def update_matching(self, filters: dict, update: dict) -> tuple:
+        '''
+        Apply the same update to every user matching the admin filters.
+
+        Returns:
+            tuple: The number of users matched and modified
+        '''
+        raise NotImplementedError
+
+    @abstractmethod
+    def reserve_balance(self, user_id: str, amount: float):
+        '''
+        Deduct an amount from a user's balance, only if the balance covers it. Atomic.
+
+        Returns:
+            float: The balance after the deduction, or None if the balance is insufficient
+        '''
+        raise NotImplementedError
+
+    # Write-behind queue
+
+    @abstractmethod
+    def write(self, entries: list) -> tuple:
+        '''
+        Apply queued writes, see persistence.PersistenceQueue.
+
+        Args:
+            entries (list): [collection, kind, filter, document, upsert] entries
+        Returns:
+            tuple: The entries to retry later, because the database could not be reached, and the
+            (entry, error) pairs that were rejected and will never succeed, e.g. duplicate keys
+        '''
+        raise NotImplementedError
+
+    # Conversations
+
+    @abstractmethod
+    def find_conversations(self, user_id: str, fields, page: int = 0, page_size: int = 20) -> list:
+        '''
+        List the first bucket of a user's conversations, newest first.
+        '''
+        raise NotImplementedError
+
+    @abstractmethod
+    def find_messages(self, user_id: str, session_id: str, first_bucket: int = None, buckets: int = None) -> list:
+        '''
+        Load the messages of a conversation, in bucket order.
+
+        Args:
+            first_bucket (int): The first bucket to load. Loads every bucket if None
+            buckets (int): The number of buckets to load from first_bucket
+        '''
+        raise NotImplementedError
+
+
+class MongoBackend(StorageBackend):
+    '''
+    MongoDB storage, through the shared client in database.py.
+    '''
+    name = 'mongodb'
+
+    def __init__(self):
+        self._indexes_created = False
+
+    def ping(self):
+        get_client().admin.command('ping')
+
+    def ensure_indexes(self):
+        if self._indexes_created:
+            return
+
+        users = get_users_collection()
+        users.create_index([('username', ASCENDING)], unique=True)
+        users.create_index([('user_id', ASCENDING)], unique=True)
+
+        conversations = get_collection('conversations')
+        conversations.create_index([('user_id', ASCENDING), ('session_id', ASCENDING), ('bucket', ASCENDING)], unique=True)
+        conversations.create_index([('user_id', ASCENDING), ('bucket', ASCENDING), ('created', DESCENDING)])
+        # Used by the admin session analytics
+        conversations.create_index([('bucket', ASCENDING), ('session.start_time', ASCENDING)])
+
+        # Per-user history and time range queries
+        usage = get_collection('usage_events')
+        usage.create_index([('user_id', ASCENDING), ('time', DESCENDING)])
+        usage.create_index([('time', ASCENDING)])
+
+        self._indexes_created = True
+
+    def close(self):
+        close_client()
+
+    @staticmethod
+    def _projection(fields) -> dict:
+        projection = {'_id': 0}
+        projection.update((field, 1) for field in fields)
+        return projection
+
+    @staticmethod
+    def _users_query(filters: dict) -> dict:
+        query = {}
+        if filters.get('role'):
+            query['role'] = filters['role']
+        if filters.get('min_balance') is not None or filters.get('max_balance') is not None:
+            query['balance'] = {}
+            if filters.get('min_balance') is not None:
+                query['balance']['$gte'] = filters['min_balance']
+            if filters.get('max_balance') is not None:
+                query['balance']['$lte'] = filters['max_balance']
+        return query
+
+    def find_user(self, filter, fields):
+        return get_users_collection().find_one(filter, projection=self._projection(fields))
+
+    def insert_user(self, user_data):
+        try:
+            # Copy, insert_one adds an _id to the document
+            get_users_collection().insert_one(dict(user_data))
+        except DuplicateKeyError:
+            return False
+        return True
+
+    def delete_user(self, user_id):
+        get_users_collection().delete_one({'user_id': user_id})
+
+    def iter_users(self, filters, fields, page=0, limit=None, batch_size=100):
+        # Sorted on the unique username index, so pages are stable
+        cursor = get_users_collection().find(
+            self._users_query(filters), projection=self._projection(fields), batch_size=batch_size
+        ).sort('username', ASCENDING)
+        if limit:
+            cursor = cursor.skip(page * limit).limit(limit)
+
+        try:
+            yield from cursor
+        finally:
+            cursor.close()
+
+    def update_users(self, changes):
+        requests = [UpdateOne(filter, update) for filter, update in changes]
+        if not requests:
+            return 0, 0
+
+        # Unordered, so one failing user does not stop the rest
+        result = get_users_collection().bulk_write(requests, ordered=False)
+        return result.matched_count, result.modified_count
+
+    def update_matching(self, filters, update):
+        result = get_users_collection().bulk_write([UpdateMany(self._users_query(filters), update)])
+        return result.matched_count, result.modified_count
+
+    def reserve_balance(self, user_id, amount):
+        user = get_users_collection().find_one_and_update(
+            {'user_id': user_id, 'balance': {'$gte': amount}},
+            {'$inc': {'balance': -amount}},
+            projection={'_id': 0, 'balance': 1},
+            return_document=ReturnDocument.AFTER
+        )
+        return None if user is None else float(user['balance'])
+
+    def write(self, entries):
+        failed = []
+        rejected = []
+        by_collection = {}
+        for entry in entries:
+            by_collection.setdefault(entry[0], []).append(entry)
+
+        for collection, group in by_collection.items():
+            requests = [
+                InsertOne(document) if kind == 'insert' else UpdateOne(filter, document, upsert=upsert)
+                for _, kind, filter, document, upsert in group
+            ]
+            try:
+                get_collection(collection).bulk_write(requests, ordered=False)
+            except BulkWriteError as e:
+                # The writes are unordered, so only the ones listed failed, and retrying them gives the same error
+                rejected.extend((group[error['index']], error.get('errmsg')) for error in e.details.get('writeErrors', []))
+            except (ConnectionFailure, ExecutionTimeout, WTimeoutError):
+                failed.extend(group)
+            except PyMongoError as e:
+                rejected.extend((entry, str(e)) for entry in group)
+            except InvalidDocument as e:
+                if len(group) == 1:
+                    rejected.append((group[0], str(e)))
+                    continue
+                # Raised while encoding, before anything is sent. Write them one at a time to find the bad ones
+                for entry in group:
+                    entry_failed, entry_rejected = self.write([entry])
+                    failed.extend(entry_failed)
+                    rejected.extend(entry_rejected)
+
+        return failed, rejected
+
+    def find_conversations(self, user_id, fields, page=0, page_size=20):
+        cursor = get_collection('conversations').find(
+            {'user_id': user_id, 'bucket': 0},
+            projection=self._projection(fields)
+        ).sort('created', DESCENDING).skip(page * page_size).limit(page_size)
+
+        return list(cursor)
+
+    def find_messages(self, user_id, session_id, first_bucket=None, buckets=None):
+        query = {'user_id': user_id, 'session_id': session_id}
+        if first_bucket is not None:
+            query['bucket'] = {'$gte': first_bucket, '$lt': first_bucket + buckets}
+
+        cursor = get_collection('conversations').find(query, projection={'_id': 0, 'messages': 1}).sort('bucket', ASCENDING)
+
+        messages = []
+        for bucket in cursor:
+            messages.extend(bucket['messages'])
+        return messages
+
+
+# Fields stored in their own columns, for lookups, sorting and atomic updates. Everything else is kept
+# in the JSON "document" column
+SQLITE_COLUMNS = {
+    'users': ('user_id', 'username', 'role', 'balance'),
+    'conversations': ('user_id', 'session_id', 'bucket', 'created'),
+    'usage_events': ('user_id', 'time', 'model', 'cost'),
+}
+
+# Columns holding datetimes, stored as ISO strings so they sort correctly
+SQLITE_DATETIME_COLUMNS = ('created', 'time')
+
+SQLITE_SCHEMA = [
+    'CREATE TABLE IF NOT EXISTS users ('
+    'user_id TEXT PRIMARY KEY, username TEXT NOT NULL UNIQUE, role TEXT, '
+    'balance REAL NOT NULL DEFAULT 0, document TEXT NOT NULL)',
+    'CREATE INDEX IF NOT EXISTS users_role_balance ON users (role, balance)',
+
+    'CREATE TABLE IF NOT EXISTS conversations ('
+    'user_id TEXT NOT NULL, session_id TEXT NOT NULL, bucket INTEGER NOT NULL, '
+    'created TEXT, document TEXT NOT NULL, PRIMARY KEY (user_id, session_id, bucket))',
+    'CREATE INDEX IF NOT EXISTS conversations_user_created ON conversations (user_id, bucket, created DESC)',
+
+    'CREATE TABLE IF NOT EXISTS usage_events ('
+    'id INTEGER PRIMARY KEY AUTOINCREMENT, user_id TEXT, time TEXT, model TEXT, cost REAL, document TEXT NOT NULL)',
+    'CREATE INDEX IF NOT EXISTS usage_events_user_time ON usage_events (user_id, time DESC)',
+    'CREATE INDEX IF NOT EXISTS usage_events_time ON usage_events (time)',
+]
+
+
+class SQLiteBackend(StorageBackend):
+    '''
+    Embedded storage in a local SQLite file, in WAL mode.
+
+    Meant for single-node installs and offline load tests: every write is a local transaction, with
+    no network round-trip. One connection is shared by the process, guarded by a lock.
+    '''
+    name = 'sqlite'
+
+    def __init__(self, path=SQLITE_PATH):
+        self.path = path
+        self._lock = threading.RLock()
+        self._db = None
+
+    def _connect(self):
+        # Opened on first use, and the schema is created with it
+        if self._db is None:
+            self._db = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+            self._db.execute('PRAGMA journal_mode=WAL')
+            # Safe with WAL: a power loss can lose the last commits, but never corrupts the file
+            self._db.execute('PRAGMA synchronous=NORMAL')
+            for statement in SQLITE_SCHEMA:
+                self._db.execute(statement)
+        return self._db
+
+    def _transaction(self, write):
+        '''
+        Run write(db) in a single transaction, rolled back if it raises.
+        '''
+        with self._lock:
+            db = self._connect()
+            db.execute('BEGIN IMMEDIATE')
+            try:
+                result = write(db)
+            except BaseException:
+                db.execute('ROLLBACK')
+                raise
+            db.execute('COMMIT')
+            return result
+
+    def ping(self):
+        with self._lock:
+            self._connect()
+
+    def ensure_indexes(self):
+        # The schema is created when the file is opened
+        self.ping()
+
+    def close(self):
+        with self._lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
+
+    # Rows <-> documents
+
+    @staticmethod
+    def _column_value(value):
+        return value.isoformat() if isinstance(value, datetime) else value
+
+    def _from_row(self, table, row) -> dict:
+        '''
+        Build a document from its columns and the JSON document column (the last one selected).
+        '''
+        document = json_util.loads(row[-1])
+        for column, value in zip(SQLITE_COLUMNS[table], row):
+            if column in SQLITE_DATETIME_COLUMNS and value is not None:
+                value = datetime.fromisoformat(value)
+            document[column] = value
+        return document
+
+    def _to_row(self, table, document) -> list:
+        rest = {field: value for field, value in document.items() if field not in SQLITE_COLUMNS[table]}
+        row = [self._column_value(document.get(column)) for column in SQLITE_COLUMNS[table]]
+        row.append(json_util.dumps(rest))
+        return row
+
+    @staticmethod
+    def _where(table, filter: dict):
+        for field in filter:
+            if field not in SQLITE_COLUMNS[table]:
+                raise ValueError(f"Can't filter {table} on {field}")
+        clause = ' AND '.join(f'{field} = ?' for field in filter) or '1'
+        return clause, list(filter.values())
+
+    def _select(self, db, table, filter: dict, suffix: str = '', params=()) -> list:
+        '''
+        Select documents by equality filter, with their rowid first.
+        '''
+        clause, values = self._where(table, filter)
+        return self._select_where(db, table, clause, values, suffix, params)
+
+    def _select_where(self, db, table, clause: str, values: list, suffix: str = '', params=()) -> list:
+        columns = ', '.join(SQLITE_COLUMNS[table] + ('document',))
+        rows = db.execute(f'SELECT rowid, {columns} FROM {table} WHERE {clause} {suffix}', values + list(params)).fetchall()
+        return [(row[0], self._from_row(table, row[1:])) for row in rows]
+
+    def _insert(self, db, table, document):
+        columns = SQLITE_COLUMNS[table] + ('document',)
+        placeholders = ', '.join('?' for _ in columns)
+        db.execute(f'INSERT INTO {table} ({", ".join(columns)}) VALUES ({placeholders})', self._to_row(table, document))
+
+    def _replace(self, db, table, rowid, document):
+        columns = SQLITE_COLUMNS[table] + ('document',)
+        assignments = ', '.join(f'{column} = ?' for column in columns)
+        db.execute(f'UPDATE {table} SET {assignments} WHERE rowid = ?', self._to_row(table, document) + [rowid])
+
+    def _update(self, db, table, found, update) -> tuple:
+        '''
+        Apply an update to the documents found by _select().
+
+        Returns:
+            tuple: The number of documents matched and modified
+        '''
+        modified = 0
+        for rowid, document in found:
+            updated = apply_update(document, update)
+            if updated != document:
+                self._replace(db, table, rowid, updated)
+                modified += 1
+        return len(found), modified
+
+    def _upsert(self, db, table, filter, update, upsert=False):
+        matched, _ = self._update(db, table, self._select(db, table, filter), update)
+        if not matched and upsert:
+            self._insert(db, table, apply_update(filter, update, inserting=True))
+
+    # Users
+
+    def find_user(self, filter, fields):
+        with self._lock:
+            found = self._select(self._connect(), 'users', filter, 'LIMIT 1')
+        if not found:
+            return None
+        document = found[0][1]
+        return {field: document[field] for field in fields if field in document}
+
+    def insert_user(self, user_data):
+        try:
+            self._transaction(lambda db: self._insert(db, 'users', user_data))
+        except sqlite3.IntegrityError:
+            return False
+        return True
+
+    def delete_user(self, user_id):
+        self._transaction(lambda db: db.execute('DELETE FROM users WHERE user_id = ?', (user_id,)))
+
+    @staticmethod
+    def _users_where(filters: dict):
+        clauses, values = [], []
+        if filters.get('role'):
+            clauses.append('role = ?')
+            values.append(filters['role'])
+        if filters.get('min_balance') is not None:
+            clauses.append('balance >= ?')
+            values.append(filters['min_balance'])
+        if filters.get('max_balance') is not None:
+            clauses.append('balance <= ?')
+            values.append(filters['max_balance'])
+        return ' AND '.join(clauses) or '1', values
+
+    def iter_users(self, filters, fields, page=0, limit=None, batch_size=100):
+        clause, values = self._users_where(filters)
+        columns = ', '.join(SQLITE_COLUMNS['users'] + ('document',))
+        offset = page * limit if limit else 0
+        remaining = limit
+
+        # Keyset pagination on the unique username, so the lock is only held while a batch is read
+        last = None
+        while remaining is None or remaining > 0:
+            size = batch_size if remaining is None else min(batch_size, remaining)
+            after = '' if last is None else 'AND username > ?'
+            params = values + ([] if last is None else [last]) + [size, offset]
+            with self._lock:
+                rows = self._connect().execute(
+                    f'SELECT {columns} FROM users WHERE {clause} {after} ORDER BY username LIMIT ? OFFSET ?', params
+                ).fetchall()
+
+            for row in rows:
+                document = self._from_row('users', row)
+                yield {field: document[field] for field in fields if field in document}
+
+            if len(rows) < size:
+                return
+            last = rows[-1][1]
+            offset = 0
+            if remaining is not None:
+                remaining -= len(rows)
+
+    def update_users(self, changes):
+        def write(db):
+            matched = modified = 0
+            for filter, update in changes:
+                result = self._update(db, 'users', self._select(db, 'users', filter), update)
+                matched += result[0]
+                modified += result[1]
+            return matched, modified
+
+        return self._transaction(write)
+
+    def update_matching(self, filters, update):
+        clause, values = self._users_where(filters)
+        return self._transaction(lambda db: self._update(db, 'users', self._select_where(db, 'users', clause, values), update))
+
+    def reserve_balance(self, user_id, amount):
+        def write(db):
+            return db.execute(
+                'UPDATE users SET balance = balance - ? WHERE user_id = ? AND balance >= ? RETURNING balance',
+                (amount, user_id, amount)
+            ).fetchone()
+
+        row = self._transaction(write)
+        return None if row is None else float(row[0])
+
+    def write(self, entries):
+        def write(db):
+            rejected = []
+            for entry in entries:
+                collection, kind, filter, document, upsert = entry
+                try:
+                    if kind == 'insert':
+                        self._insert(db, collection, document)
+                    else:
+                        self._upsert(db, collection, filter, document, upsert)
+                except (sqlite3.IntegrityError, ValueError, TypeError) as e:
+                    # Only this write fails, the rest of the transaction still applies
+                    rejected.append((entry, str(e)))
+            return [], rejected
+
+        try:
+            return self._transaction(write)
+        except sqlite3.Error:
+            # Locked or unreadable database, the whole batch is retried
+            return list(entries), []
+
+    # Conversations
+
+    def find_conversations(self, user_id, fields, page=0, page_size=20):
+        with self._lock:
+            found = self._select(
+                self._connect(), 'conversations', {'user_id': user_id, 'bucket': 0},
+                'ORDER BY created DESC LIMIT ? OFFSET ?', (page_size, page * page_size)
+            )
+        return [{field: document[field] for field in fields if field in document} for _, document in found]
+
+    def find_messages(self, user_id, session_id, first_bucket=None, buckets=None):
+        suffix, params = 'ORDER BY bucket', ()
+        if first_bucket is not None:
+            suffix, params = 'AND bucket >= ? AND bucket < ? ORDER BY bucket', (first_bucket, first_bucket + buckets)
+
+        with self._lock:
+            found = self._select(self._connect(), 'conversations', {'user_id': user_id, 'session_id': session_id}, suffix, params)
+
+        messages = []
+        for _, bucket in found:
+            messages.extend(bucket['messages'])
+        return messages
+
+
+def get_backend() -> StorageBackend:
+    '''
+    Get the process-wide storage backend selected by STORAGE_BACKEND, creating it on first use.
+    '''
+    global _backend
+
+    if _backend is None:
+        with _backend_lock:
+            if _backend is None:
+                if STORAGE_BACKEND == 'sqlite':
+                    _backend = SQLiteBackend()
+                elif STORAGE_BACKEND == 'mongodb':
+                    _backend = MongoBackend()
+                else:
+                    raise ValueError(f"Unknown storage backend: {STORAGE_BACKEND}")
+
+    return _backend
@@ -0,0 +1,24 @@
+# Test setup: an in-memory config that selects the embedded SQLite backend, so the tests run offline.
+
+import os
+import sys
+import tempfile
+import types
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+# config.py holds the deployment's secrets and is not part of the repository. The modules read it on import
+_data_dir = tempfile.mkdtemp(prefix='openai-app-tests-')
+config = types.ModuleType('config')
+config.API_KEY = 'test'
+config.ATLAS_URI = 'mongodb://localhost:27017'
+config.STORAGE_BACKEND = 'sqlite'
+config.SQLITE_PATH = os.path.join(_data_dir, 'app.sqlite3')
+config.PERSISTENCE_JOURNAL = os.path.join(_data_dir, 'persistence_journal.jsonl')
+config.PERSISTENCE_REJECTED = os.path.join(_data_dir, 'persistence_rejected.jsonl')
+# The tests flush the shared queue themselves
+config.PERSISTENCE_FLUSH_INTERVAL = 3600
+config.PERSISTENCE_MAX_PENDING = 10000
+config.CACHE_PATH = os.path.join(_data_dir, 'response_cache.sqlite3')
+sys.modules.setdefault('config', config)
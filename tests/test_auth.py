@@ -0,0 +1,49 @@
+import time
+
+import pytest
+
+import auth
+
+from users import User
+
+
+def test_token_round_trip():
+    token = auth.issue_token('user-1')
+    assert auth.verify_token(token) == 'user-1'
+
+
+def test_tampered_token_is_rejected():
+    encoded, signature = auth.issue_token('user-1').split('.')
+    other, _ = auth.issue_token('user-2').split('.')
+    assert auth.verify_token(f"{other}.{signature}") is None
+    assert auth.verify_token(f"{encoded}.{signature[:-1]}x") is None
+    assert auth.verify_token('not a token') is None
+
+
+def test_expired_token_is_rejected(monkeypatch):
+    token = auth.issue_token('user-1', ttl=10)
+    monkeypatch.setattr(time, 'time', lambda: 2 ** 40)
+    assert auth.verify_token(token) is None
+
+
+def test_hash_and_check_password():
+    hashed = auth.hash_password('secret')
+    assert auth.hashed_rounds(hashed) == auth.get_rounds()
+    assert auth.check_password('secret', hashed)
+    assert not auth.check_password('wrong', hashed)
+
+
+def test_users_from_documents_skip_bcrypt(monkeypatch):
+    def no_bcrypt(password):
+        raise AssertionError("bcrypt was called")
+
+    monkeypatch.setattr(auth, 'hash_password', no_bcrypt)
+    user_data = {
+        'user_id': 'user-1', 'first_name': 'A', 'last_name': 'B', 'email': 'a@b.c', 'username': 'ab',
+        'password': b'$2b$12$stored', 'role': 'user', 'balance': 1.5,
+    }
+    user = User.from_document(user_data)
+    assert user.password == b'$2b$12$stored'
+    assert not user.is_dirty()
+
+    User.guest()
@@ -0,0 +1,79 @@
+import asyncio
+import json
+
+import pytest
+
+import batch
+
+from chat_settings import ChatSettings
+from users import User
+
+
+def fake_response(answer: str) -> dict:
+    return {
+        'model': 'gpt-3.5-turbo',
+        'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': answer}, 'finish_reason': 'stop'}],
+        'usage': {'prompt_tokens': 5, 'completion_tokens': 5, 'total_tokens': 10},
+        'timing': {'time_to_first_token': 0.1, 'total_time': 0.1, 'tokens_per_second': 50.0},
+    }
+
+
+@pytest.fixture
+def sent(monkeypatch):
+    sent = []
+
+    async def achat(prompt, conversation, settings, on_delta=None, context=None):
+        sent.append(prompt)
+        if prompt == 'fail':
+            raise RuntimeError('API error')
+        return fake_response(prompt.upper())
+
+    monkeypatch.setattr(batch, 'achat', achat)
+    return sent
+
+
+def write_lines(path, lines):
+    path.write_text(''.join(line + '\n' for line in lines))
+
+
+def test_completed_lines_only_counts_successes(tmp_path):
+    output = tmp_path / 'output.jsonl'
+    output.write_text(
+        json.dumps({'line': 1, 'status': 'ok'}) + '\n'
+        + json.dumps({'line': 2, 'status': 'error'}) + '\n'
+        + '{"line": 3, "sta'
+    )
+    assert batch.completed_lines(output) == {1}
+    assert batch.completed_lines(tmp_path / 'missing.jsonl') == set()
+
+
+def test_resume_skips_completed_records(tmp_path, sent):
+    requests = tmp_path / 'requests.jsonl'
+    output = tmp_path / 'output.jsonl'
+    write_lines(requests, [json.dumps({'prompt': 'one'}), json.dumps({'prompt': 'fail'}), 'not json'])
+    # A crashed run: line 1 succeeded, the next result was cut off while writing it
+    output.write_text(json.dumps({'line': 1, 'status': 'ok'}) + '\n{"line": 2')
+
+    user = User.guest()
+    summary = asyncio.run(batch.run_batch(user, requests, output, ChatSettings(), concurrency=2))
+
+    assert sent == ['fail']
+    assert summary['skipped'] == 1 and summary['error'] == 2
+    results = [json.loads(line) for line in output.read_text().splitlines()[2:]]
+    assert sorted(result['line'] for result in results) == [2, 3]
+    # The failed request gave its reservation back
+    assert user.balance == User.guest().balance
+
+
+def test_results_are_charged(tmp_path, sent):
+    requests = tmp_path / 'requests.jsonl'
+    output = tmp_path / 'output.jsonl'
+    write_lines(requests, [json.dumps({'prompt': 'one', 'id': 'a'}), json.dumps({'messages': [{'role': 'user', 'content': 'two'}]})])
+
+    user = User.guest()
+    summary = asyncio.run(batch.run_batch(user, requests, output, ChatSettings(), concurrency=1))
+
+    assert summary['ok'] == 2
+    results = {result['line']: result for result in map(json.loads, output.read_text().splitlines())}
+    assert results[1]['id'] == 'a' and results[1]['answer'] == 'ONE'
+    assert round(user.balance + summary['expense'], 8) == User.guest().balance
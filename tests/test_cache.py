@@ -0,0 +1,109 @@
+import asyncio
+import time
+
+import pytest
+
+from cache import ResponseCache, request_key
+from conversation import Conversation
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(time, 'time', clock)
+    return clock
+
+
+def request(prompt: str, temperature: float = 0) -> dict:
+    return {'model': 'gpt-3.5-turbo', 'temperature': temperature, 'messages': [{'role': 'user', 'content': prompt}]}
+
+
+def response(answer: str) -> dict:
+    return {
+        'object': 'chat.completion',
+        'model': 'gpt-3.5-turbo',
+        'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': answer}, 'finish_reason': 'stop'}],
+        'usage': {'prompt_tokens': 5, 'completion_tokens': 5, 'total_tokens': 10},
+    }
+
+
+def test_round_trip_returns_a_marked_copy(tmp_path, clock):
+    cache = ResponseCache(path=tmp_path / 'cache.sqlite3')
+    cache.put(request('Hi'), response('Hello'))
+
+    hit = cache.get(request('Hi'))
+    assert hit['cached'] and hit['choices'][0]['message']['content'] == 'Hello'
+    hit['choices'][0]['message']['content'] = 'changed'
+    assert cache.get(request('Hi'))['choices'][0]['message']['content'] == 'Hello'
+
+
+def test_only_deterministic_requests_are_cached(tmp_path, clock):
+    cache = ResponseCache(path=tmp_path / 'cache.sqlite3')
+    cache.put(request('Hi', temperature=1), response('Hello'))
+    assert cache.get(request('Hi', temperature=1)) is None
+    assert cache.stats()['misses'] == 0
+
+
+def test_memory_tier_falls_back_to_disk(tmp_path, clock):
+    cache = ResponseCache(path=tmp_path / 'cache.sqlite3', memory_entries=2)
+    for prompt in ['a', 'b', 'c']:
+        cache.put(request(prompt), response(prompt))
+
+    assert cache.get(request('a')) is not None
+    assert cache.get(request('c')) is not None
+    assert cache.stats()['disk_hits'] == 1 and cache.stats()['memory_hits'] == 1
+
+
+def test_entries_expire(tmp_path, clock):
+    cache = ResponseCache(path=tmp_path / 'cache.sqlite3', ttl=60)
+    cache.put(request('Hi'), response('Hello'))
+
+    clock.now += 61
+    assert cache.get(request('Hi')) is None
+    assert cache.stats()['misses'] == 1
+
+
+def test_least_recently_used_entries_are_evicted(tmp_path, clock):
+    size = len(ResponseCache(path=tmp_path / 'size.sqlite3')._prepare(request('a'), response('a'))[1])
+    cache = ResponseCache(path=tmp_path / 'cache.sqlite3', memory_entries=0, max_bytes=2 * size)
+    cache.put(request('a'), response('a'))
+    clock.now += 1
+    cache.put(request('b'), response('b'))
+    clock.now += 1
+    # The access is written with the next put, and keeps "a" over "b"
+    assert cache.get(request('a')) is not None
+    clock.now += 1
+    cache.put(request('c'), response('c'))
+
+    assert cache.get(request('a')) is not None
+    assert cache.get(request('b')) is None
+    assert cache.get(request('c')) is not None
+
+
+def test_async_round_trip(tmp_path, clock):
+    cache = ResponseCache(path=tmp_path / 'cache.sqlite3', memory_entries=0)
+
+    async def main():
+        await cache.aput(request('Hi'), response('Hello'))
+        return await cache.aget(request('Hi'))
+
+    assert asyncio.run(main())['choices'][0]['message']['content'] == 'Hello'
+
+
+def test_branches_with_the_same_history_share_a_key():
+    first, second = Conversation(), Conversation()
+    for conversation in (first, second):
+        conversation.add('user', 'Hi')
+        conversation.add('assistant', 'Hello')
+
+    key = request_key({'model': 'gpt-3.5-turbo', 'temperature': 0, 'messages': first.to_api()})
+    assert key == request_key({'model': 'gpt-3.5-turbo', 'temperature': 0, 'messages': second.to_api()})
+    assert key != request_key({'model': 'gpt-3.5-turbo', 'temperature': 0, 'messages': first.to_api()[:1]})
@@ -0,0 +1,56 @@
+import dataclasses
+
+import pytest
+
+from chat_settings import ChatSettings
+
+
+def test_settings_are_validated_and_normalized():
+    settings = ChatSettings(max_tokens='200', temperature=1)
+    assert settings.max_tokens == 200 and isinstance(settings.temperature, float)
+
+
+@pytest.mark.parametrize('changes', [
+    {'model': 'not-a-model'},
+    {'temperature': 3},
+    {'top_p': -0.1},
+    {'max_tokens': 0},
+    {'presence_penalty': 'high'},
+])
+def test_invalid_settings_are_rejected(changes):
+    with pytest.raises(ValueError):
+        ChatSettings(**changes)
+
+
+def test_replace_returns_new_validated_settings():
+    settings = ChatSettings()
+    changed = settings.replace(temperature=0)
+    assert changed.temperature == 0 and settings.temperature == ChatSettings().temperature
+
+    with pytest.raises(ValueError):
+        settings.replace(temperature=5)
+    with pytest.raises(ValueError):
+        settings.replace(messages=[])
+
+
+def test_settings_are_immutable():
+    with pytest.raises(dataclasses.FrozenInstanceError):
+        ChatSettings().temperature = 0
+
+
+def test_requests_reference_the_messages():
+    settings = ChatSettings()
+    messages = [{'role': 'user', 'content': 'Hi'}]
+    request = settings.request(messages)
+    assert request['messages'] is messages and request['model'] == settings.model
+    assert 'messages' not in settings.as_dict()
+
+
+def test_stream_can_be_turned_off():
+    settings = ChatSettings().replace(stream=False)
+    assert settings.request([])['stream'] is False
+
+
+def test_stream_must_be_a_bool():
+    with pytest.raises(ValueError):
+        ChatSettings(stream='false')
@@ -0,0 +1,61 @@
+from context import ContextWindow
+from conversation import Conversation
+from tokens import count_message_tokens
+
+
+MODEL = 'gpt-3.5-turbo'
+
+
+def build(count: int, words: int = 20) -> Conversation:
+    conversation = Conversation()
+    conversation.add('system', 'You are a helpful assistant.')
+    for number in range(count):
+        conversation.add('user' if number % 2 == 0 else 'assistant', f'message {number} ' + 'word ' * words)
+    return conversation
+
+
+def test_short_conversations_are_sent_whole():
+    conversation = build(4)
+    messages = conversation.to_api()
+    assert ContextWindow().fit(messages, MODEL, 1000) is messages
+
+
+def test_oldest_messages_are_dropped_and_system_messages_kept():
+    conversation = build(20)
+    context = ContextWindow(budget=300)
+    messages = context.fit(conversation.to_api(), MODEL, 1000)
+
+    assert messages[0] is conversation[0]
+    assert messages[-1] is conversation[-1]
+    assert len(messages) < len(conversation)
+    assert count_message_tokens(messages) <= 300
+    assert context.prompt_tokens() == count_message_tokens(messages)
+
+
+def test_the_newest_message_is_always_sent():
+    conversation = build(2, words=500)
+    messages = ContextWindow(budget=50).fit(conversation.to_api(), MODEL, 1000)
+    assert messages[-1] is conversation[-1]
+
+
+def test_rolled_back_messages_are_forgotten():
+    conversation = build(20)
+    context = ContextWindow(budget=300)
+    context.fit(conversation.to_api(), MODEL, 1000)
+
+    conversation.rollback(len(conversation) - 2)
+    conversation.add('user', 'a different question')
+    messages = context.fit(conversation.to_api(), MODEL, 1000)
+
+    assert messages[-1] is conversation[-1]
+    assert context.prompt_tokens() == count_message_tokens(messages)
+
+
+def test_a_bigger_budget_sends_older_messages_again():
+    conversation = build(60, words=60)
+    context = ContextWindow()
+    small = context.fit(conversation.to_api(), MODEL, 3000)
+    large = context.fit(conversation.to_api(), MODEL, 1000)
+
+    assert len(large) > len(small)
+    assert count_message_tokens(large) <= 4096 - 1000
@@ -0,0 +1,85 @@
+from conversation import Conversation, Message, api_messages
+from tokens import count_message_tokens
+
+
+def build(count: int) -> Conversation:
+    conversation = Conversation()
+    for number in range(count):
+        conversation.add('user' if number % 2 == 0 else 'assistant', f'message {number}')
+    return conversation
+
+
+def test_messages_are_records_not_dicts():
+    message = build(1)[0]
+    assert not isinstance(message, dict)
+    assert message['role'] == 'user' and message['content'] == 'message 0'
+    assert api_messages([message]) == [{'role': 'user', 'content': 'message 0'}]
+
+
+def test_running_token_count_matches_a_recount():
+    conversation = build(5)
+    assert conversation.tokens() == count_message_tokens(conversation.to_storage())
+
+
+def test_rollback_restores_count_and_digest():
+    conversation = build(2)
+    tokens, digest = conversation.tokens(), conversation.digest()
+    checkpoint = conversation.checkpoint()
+    conversation.add('user', 'failed prompt')
+
+    conversation.rollback(checkpoint)
+    assert len(conversation) == 2
+    assert conversation.tokens() == tokens
+    assert conversation.digest() == digest
+
+
+def test_digest_identifies_the_history():
+    assert build(3).digest() == build(3).digest()
+    assert build(3).digest(2) == build(2).digest()
+    assert build(3).digest() != build(2).digest()
+
+
+def test_storage_format():
+    conversation = build(3)
+    assert conversation.to_storage(1, 2) == [{'role': 'assistant', 'content': 'message 1'}]
+    assert all(type(message) is Message for message in conversation.to_api())
+
+
+def test_rewind_keeps_the_undone_messages_as_a_branch():
+    conversation = build(4)
+    tip = conversation[-1]
+
+    conversation.rewind(2)
+    assert len(conversation) == 2
+    assert conversation.branches() == [tip]
+
+
+def test_fork_shares_the_common_history():
+    conversation = build(4)
+    shared = conversation[1]
+
+    conversation.fork(2)
+    conversation.add('user', 'another question')
+    [other] = conversation.branches()
+    assert other.path()[1] is shared
+    assert conversation[1] is shared
+    # Both branches agree on the digest of their common prefix
+    assert conversation.digest(2) == build(2).digest()
+
+
+def test_fork_at_the_end_records_no_branch():
+    conversation = build(2)
+    conversation.fork(len(conversation))
+    assert conversation.branches() == []
+
+
+def test_switch_keeps_the_current_branch():
+    conversation = build(4)
+    first = conversation[-1]
+    conversation.fork(2)
+    second = conversation.add('user', 'another question')
+
+    conversation.switch(first)
+    assert conversation[-1] is first and len(conversation) == 4
+    assert conversation.branches() == [second]
+    assert conversation.tokens() == build(4).tokens()
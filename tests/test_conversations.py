@@ -0,0 +1,102 @@
+import pytest
+
+import conversations
+
+from conversation import Conversation
+from persistence import persistence
+from storage import get_backend
+
+
+@pytest.fixture(autouse=True)
+def small_buckets(monkeypatch):
+    get_backend().ensure_indexes()
+    monkeypatch.setattr(conversations, 'BUCKET_SIZE', 3)
+
+
+def build(count: int) -> Conversation:
+    conversation = Conversation()
+    for number in range(count):
+        conversation.add('user' if number % 2 == 0 else 'assistant', f'message {number}')
+    return conversation
+
+
+def saved(session_id: str) -> list:
+    persistence.flush()
+    return conversations.load_messages('user', session_id)
+
+
+def queued(session_id: str) -> list:
+    return [entry for entry in persistence._pending if entry[2].get('session_id') == session_id]
+
+
+def test_save_then_append_only_sends_new_messages():
+    conversation = build(4)
+    session = {'id': 'append'}
+    assert conversations.save_conversation('user', session, conversation) == 4
+    assert saved('append') == conversation.to_storage()
+
+    conversation.add('user', 'message 4')
+    conversation.add('assistant', 'message 5')
+    assert conversations.save_conversation('user', session, conversation) == 2
+
+    # Bucket 1 already holds message 3, only the two new messages are pushed. Bucket 0 gets the new total
+    entries = {entry[2]['bucket']: entry[3] for entry in queued('append')}
+    assert set(entries) == {0, 1}
+    assert entries[0]['$set'] == {'total': 6}
+    assert entries[1]['$push']['messages']['$each'] == conversation.to_storage(4, 6)
+    assert entries[1]['$inc'] == {'count': 2}
+
+    assert saved('append') == conversation.to_storage()
+    assert conversations.list_conversations('user')[0]['total'] == 6
+
+
+def test_unchanged_save_sends_nothing():
+    conversation = build(5)
+    session = {'id': 'unchanged'}
+    conversations.save_conversation('user', session, conversation)
+    persistence.flush()
+
+    assert conversations.save_conversation('user', session, conversation) == 0
+    assert queued('unchanged') == []
+
+
+def test_rewind_and_save_rewrites_from_the_first_change():
+    conversation = build(8)
+    session = {'id': 'rewind'}
+    conversations.save_conversation('user', session, conversation)
+    persistence.flush()
+
+    # Back to message 4, then a different answer: bucket 0 is unchanged, buckets 1 and 2 are not
+    conversation.rewind(4)
+    conversation.add('user', 'another question')
+    assert conversations.save_conversation('user', session, conversation) == 2
+
+    entries = {entry[2]['bucket']: entry[3] for entry in queued('rewind')}
+    assert set(entries) == {0, 1, 2}
+    assert '$push' not in entries[1] and entries[1]['$set']['messages'] == conversation.to_storage(3, 6)
+    # The last bucket of the longer version is emptied, bucket 0 only gets the new total
+    assert entries[2]['$set'] == {'messages': [], 'count': 0}
+    assert entries[0]['$set'] == {'total': 5}
+
+    assert saved('rewind') == conversation.to_storage()
+
+
+def test_two_saves_before_a_flush():
+    conversation = build(2)
+    session = {'id': 'unflushed'}
+    conversations.save_conversation('user', session, conversation)
+    conversation.add('user', 'message 2')
+    conversation.add('assistant', 'message 3')
+    conversations.save_conversation('user', session, conversation)
+
+    assert saved('unflushed') == conversation.to_storage()
+
+
+def test_saves_are_idempotent_by_session_id():
+    conversation = build(4)
+    conversations.save_conversation('user', {'id': 'idempotent'}, conversation)
+    # Another process, or a forgotten session, writes every bucket again instead of appending
+    conversations._saved.clear()
+    conversations.save_conversation('user', {'id': 'idempotent'}, conversation)
+
+    assert saved('idempotent') == conversation.to_storage()
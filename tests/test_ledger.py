@@ -0,0 +1,80 @@
+import threading
+
+import ledger
+
+from persistence import persistence
+from storage import get_backend
+from users import User
+
+
+def stored_user(username: str, balance: float) -> User:
+    get_backend().ensure_indexes()
+    user = User('Test', 'User', 'test@example.com', username, b'not-a-real-hash')
+    user.balance = balance
+    user.save2db()
+    return user
+
+
+def stored_balance(user: User) -> float:
+    return get_backend().find_user({'user_id': user.user_id}, ('balance',))['balance']
+
+
+def queued_events(user: User) -> list:
+    return [entry[3] for entry in persistence._pending if entry[0] == 'usage_events' and entry[3]['user_id'] == user.user_id]
+
+
+def test_reserve_never_overdraws():
+    user = stored_user('ledger-reserve', 1.0)
+    assert user.reserve(0.6)
+    assert not user.reserve(0.6)
+    assert stored_balance(user) == 0.4 and user.balance == 0.4
+
+
+def test_release_gives_the_reservation_back():
+    user = stored_user('ledger-release', 1.0)
+    user.reserve(0.5)
+    user.release(0.5)
+    assert stored_balance(user) == 1.0 and user.balance == 1.0
+
+
+def test_settle_refunds_the_unused_part():
+    user = stored_user('ledger-settle', 1.0)
+    user.reserve(0.5)
+    user.settle(0.5, 0.2, {'model': 'gpt-3.5-turbo'})
+
+    assert stored_balance(user) == 0.8 and user.balance == 0.8
+    [event] = queued_events(user)
+    assert event['cost'] == 0.2 and event['reserved'] == 0.5 and 'overage' not in event
+
+
+def test_settle_charges_an_overage():
+    user = stored_user('ledger-overage', 1.0)
+    user.reserve(0.5)
+    ledger.settle(user.user_id, 0.5, 0.7)
+
+    assert round(stored_balance(user), 8) == 0.3
+    [event] = queued_events(user)
+    assert event['cost'] == 0.7 and event['overage'] == 0.2
+
+
+def test_concurrent_guest_reservations_never_overdraw():
+    guest = User.guest()
+    guest.balance = 10.0
+    start = threading.Barrier(8)
+    reserved = []
+
+    def worker():
+        start.wait()
+        for _ in range(100):
+            if guest.reserve(0.125):
+                reserved.append(0.125)
+
+    threads = [threading.Thread(target=worker) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    # Exact in binary, so exactly 80 reservations fit
+    assert len(reserved) == 80
+    assert guest.balance == 0
@@ -0,0 +1,104 @@
+import os
+
+import pytest
+
+import persistence as persistence_module
+
+from persistence import PersistenceQueue, _merge
+from storage import get_backend
+
+
+def test_merge_sums_inc_and_appends_push():
+    pending = {'$inc': {'balance': -1}, '$push': {'messages': {'$each': ['a']}}}
+    assert _merge(pending, {'$inc': {'balance': 0.5}, '$push': {'messages': {'$each': ['b', 'c']}}})
+    assert pending == {'$inc': {'balance': -0.5}, '$push': {'messages': {'$each': ['a', 'b', 'c']}}}
+
+
+def test_merge_last_set_and_first_set_on_insert_win():
+    pending = {'$set': {'role': 'user'}, '$setOnInsert': {'created': 1}}
+    assert _merge(pending, {'$set': {'role': 'admin'}, '$setOnInsert': {'created': 2}})
+    assert pending == {'$set': {'role': 'admin'}, '$setOnInsert': {'created': 1}}
+
+
+def test_merge_refuses_the_same_field_with_different_operators():
+    pending = {'$set': {'messages': ['a'], 'count': 1}}
+    assert not _merge(pending, {'$push': {'messages': {'$each': ['b']}}, '$inc': {'count': 1}})
+    # Nothing was merged
+    assert pending == {'$set': {'messages': ['a'], 'count': 1}}
+
+
+@pytest.fixture
+def queue(tmp_path):
+    get_backend().ensure_indexes()
+    return PersistenceQueue(
+        flush_interval=3600,
+        journal_path=str(tmp_path / 'journal.jsonl'),
+        rejected_path=str(tmp_path / 'rejected.jsonl'),
+    )
+
+
+def test_rejected_write_is_set_aside(queue):
+    user = {'user_id': 'persistence-duplicate', 'username': 'persistence-duplicate', 'role': 'user', 'balance': 1.0}
+    queue.insert('users', dict(user))
+    queue.flush()
+
+    # The second insert breaks the unique index, it would fail on every replay
+    queue.insert('users', dict(user))
+    queue.flush()
+
+    assert not os.path.exists(queue.journal_path)
+    assert not queue.has_pending()
+    with open(queue.rejected_path) as f:
+        assert len(f.readlines()) == 1
+
+    # Later writes are not held back
+    queue.update('users', {'user_id': 'persistence-duplicate'}, {'$inc': {'balance': 1}})
+    queue.flush()
+    assert get_backend().find_user({'user_id': 'persistence-duplicate'}, ('balance',))['balance'] == 2.0
+
+
+class Unreachable:
+    def write(self, entries):
+        return list(entries), []
+
+
+def test_unreachable_database_journals_and_replays(queue, monkeypatch):
+    user = {'user_id': 'persistence-outage', 'username': 'persistence-outage', 'role': 'user', 'balance': 1.0}
+    queue.insert('users', user)
+
+    monkeypatch.setattr(persistence_module, 'get_backend', Unreachable)
+    queue.flush()
+    assert os.path.exists(queue.journal_path)
+    assert queue.has_pending()
+
+    monkeypatch.setattr(persistence_module, 'get_backend', get_backend)
+    queue.flush()
+    assert not queue.has_pending()
+    assert get_backend().find_user({'user_id': 'persistence-outage'}, ('username',)) == {'username': 'persistence-outage'}
+
+
+class Broken:
+    def write(self, entries):
+        raise RuntimeError("unexpected")
+
+
+def test_unexpected_error_keeps_the_worker_and_the_batch(tmp_path, monkeypatch):
+    get_backend().ensure_indexes()
+    queue = PersistenceQueue(
+        flush_interval=0.01,
+        journal_path=str(tmp_path / 'journal.jsonl'),
+        rejected_path=str(tmp_path / 'rejected.jsonl'),
+    )
+    monkeypatch.setattr(persistence_module, 'get_backend', Broken)
+    queue.insert('users', {'user_id': 'persistence-broken', 'username': 'persistence-broken', 'role': 'user', 'balance': 1.0})
+    queue.flush()
+    assert os.path.exists(queue.journal_path)
+
+    monkeypatch.setattr(persistence_module, 'get_backend', get_backend)
+    queue.insert('users', {'user_id': 'persistence-after', 'username': 'persistence-after', 'role': 'user', 'balance': 1.0})
+    queue.close()
+
+    assert queue._thread.is_alive() is False
+    assert not queue.has_pending()
+    for user_id in ('persistence-broken', 'persistence-after'):
+        assert get_backend().find_user({'user_id': user_id}, ('user_id',)) == {'user_id': user_id}
@@ -0,0 +1,76 @@
+import time
+
+import pytest
+
+from rate_limit import ModelRateLimiter, TokenBucket, get_limiter
+
+
+class Clock:
+    def __init__(self):
+        self.now = 100.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(time, 'monotonic', clock)
+    return clock
+
+
+def test_reservations_within_capacity_do_not_wait(clock):
+    bucket = TokenBucket(60)
+    assert bucket.reserve(30) == 0
+    assert bucket.reserve(30) == 0
+
+
+def test_waits_are_queued_in_arrival_order(clock):
+    # 1 token per second
+    bucket = TokenBucket(60)
+    bucket.reserve(60)
+    assert bucket.reserve(10) == 10
+    assert bucket.reserve(5) == 15
+
+
+def test_bucket_refills_up_to_capacity(clock):
+    bucket = TokenBucket(60)
+    bucket.reserve(60)
+    clock.now += 30
+    assert bucket.reserve(30) == 0
+
+    clock.now += 3600
+    assert bucket.reserve(60) == 0
+    assert bucket.reserve(1) == 1
+
+
+def test_large_requests_are_clamped_to_capacity(clock):
+    bucket = TokenBucket(60)
+    assert bucket.reserve(1000) == 0
+    assert bucket.reserve(1) == 1
+
+
+def test_release_gives_capacity_back(clock):
+    bucket = TokenBucket(60)
+    bucket.reserve(60)
+    bucket.release(20)
+    assert bucket.reserve(20) == 0
+
+
+def test_limiter_waits_for_the_further_limit(clock):
+    limiter = ModelRateLimiter(rpm=60, tpm=600)
+    limiter.acquire(600)
+    # One more request per second, but 60 tokens take 6 seconds
+    assert limiter._reserve(60) == 6
+
+
+def test_settle_returns_unused_tokens(clock):
+    limiter = ModelRateLimiter(rpm=60, tpm=600)
+    limiter.acquire(600)
+    limiter.settle(600, 100)
+    assert limiter.tokens.reserve(500) == 0
+
+
+def test_model_aliases_share_a_limiter():
+    assert get_limiter('gpt-3.5-turbo') is get_limiter('gpt-3.5-turbo-0301')
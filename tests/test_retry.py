@@ -0,0 +1,128 @@
+import asyncio
+import time
+
+import openai
+import pytest
+
+from exceptions import CircuitOpen
+from retry import CircuitBreaker, RetryPolicy, acall_with_retry, call_with_retry, get_retry_after, is_transient
+
+
+# Retries without waiting
+NO_WAIT = RetryPolicy(max_attempts=3, base_delay=0, max_delay=0)
+
+
+class Clock:
+    def __init__(self):
+        self.now = 100.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(time, 'monotonic', clock)
+    return clock
+
+
+def failing(errors, response='ok'):
+    calls = []
+
+    def send():
+        calls.append(1)
+        if errors:
+            raise errors.pop(0)
+        return response
+    return send, calls
+
+
+def test_transient_errors():
+    assert is_transient(openai.error.RateLimitError('slow down'))
+    assert is_transient(openai.error.APIError('server error', http_status=502))
+    assert not is_transient(openai.error.InvalidRequestError('bad request', param=None))
+    assert not is_transient(ValueError())
+
+
+def test_retry_after_header_sets_the_minimum_delay():
+    error = openai.error.RateLimitError('slow down', headers={'retry-after': '3'})
+    assert get_retry_after(error) == 3
+    assert RetryPolicy(base_delay=0.1, max_delay=20).delay(1, error) == 3
+
+
+def test_transient_errors_are_retried():
+    send, calls = failing([openai.error.Timeout(), openai.error.APIConnectionError('down')])
+    assert call_with_retry(send, NO_WAIT, CircuitBreaker()) == 'ok'
+    assert len(calls) == 3
+
+
+def test_permanent_errors_are_not_retried():
+    send, calls = failing([openai.error.InvalidRequestError('bad request', param=None)])
+    with pytest.raises(openai.error.InvalidRequestError):
+        call_with_retry(send, NO_WAIT, CircuitBreaker())
+    assert len(calls) == 1
+
+
+def test_attempts_run_out():
+    send, calls = failing([openai.error.Timeout()] * 5)
+    with pytest.raises(openai.error.Timeout):
+        call_with_retry(send, NO_WAIT, CircuitBreaker())
+    assert len(calls) == 3
+
+
+def test_no_retry_once_content_was_streamed():
+    send, calls = failing([openai.error.Timeout()])
+    with pytest.raises(openai.error.Timeout):
+        call_with_retry(send, NO_WAIT, CircuitBreaker(), can_retry=lambda: False)
+    assert len(calls) == 1
+
+
+def test_async_retry():
+    errors = [openai.error.Timeout()]
+
+    async def send():
+        if errors:
+            raise errors.pop()
+        return 'ok'
+
+    assert asyncio.run(acall_with_retry(send, NO_WAIT, CircuitBreaker())) == 'ok'
+
+
+def test_circuit_opens_after_repeated_failures(clock):
+    breaker = CircuitBreaker(failure_threshold=2, reset_timeout=30)
+    breaker.record_failure()
+    breaker.before_request()
+    breaker.record_failure()
+
+    with pytest.raises(CircuitOpen) as raised:
+        breaker.before_request()
+    assert raised.value.retry_in == 30
+
+
+def test_half_open_circuit_lets_one_trial_through(clock):
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=30)
+    breaker.record_failure()
+    clock.now += 31
+
+    breaker.before_request()
+    with pytest.raises(CircuitOpen):
+        breaker.before_request()
+
+    # A failed trial opens the circuit again, a successful one closes it
+    breaker.record_failure()
+    with pytest.raises(CircuitOpen):
+        breaker.before_request()
+    clock.now += 31
+    breaker.before_request()
+    breaker.record_success()
+    breaker.before_request()
+    breaker.before_request()
+
+
+def test_open_circuit_fails_fast(clock):
+    breaker = CircuitBreaker(failure_threshold=1)
+    send, calls = failing([openai.error.Timeout()] * 5)
+    with pytest.raises(CircuitOpen):
+        call_with_retry(send, NO_WAIT, breaker)
+    assert len(calls) == 1
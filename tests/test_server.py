@@ -0,0 +1,58 @@
+import asyncio
+
+from aiohttp.test_utils import TestClient, TestServer
+
+import conversations
+import server
+
+from conversation import Conversation
+from persistence import persistence
+from storage import get_backend
+from users import User
+
+
+def saved_user() -> User:
+    get_backend().ensure_indexes()
+    user = User('Test', 'User', 'test@example.com', 'server-test', b'not-a-real-hash')
+    user.save2db()
+
+    conversation = Conversation()
+    conversation.add('user', 'Hi')
+    conversation.add('assistant', 'Hello')
+    conversations.save_conversation(user.user_id, {'id': 'saved-session'}, conversation)
+    persistence.flush()
+    return user
+
+
+def run(requests):
+    async def main():
+        client = TestClient(TestServer(server.create_app()))
+        await client.start_server()
+        try:
+            return await requests(client)
+        finally:
+            await client.close()
+    return asyncio.run(main())
+
+
+def test_saved_conversation_can_be_read_and_continued(monkeypatch):
+    # The app closes the shared queue on cleanup, the other tests still use it
+    monkeypatch.setattr(persistence, 'close', persistence.flush)
+    user = saved_user()
+    headers = {'Authorization': f'Bearer {user.issue_token()}'}
+
+    async def requests(client):
+        loaded = await client.get('/conversations/saved-session', headers=headers)
+        missing = await client.get('/conversations/unknown', headers=headers)
+        resumed = await client.post('/sessions', json={'conversation': 'saved-session'}, headers=headers)
+        again = await client.post('/sessions', json={'conversation': 'saved-session'}, headers=headers)
+        return await loaded.json(), missing.status, resumed.status, await resumed.json(), again.status
+
+    loaded, missing, status, session, again = run(requests)
+
+    assert [message['content'] for message in loaded['messages']] == ['Hi', 'Hello']
+    assert missing == 404
+    assert status == 201
+    # The session keeps the saved id, so saving it updates the same conversation
+    assert session['session_id'] == 'saved-session' and session['messages'] == 2
+    assert again == 409
@@ -0,0 +1,30 @@
+import pytest
+
+from storage import apply_update
+
+
+def test_set_inc_and_unset():
+    document = {'balance': 1.0, 'role': 'user', 'old': True}
+    updated = apply_update(document, {'$set': {'role': 'admin'}, '$inc': {'balance': -0.25, 'requests': 1}, '$unset': {'old': ''}})
+    assert updated == {'balance': 0.75, 'role': 'admin', 'requests': 1}
+    # The original document is not changed
+    assert document == {'balance': 1.0, 'role': 'user', 'old': True}
+
+
+def test_set_on_insert_only_applies_when_inserting():
+    update = {'$setOnInsert': {'created': 1}, '$set': {'count': 2}}
+    assert apply_update({}, update, inserting=True) == {'created': 1, 'count': 2}
+    assert apply_update({'created': 0}, update) == {'created': 0, 'count': 2}
+
+
+def test_push_single_value_and_each():
+    document = {'messages': ['a']}
+    document = apply_update(document, {'$push': {'messages': 'b'}})
+    document = apply_update(document, {'$push': {'messages': {'$each': ['c', 'd']}}})
+    assert document['messages'] == ['a', 'b', 'c', 'd']
+    assert apply_update({}, {'$push': {'messages': {'$each': ['x']}}}, inserting=True) == {'messages': ['x']}
+
+
+def test_unsupported_operator():
+    with pytest.raises(ValueError):
+        apply_update({}, {'$pull': {'messages': 'a'}})
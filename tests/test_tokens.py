@@ -0,0 +1,29 @@
+from tokens import TOKENS_PER_MESSAGE, TOKENS_PER_REPLY, count_message_tokens, estimate_tokens
+
+
+def test_words_and_punctuation():
+    # Hello(2) there(2) ,(1) how(1) are(1) you(1) ?(1)
+    assert estimate_tokens('Hello there, how are you?') == 9
+    # Long words are split into chunks
+    assert estimate_tokens('internationalization') == 5
+
+
+def test_digits_are_grouped():
+    assert estimate_tokens('1234567890123456') == 6
+    assert estimate_tokens('7') == 1
+
+
+def test_whitespace_runs_count():
+    assert estimate_tokens('a b') == 2
+    assert estimate_tokens('a\n        b') == estimate_tokens('a b') + 3
+
+
+def test_non_ascii_characters_count_at_least_one_token_each():
+    assert estimate_tokens('我们今天去公园散步') >= 9
+    assert estimate_tokens('Привет') >= 6
+
+
+def test_count_message_tokens():
+    messages = [{'role': 'user', 'content': 'Hi'}, {'role': 'assistant', 'content': 'Hello'}]
+    expected = TOKENS_PER_REPLY + (TOKENS_PER_MESSAGE + 1 + 1) + (TOKENS_PER_MESSAGE + 3 + 2)
+    assert count_message_tokens(messages) == expected
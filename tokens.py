@@ -0,0 +1,97 @@
+# This file contains an offline token estimator used by the chat application.
+
+import re
+
+from functools import lru_cache
+
+
+# Rough approximation of the BPE tokenizer: words, runs of digits, runs of whitespace and individual punctuation marks
+TOKEN_PATTERN = re.compile(r"\d+|[^\W\d]+|\s+|[^\w\s]", re.UNICODE)
+
+# Average number of characters per token for long words and whitespace runs
+CHARS_PER_TOKEN = 4
+
+# The tokenizer splits numbers into groups of at most 3 digits
+DIGITS_PER_TOKEN = 3
+
+# Every chat message is wrapped in <|start|>{role}\n{content}<|end|>\n
+TOKENS_PER_MESSAGE = 4
+
+# Every reply is primed with <|start|>assistant<|message|>
+TOKENS_PER_REPLY = 3
+
+# Number of distinct messages to remember token counts for
+MESSAGE_CACHE_SIZE = 8192
+
+
+def estimate_tokens(text: str) -> int:
+    '''
+    Estimate the number of tokens in a piece of text without calling the API.
+
+    Errs on the high side, so reservations usually cover the real count:
+    - ASCII words count one token per CHARS_PER_TOKEN characters.
+    - Other characters (accents, Cyrillic, CJK, ...) take one or more tokens each in the real
+      tokenizer, so each counts as one token.
+    - Numbers count one token per DIGITS_PER_TOKEN digits.
+    - A single space is part of the next word. Other whitespace (newlines, indentation) counts one
+      token per CHARS_PER_TOKEN characters.
+    It is still an estimate, see ledger.settle() for costs above the reservation.
+
+    Args:
+        text (str): The text to estimate
+    Returns:
+        int: The estimated number of tokens
+    '''
+    count = 0
+    for piece in TOKEN_PATTERN.findall(text):
+        if piece == ' ':
+            continue
+        if piece.isdigit():
+            count += -(-len(piece) // DIGITS_PER_TOKEN)
+            continue
+        # Short words are usually a single token, longer words are split into chunks
+        non_ascii = len(piece) - len(piece.encode('ascii', 'ignore'))
+        count += -(-(len(piece) - non_ascii) // CHARS_PER_TOKEN) + non_ascii
+    return count
+
+
+def estimate_message_tokens(role: str, content: str) -> int:
+    '''
+    Estimate the number of tokens of a message given its role and content, without memoizing it.
+    For counts that are kept elsewhere, e.g. by the Conversation.
+    '''
+    return TOKENS_PER_MESSAGE + estimate_tokens(role) + estimate_tokens(content)
+
+
+def message_tokens(message: dict) -> int:
+    '''
+    Estimate the number of tokens a single chat message adds to the prompt. Counts are memoized.
+
+    Args:
+        message (dict): The message, with a role and content
+    Returns:
+        int: The estimated number of tokens
+    '''
+    return _message_tokens(message['role'], message['content'])
+
+
+@lru_cache(maxsize=MESSAGE_CACHE_SIZE)
+def _message_tokens(role: str, content: str) -> int:
+    # Memoized, so every turn only tokenizes the messages that are new since the last one.
+    # Python caches the hash of a str, so repeated lookups of the same message are O(1)
+    return estimate_message_tokens(role, content)
+
+
+def count_message_tokens(messages: list) -> int:
+    '''
+    Estimate the number of prompt tokens for a list of chat messages.
+
+    Args:
+        messages (list): The messages, as sent to the API
+    Returns:
+        int: The estimated number of prompt tokens
+    '''
+    count = TOKENS_PER_REPLY
+    for message in messages:
+        count += message_tokens(message)
+    return count
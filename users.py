@@ -1,31 +1,43 @@
-import bcrypt
+import asyncio
+import threading
 import uuid
-from pymongo import MongoClient
-
-# Using dotenv to load environment variables, development only
-# from dotenv import load_dotenv
-# load_dotenv()
-
-# Using config.py to load environment variables, production
-from config import ATLAS_URI
-
-# Connect to the database
-# atlas_url = os.getenv('ATLAS_URI') #! Development only, use config.py for production
-atlas_url = ATLAS_URI
-client = MongoClient(atlas_url)
-db = client['openai-app']
-users_collection = db['users']
-  
+
+import auth
+import conversations
+import ledger
+
+from persistence import persistence
+
+# Users are stored through the backend selected in config.py (MongoDB or SQLite)
+from storage import get_backend
+
+# Fields needed to build a User. Leaves out anything else stored on the document (e.g. old embedded conversations)
+USER_FIELDS = ('user_id', 'first_name', 'last_name', 'email', 'username', 'password', 'role', 'balance')
+
+# Public user details, for lookups that don't authenticate
+PROFILE_FIELDS = ('user_id', 'first_name', 'last_name', 'email', 'username', 'role', 'balance')
+
+# Guards the in-memory balances. A guest's balance only lives in memory, so its check and deduction
+# must not interleave, e.g. between the concurrent records of a batch. Shared by all users, the
+# critical sections are a few arithmetic operations
+_balance_lock = threading.Lock()
+
 class User:
+    # Fixed attributes keep each instance small when many users are held in memory
+    __slots__ = ('first_name', 'last_name', 'email', 'username', 'password', 'role', 'balance', 'user_id', '_dirty')
+
+    # Fields written by save() when they change. The balance is only changed by the ledger
+    TRACKED_FIELDS = frozenset(['first_name', 'last_name', 'email', 'username', 'password', 'role'])
+
     def __init__(self, first_name, last_name, email, username, password, role='user'):
         # self.db = Database()
+        self._dirty = set()
         self.first_name = first_name
         self.last_name = last_name
         self.email = email
         self.username = username
         self.role = role
         self.balance: float = 0
-        self.conversations = []
         self.user_id = self.generate_user_id()
 
         if role == 'user':
@@ -35,12 +47,28 @@ class User:
         elif role == 'admin':
             self.balance = 100.00000
 
-        try:
-            self.password = self.hash_password(password)
-        except AttributeError as e:
-            # If the password is already hashed, set the password to the hashed password
+        if isinstance(password, bytes):
+            # Already hashed, e.g. loaded from the database. Never goes through the bcrypt pool
             self.password = password
+        else:
+            self.password = self.hash_password(password)
 
+        # A new user is saved in full by save2db(), nothing is dirty yet
+        self._dirty.clear()
+
+    def __setattr__(self, name, value):
+        '''
+        Track changes to the saved fields, so save() only writes what changed.
+        '''
+        if name in User.TRACKED_FIELDS and getattr(self, name, None) != value:
+            self._dirty.add(name)
+        object.__setattr__(self, name, value)
+
+    def is_dirty(self):
+        '''
+        Check if any saved field changed since the user was loaded or saved.
+        '''
+        return bool(self._dirty)
 
     @classmethod
     def check_username(cls, username):
@@ -52,19 +80,19 @@ class User:
         Returns:
             bool: True if the username is unique, False otherwise
         '''
-        user = users_collection.find_one({'username': username})
+        user = get_backend().find_user({'username': username}, ('user_id',))
         return user is None # If user is None, username is unique. Returns True
 
     def hash_password(self, password):
         '''
-        Hash the password using bcrypt.
+        Hash the password using bcrypt, in the bcrypt worker pool with the calibrated cost factor.
 
         Args:
             password (str): The password to hash
         Returns:
             str: The hashed password
         '''
-        return bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt())
+        return auth.hash_password(password)
 
 
     def check_password(self, password: str):
@@ -76,7 +104,7 @@ class User:
         Returns:
             bool: True if the password matches, False otherwise
         '''   
-        return bcrypt.checkpw(password.decode('utf-8'), self.password)
+        return auth.check_password(password, self.password)
     
     def generate_user_id(self):
         '''
@@ -118,8 +146,7 @@ class User:
             "username": self.username,
             "password": self.password,
             "role": self.role,
-            "balance": self.balance,
-            "conversations": self.conversations
+            "balance": self.balance
         }
 
     # Store the user data in the database. On user creation, the user is saved to the database.
@@ -128,7 +155,11 @@ class User:
         Save the user data to the database, and checks for unique username. Used on user creation.
         '''
         if self.check_username(self.username):
-            users_collection.insert_one(self.to_json())
+            if not get_backend().insert_user(self.to_json()):
+                # Someone else took the username since the check. The unique index catches it
+                print('\nError: Username already exists')
+                return False
+            self._dirty.clear()
             # print(f'User {self.username} saved to database')
             return True
         else:
@@ -140,7 +171,7 @@ class User:
         '''
         Delete the user from the database.
         '''
-        users_collection.delete_one({'user_id': self.user_id})
+        get_backend().delete_user(self.user_id)
         print(f'User {self.username} deleted from database')
 
 
@@ -152,7 +183,7 @@ class User:
             field (str): The field to update
             value (str): The value to update the field to
         '''
-        users_collection.update_one({'user_id': self.user_id}, {'$set': {field: value}})
+        get_backend().update_users([({'user_id': self.user_id}, {'$set': {field: value}})])
         # print(f'User {self.username} updated in database')
 
 
@@ -169,25 +200,20 @@ class User:
             User: The user if authenticated, None otherwise
         '''
 
-        user_data = users_collection.find_one({'username': username})
+        user_data = get_backend().find_user({'username': username}, USER_FIELDS)
 
         if user_data:
-            # User exists, check password
+            # User exists, check password. Runs in the bcrypt worker pool
             hashed_password = user_data['password']
-            #if bcrypt.checkpw(password.decode('utf-8'), hashed_password):
-            if bcrypt.checkpw(bytes(password, 'utf-8'), hashed_password):
+            if auth.check_password(password, hashed_password):
                 # Password matches, get the user and return
-                user = cls(
-                    first_name=user_data['first_name'],
-                    last_name=user_data['last_name'],
-                    email=user_data['email'],
-                    username=user_data['username'],
-                    password=hashed_password,
-                    role=user_data['role']
-                )
-                user.user_id = user_data['user_id']
-                user.balance = float(user_data['balance'])
-                user.conversations = user_data['conversations']
+                user = cls.from_document(user_data)
+
+                # Rehash passwords stored with a lower cost factor than this machine can now afford
+                if auth.hashed_rounds(hashed_password) < auth.get_rounds():
+                    user.password = user.hash_password(password)
+                    user.save()
+
                 return user
             else:
                 # Password does not match
@@ -197,6 +223,78 @@ class User:
             return None
         
 
+    @classmethod
+    async def aauthenticate(cls, username, password):
+        '''
+        Async version of authenticate(). The lookup runs in a worker thread and the password check in
+        the bcrypt pool, without holding a thread while it waits.
+
+        Returns:
+            User: The user if authenticated, None otherwise
+        '''
+        user_data = await asyncio.to_thread(get_backend().find_user, {'username': username}, USER_FIELDS)
+        if not user_data:
+            return None
+
+        hashed_password = user_data['password']
+        if not await auth.acheck_password(password, hashed_password):
+            return None
+
+        user = cls.from_document(user_data)
+
+        # Rehash passwords stored with a lower cost factor than this machine can now afford
+        if auth.hashed_rounds(hashed_password) < auth.get_rounds():
+            user.password = await auth.ahash_password(password)
+            user.save()
+
+        return user
+
+    @classmethod
+    def from_document(cls, user_data: dict):
+        '''
+        Build a user from its database document. The stored hash is used as is, without bcrypt.
+        '''
+        password = user_data['password']
+        if isinstance(password, str):
+            password = password.encode('utf-8')
+
+        user = cls(
+            first_name=user_data['first_name'],
+            last_name=user_data['last_name'],
+            email=user_data['email'],
+            username=user_data['username'],
+            password=password,
+            role=user_data['role']
+        )
+        user.user_id = user_data['user_id']
+        user.balance = float(user_data['balance'])
+        # Conversations are stored in their own collection and loaded on demand
+        user._dirty.clear()
+        return user
+
+    def issue_token(self):
+        '''
+        Issue a signed session token for the user, to authenticate again without the password.
+        '''
+        return auth.issue_token(self.user_id)
+
+    @classmethod
+    def from_token(cls, token: str):
+        '''
+        Authenticate the user from a session token issued by issue_token(). Skips bcrypt entirely.
+
+        Args:
+            token (str): The session token
+        Returns:
+            User: The user if the token is valid, None otherwise
+        '''
+        user_id = auth.verify_token(token)
+        if user_id is None:
+            return None
+
+        user_data = get_backend().find_user({'user_id': user_id}, USER_FIELDS)
+        return cls.from_document(user_data) if user_data else None
+
     @classmethod    
     def guest(cls):
         '''
@@ -207,7 +305,7 @@ class User:
             last_name='',
             email='',
             username='guest',
-            password='',
+            password=b'',     # Guests never log in, there is nothing to hash
             role='guest')
 
 
@@ -234,25 +332,174 @@ class User:
         Returns:
             User: The user if found, None otherwise
         '''
-        user = users_collection.find_one({'username': username})
+        user = get_backend().find_user({'username': username}, PROFILE_FIELDS)
         return user
     
-    def expense(self, amount):
+    @classmethod
+    def iter_users(cls, role=None, min_balance=None, max_balance=None, page=0, limit=None, batch_size=100):
+        '''
+        Stream users from the database, one batch at a time, without their password hash or history.
+
+        Args:
+            role (str): Only users with this role
+            min_balance (float): Only users with at least this balance
+            max_balance (float): Only users with at most this balance
+            page (int): The page to start at, in pages of limit users
+            limit (int): The maximum number of users. Streams every matching user if None
+            batch_size (int): The number of users fetched per round-trip
+        Yields:
+            dict: The public user details
+        '''
+        filters = {'role': role, 'min_balance': min_balance, 'max_balance': max_balance}
+        return get_backend().iter_users(filters, PROFILE_FIELDS, page, limit, batch_size)
+
+    @staticmethod
+    def build_admin_update(role=None, credit=None):
+        '''
+        Build the update for an admin change: a new role and/or a balance credit.
+        '''
+        update = {}
+        if role:
+            update['$set'] = {'role': role}
+        if credit:
+            # Atomic increment, so it can't overwrite concurrent balance changes
+            update['$inc'] = {'balance': credit}
+        return update
+
+    @classmethod
+    def bulk_update(cls, changes):
+        '''
+        Apply role changes and balance credits to many users in a single bulk_write.
+
+        Args:
+            changes: An iterable of (username, role, credit). role and credit may be None
+        Returns:
+            tuple: The number of users matched and modified
+        '''
+        updates = []
+        for username, role, credit in changes:
+            update = cls.build_admin_update(role, credit)
+            if update:
+                updates.append(({'username': username}, update))
+
+        if not updates:
+            return 0, 0
+
+        return get_backend().update_users(updates)
+
+    @classmethod
+    def update_matching(cls, filters: dict, role=None, credit=None):
         '''
-        Reduce the user balance by the amount.
+        Apply a role change and/or balance credit to every user matching the admin filters, in one round-trip.
 
         Args:
-            amount (float): The amount to reduce the balance by
+            filters (dict): The admin filters: role, min_balance and max_balance
+            role (str): The new role
+            credit (float): The amount to add to the balance
+        Returns:
+            tuple: The number of users matched and modified
+        '''
+        update = cls.build_admin_update(role, credit)
+        if not update:
+            return 0, 0
+
+        return get_backend().update_matching(filters, update)
+
+    def reserve(self, amount):
         '''
-        self.balance -= amount
-        self.update('balance', self.balance)
+        Reserve the maximum cost of a request from the balance, before it is sent.
+
+        Args:
+            amount (float): The maximum cost of the request
+        Returns:
+            bool: True if the amount was reserved, False if the balance is insufficient
+        '''
+        if self.role == 'guest':
+            # Guests are not stored in the database, their balance only lives in memory
+            with _balance_lock:
+                if self.balance < amount:
+                    return False
+                self.balance -= amount
+            return True
+
+        balance = ledger.reserve(self.user_id, amount)
+        if balance is None:
+            return False
+        with _balance_lock:
+            self.balance = balance
+        return True
+
+    def release(self, amount):
+        '''
+        Give back a reservation that was not used.
+
+        Args:
+            amount (float): The reserved amount
+        '''
+        with _balance_lock:
+            self.balance += amount
+        if self.role != 'guest':
+            ledger.release(self.user_id, amount)
+
+    def settle(self, reserved, cost, details=None):
+        '''
+        Settle a reservation with the actual cost of the request, and record the usage.
+
+        The cost is estimated for streamed responses and can exceed the reservation. The whole cost
+        is charged, see ledger.settle().
+
+        Args:
+            reserved (float): The reserved amount
+            cost (float): The actual cost of the request
+            details (dict): Extra details for the usage event, e.g. model and token usage
+        '''
+        with _balance_lock:
+            self.balance += round(reserved - cost, 8)
+        if self.role != 'guest':
+            ledger.settle(self.user_id, reserved, cost, details)
+
+    def get_conversations(self, page: int = 0, page_size: int = 20):
+        '''
+        Get a page of the user's saved conversations, newest first, without their messages.
+
+        Args:
+            page (int): The page number, starting at 0
+            page_size (int): The number of conversations per page
+        Returns:
+            list: The conversation summaries
+        '''
+        return conversations.list_conversations(self.user_id, page, page_size)
+
+    def get_conversation_messages(self, session_id: str):
+        '''
+        Get the messages of one of the user's saved conversations.
+        '''
+        return conversations.load_messages(self.user_id, session_id)
 
     def save(self):
         '''
-        Save the user to the database. Used on user update on application exit.
+        Save the changed fields of the user to the database. Used on user update on application exit.
         '''
-        users_collection.update_one({'user_id': self.user_id}, {'$set': self.to_json()})
+        # Nothing changed, nothing to write
+        if not self._dirty:
+            return
+
+        # Only the changed fields are written. The balance is only ever changed by the ledger's atomic updates
+        user_data = {field: getattr(self, field) for field in self._dirty}
+        self._dirty.clear()
 
+        # Written in the background, pending writes are flushed on application exit
+        persistence.update('users', {'user_id': self.user_id}, {'$set': user_data})
 
 
+def ensure_indexes():
+    '''
+    Create the database indexes. Runs once at startup, in the background.
+    '''
+    try:
+        get_backend().ensure_indexes()
+    except Exception as e:
+        print(f"Warning: Could not create database indexes ({e})")
 
+    # Pick the bcrypt cost factor before the first login needs it
+    auth.get_rounds()